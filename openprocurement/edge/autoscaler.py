@@ -0,0 +1,72 @@
+# -*- coding: utf-8 -*-
+import math
+
+
+class WorkersAutoscaler(object):
+
+    """Sizes main workers pool to drain backlog in ``drain_time`` seconds
+
+    Arrival and completion rates of resource items queue are measured
+    between updates and smoothed with EWMA. Needed throughput is arrival
+    rate plus backlog divided by ``drain_time``, throughput of one worker
+    is taken from completion rate or, before anything is completed, from
+    upstream request latency. While share of 429 answers is above
+    ``throttle_ratio_max`` pool only shrinks, more workers would only get
+    more 429. Pool grows at once and shrinks by one worker per update.
+    """
+
+    def __init__(self, workers_min, workers_max, drain_time=60,
+                 throttle_ratio_max=0.05, smoothing=0.5):
+        self.workers_min = workers_min
+        self.workers_max = workers_max
+        self.drain_time = drain_time
+        self.throttle_ratio_max = throttle_ratio_max
+        self.smoothing = smoothing
+        self.arrival_rate = 0.0
+        self.completion_rate = 0.0
+        self.throttle_ratio = 0.0
+        self.last = None
+
+    def _smooth(self, previous, value):
+        return previous + self.smoothing * (value - previous)
+
+    def update(self, now, qsize, got, requests, throttled):
+        """Take counters of queue and API clients at time ``now``"""
+        if self.last is not None:
+            last_now, last_qsize, last_got, last_requests, last_throttled =\
+                self.last
+            elapsed = now - last_now
+            if elapsed > 0:
+                completed = max(got - last_got, 0)
+                arrived = max(completed + qsize - last_qsize, 0)
+                self.completion_rate = self._smooth(
+                    self.completion_rate, completed / float(elapsed))
+                self.arrival_rate = self._smooth(
+                    self.arrival_rate, arrived / float(elapsed))
+                # Counters of released API clients are gone
+                sent = requests - last_requests
+                self.throttle_ratio = max(
+                    throttled - last_throttled, 0) / float(sent) \
+                    if sent > 0 else 0.0
+        self.last = (now, qsize, got, requests, throttled)
+
+    def desired(self, workers, qsize, latency=0):
+        """Number of main workers for current backlog and rates"""
+        if self.throttle_ratio > self.throttle_ratio_max:
+            desired = workers - 1
+        else:
+            if workers > 0 and self.completion_rate > 0:
+                worker_rate = self.completion_rate / workers
+            elif latency > 0:
+                worker_rate = 1.0 / latency
+            else:
+                worker_rate = None
+            needed = self.arrival_rate + float(qsize) / self.drain_time
+            if worker_rate is None:
+                # Nothing measured yet, probe with one more worker
+                desired = workers + 1 if qsize else self.workers_min
+            else:
+                desired = int(math.ceil(needed / worker_rate))
+            if desired < workers:
+                desired = workers - 1
+        return min(max(desired, self.workers_min), self.workers_max)
@@ -0,0 +1,1027 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import argparse
+import gc
+import logging
+import logging.config
+import math
+import os
+import psutil
+import random
+import sys
+import uuid
+from bisect import bisect_left, bisect_right
+from collections import Counter, OrderedDict, defaultdict, deque
+from Cookie import SimpleCookie
+from couchdb import Server
+from datetime import datetime, timedelta
+from gevent import sleep, spawn
+from gevent.pywsgi import WSGIServer
+from json import dumps, loads
+from time import time
+from urlparse import parse_qsl, urlsplit
+from yaml import load
+from openprocurement.edge.databridge import EdgeDataBridge
+from openprocurement.edge.items import QueueItem
+from openprocurement.edge.latency import percentile
+from openprocurement.edge.recorder import read_records
+from openprocurement.edge.retry import retry_delay
+from openprocurement.edge.utils import TZ, VALIDATE_BULK_DOCS_ID
+
+logger = logging.getLogger(__name__)
+
+STATUSES = {
+    200: '200 OK',
+    201: '201 Created',
+    304: '304 Not Modified',
+    400: '400 Bad Request',
+    404: '404 Not Found',
+    409: '409 Conflict',
+    412: '412 Precondition Failed',
+    429: '429 Too Many Requests',
+    500: '500 Internal Server Error',
+    502: '502 Bad Gateway',
+    503: '503 Service Unavailable'
+}
+
+# Bridge options needed to run against fake upstream, the rest are defaults
+BRIDGE_OPTIONS = {
+    'resources_api_version': '2.3',
+    'watch_interval': 1,
+    'retrievers_params': {
+        'down_requests_sleep': 0.1,
+        'up_requests_sleep': 0.1,
+        'up_wait_sleep': 30,
+        'up_wait_sleep_min': 1,
+        'queue_size': 1001
+    }
+}
+
+REPORT_FIELDS = (
+    'duration', 'docs_saved', 'docs_per_sec', 'initial_sync_sec',
+    'changes_made', 'changes_saved', 'lag_p50', 'lag_p95', 'lag_p99',
+    'lag_max', 'upstream_requests', 'document_requests', 'feed_requests',
+    'throttled', 'not_found', 'not_modified', 'not_recorded',
+    'requests_per_saved_doc',
+    'rss_start_mb', 'rss_peak_mb', 'rss_growth_mb'
+)
+
+QUEUE_ITEMS_REPORT_FIELDS = (
+    'items', 'dict_bytes', 'queue_item_bytes', 'dict_rss_mb',
+    'queue_item_rss_mb', 'dict_usec', 'queue_item_usec', 'dict_retry_usec',
+    'queue_item_retry_usec'
+)
+
+LOG_EVENTS_REPORT_FIELDS = (
+    'duration', 'log_level', 'log_sample_rate', 'unsampled_docs_saved',
+    'sampled_docs_saved', 'unsampled_docs_per_sec', 'sampled_docs_per_sec',
+    'unsampled_lag_p95', 'sampled_lag_p95', 'unsampled_upstream_requests',
+    'sampled_upstream_requests'
+)
+
+RETRY_CONFIG = {
+    'retry_default_timeout': 1,
+    'retry_max_timeout': 300,
+    'retry_jitter': 0.1
+}
+
+
+def respond(start_response, status, body='', headers=()):
+    if not isinstance(body, str):
+        body = dumps(body)
+    start_response(STATUSES[status], [
+        ('Content-Type', 'application/json'),
+        ('Content-Length', str(len(body)))] + list(headers))
+    return [body]
+
+
+def read_body(environ):
+    length = environ.get('CONTENT_LENGTH')
+    if length:
+        return environ['wsgi.input'].read(int(length))
+    return environ['wsgi.input'].read()
+
+
+class FakeUpstream(object):
+
+    """WSGI app imitating public openprocurement API
+
+    Serves ``docs`` synthetic resource items of about ``doc_size`` bytes
+    through ``feed=changes`` feed and document endpoints, ``changer``
+    modifies ``change_rate`` random items per second. Every request waits
+    for lognormal latency with ``latency`` median, document requests are
+    answered 429 and 404 with ``rate_429`` and ``rate_404`` probability.
+
+    Clients are pinned with SERVER_ID cookie to one of ``backends``, the
+    first backend is actual and the others lag behind evenly up to
+    ``replica_lag`` seconds, so they answer with previous version or 404
+    for recent changes. Feed is always actual. ``changed`` maps every
+    (id, dateModified) to time of change, ``requests`` counts requests.
+    """
+
+    def __init__(self, resource='tenders', docs=1000, doc_size=4096,
+                 change_rate=10, latency=0.05, latency_sigma=0.5,
+                 rate_429=0, rate_404=0, backends=1, replica_lag=0,
+                 history=10):
+        self.resource = resource
+        self.doc_size = doc_size
+        self.change_rate = change_rate
+        self.latency = latency
+        self.latency_sigma = latency_sigma
+        self.rate_429 = rate_429
+        self.rate_404 = rate_404
+        self.backends = ['backend{}'.format(i) for i in xrange(backends)]
+        self.replica_lag = replica_lag
+        self.history = history
+        self.item_ids = []
+        self.versions = {}  # id -> (change time, dateModified, body)
+        self.seqs = []  # feed sequence numbers, ascending
+        self.seq_ids = {}  # seq -> id
+        self.item_seqs = {}  # id -> seq of last change
+        self.seq = 0
+        self.changed = {}
+        self.requests = Counter()
+        self.last_modified = datetime.now(TZ)
+        self.padding = None
+        for _ in xrange(docs):
+            item_id = uuid.uuid4().hex
+            self.item_ids.append(item_id)
+            self.change(item_id)
+
+    def next_date_modified(self):
+        # dateModified is unique and grows like in CDB
+        self.last_modified = max(datetime.now(TZ),
+                                 self.last_modified +
+                                 timedelta(microseconds=1))
+        return self.last_modified.isoformat()
+
+    def make_body(self, item_id, date_modified):
+        doc = {
+            'id': item_id,
+            'tenderID': 'UA-{}'.format(item_id[:10]),
+            'status': 'active.tendering',
+            'procurementMethodType': 'belowThreshold',
+            'title': 'Benchmark {}'.format(self.resource[:-1]),
+            'owner': 'benchmark',
+            'dateModified': date_modified,
+            'description': ''
+        }
+        if self.padding is None:
+            self.padding = max(self.doc_size - len(dumps(doc)), 0)
+        doc['description'] = 'x' * self.padding
+        return dumps(doc)
+
+    def change(self, item_id):
+        now = time()
+        date_modified = self.next_date_modified()
+        self.versions.setdefault(item_id, deque(maxlen=self.history)).append(
+            (now, date_modified, self.make_body(item_id, date_modified)))
+        self.changed[(item_id, date_modified)] = now
+        seq = self.item_seqs.get(item_id)
+        if seq is not None:
+            del self.seqs[bisect_left(self.seqs, seq)]
+            del self.seq_ids[seq]
+        self.seq += 1
+        self.seqs.append(self.seq)
+        self.seq_ids[self.seq] = item_id
+        self.item_seqs[item_id] = self.seq
+
+    def changer(self):
+        tick = 0.05
+        due = 0.0
+        while True:
+            sleep(tick)
+            due += self.change_rate * tick
+            while due >= 1:
+                self.change(random.choice(self.item_ids))
+                due -= 1
+
+    def delay(self):
+        if self.latency <= 0:
+            return 0
+        return random.lognormvariate(math.log(self.latency),
+                                     self.latency_sigma)
+
+    def visible(self, item_id, backend):
+        """Version of item replicated to backend by now"""
+        versions = self.versions.get(item_id, ())
+        if len(self.backends) > 1:
+            lag = self.replica_lag * self.backends.index(backend) /\
+                float(len(self.backends) - 1)
+        else:
+            lag = 0
+        replicated = time() - lag
+        for version in reversed(versions):
+            if version[0] <= replicated:
+                return version
+        return None
+
+    def feed(self, params):
+        self.requests['feed'] += 1
+        limit = int(params.get('limit', 100))
+        offset = params.get('offset')
+        offset = int(float(offset)) if offset else None
+        if params.get('descending') in ('1', 'True', 'true'):
+            end = bisect_left(self.seqs, offset) if offset else\
+                len(self.seqs)
+            page = self.seqs[max(end - limit, 0):end][::-1]
+            next_offset = page[-1] if page else offset or 0
+            prev_offset = page[0] if page else self.seq
+            if offset is None:
+                prev_offset = self.seq
+        else:
+            start = bisect_right(self.seqs, offset) if offset else 0
+            page = self.seqs[start:start + limit]
+            next_offset = page[-1] if page else offset or self.seq
+            prev_offset = offset or 0
+        items = []
+        for seq in page:
+            _, date_modified, body = self.versions[self.seq_ids[seq]][-1]
+            if params.get('opt_fields') == '_all_':
+                items.append(body)
+            else:
+                items.append(dumps({'id': self.seq_ids[seq],
+                                    'dateModified': date_modified}))
+        return '{{"data":[{}],"next_page":{},"prev_page":{}}}'.format(
+            ','.join(items), dumps({'offset': next_offset}),
+            dumps({'offset': prev_offset}))
+
+    def document(self, environ, start_response, item_id, backend, headers):
+        self.requests['document'] += 1
+        if random.random() < self.rate_429:
+            self.requests['throttled'] += 1
+            return respond(start_response, 429, {
+                'status': 'error', 'errors': [{'description': 'Too Many'}]
+            }, headers)
+        version = self.visible(item_id, backend)
+        if version is None or random.random() < self.rate_404:
+            self.requests['not_found'] += 1
+            return respond(start_response, 404, {
+                'status': 'error', 'errors': [{
+                    'location': 'url', 'name': '{}_id'.format(
+                        self.resource[:-1]),
+                    'description': 'Not Found'}]
+            }, headers)
+        _, date_modified, body = version
+        etag = '"{}"'.format(date_modified)
+        headers.append(('ETag', etag))
+        if environ.get('HTTP_IF_NONE_MATCH') == etag:
+            self.requests['not_modified'] += 1
+            start_response(STATUSES[304], headers)
+            return ['']
+        return respond(start_response, 200, '{"data":' + body + '}', headers)
+
+    def __call__(self, environ, start_response):
+        body = self.handle(environ, start_response)
+        # pywsgi sends body as is even to HEAD request
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else body
+
+    def handle(self, environ, start_response):
+        self.requests['total'] += 1
+        sleep(self.delay())
+        cookie = SimpleCookie(environ.get('HTTP_COOKIE', '')).get('SERVER_ID')
+        backend = cookie.value if cookie is not None else None
+        headers = []
+        if backend not in self.backends:
+            backend = random.choice(self.backends)
+            headers.append(('Set-Cookie',
+                            'SERVER_ID={}; Path=/'.format(backend)))
+        path = environ['PATH_INFO'].strip('/').split('/')
+        if len(path) == 3 and path[0] == 'api' and path[2] == 'spore':
+            self.requests['spore'] += 1
+            return respond(start_response, 200, {}, headers)
+        if len(path) < 3 or path[0] != 'api' or path[2] != self.resource:
+            return respond(start_response, 404, {'status': 'error'}, headers)
+        if len(path) == 3:
+            params = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+            return respond(start_response, 200, self.feed(params), headers)
+        if len(path) == 4:
+            return self.document(environ, start_response, path[3], backend,
+                                 headers)
+        # Historical endpoint isn't imitated
+        return respond(start_response, 404, {'status': 'error'}, headers)
+
+
+def request_key(method, path):
+    """Path with sorted query, so order of parameters doesn't matter"""
+    parts = urlsplit(path)
+    query = '&'.join(sorted(parts.query.split('&'))) if parts.query else ''
+    return method, parts.path + ('?' + query if query else '')
+
+
+class TrafficReplay(object):
+
+    """WSGI app serving upstream traffic written by TrafficRecorder
+
+    Responses are looked up by request method and path. With positive
+    ``speed`` replay clock runs ``speed`` times faster than recording and
+    starts at the first request, every request gets the latest response
+    recorded by now on replay clock (or the earliest one) after recorded
+    latency divided by ``speed``. With zero ``speed`` there are no delays
+    and responses for the same request are handed out in recorded order,
+    the last one is repeated. Conditional requests are answered 304 with
+    recorded ETag.
+
+    Has the interface of FakeUpstream for BridgeBenchmark, items of
+    recorded feed pages are ``item_ids`` and ``changed`` maps (id,
+    dateModified) to time it was served first.
+    """
+
+    def __init__(self, directory, resource=None, speed=1):
+        self.speed = speed
+        self.responses = defaultdict(list)  # request key -> records
+        self.times = {}  # request key -> record times, ascending
+        self.cursors = Counter()
+        self.changed = {}
+        self.requests = Counter()
+        self.started = None
+        self.first_time = None
+        self.resource = resource
+        item_ids = OrderedDict()
+        for record in read_records(directory):
+            path = urlsplit(record['path']).path.strip('/').split('/')
+            if len(path) < 3 or path[0] != 'api':
+                continue
+            if self.resource is None:
+                self.resource = path[2]
+            if path[2] != self.resource:
+                continue
+            if record['status'] == 304:
+                # Replay answers conditional requests itself
+                continue
+            key = request_key(record['method'], record['path'])
+            self.responses[key].append(record)
+            if self.first_time is None or record['time'] < self.first_time:
+                self.first_time = record['time']
+            if len(path) == 3 and record['status'] == 200:
+                for item in self.response_items(record):
+                    item_ids[item['id']] = True
+        for records in self.responses.values():
+            records.sort(key=lambda record: record['time'])
+        self.times = dict((key, [record['time'] for record in records])
+                          for key, records in self.responses.items())
+        self.item_ids = list(item_ids)
+        logger.info('Loaded {} recorded responses of {} requests'.format(
+            sum(len(records) for records in self.responses.values()),
+            len(self.responses)))
+
+    def response_items(self, record):
+        """Items of feed page or document of response"""
+        try:
+            data = loads(record['body']).get('data')
+        except (ValueError, AttributeError):
+            return []
+        if not isinstance(data, list):
+            data = [data]
+        return [item for item in data
+                if isinstance(item, dict) and 'dateModified' in item]
+
+    def changer(self):
+        # Changes come from recording, replay clock starts on first request
+        pass
+
+    def select(self, key):
+        records = self.responses.get(key)
+        if not records:
+            return None
+        if self.speed <= 0:
+            record = records[min(self.cursors[key], len(records) - 1)]
+            self.cursors[key] += 1
+            return record
+        clock = self.first_time + (time() - self.started) * self.speed
+        return records[max(bisect_right(self.times[key], clock) - 1, 0)]
+
+    def __call__(self, environ, start_response):
+        body = self.handle(environ, start_response)
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else body
+
+    def handle(self, environ, start_response):
+        if self.started is None:
+            self.started = time()
+        self.requests['total'] += 1
+        path = environ['PATH_INFO']
+        if environ.get('QUERY_STRING'):
+            path += '?' + environ['QUERY_STRING']
+        method = environ['REQUEST_METHOD']
+        record = self.select(request_key(method, path))
+        if record is None and method == 'HEAD':
+            record = self.select(request_key('GET', path))
+        segments = environ['PATH_INFO'].strip('/').split('/')
+        is_feed = len(segments) == 3 and segments[2] == self.resource
+        if is_feed:
+            self.requests['feed'] += 1
+        elif len(segments) == 4 and segments[2] == self.resource:
+            self.requests['document'] += 1
+        if record is None and segments[-1] == 'spore':
+            # Clients request spore before recorder is attached to them
+            return respond(start_response, 200, {})
+        if record is None:
+            self.requests['not_recorded'] += 1
+            return respond(start_response, 404, {
+                'status': 'error', 'errors': [{
+                    'location': 'url', 'name': 'path',
+                    'description': 'Not recorded'}]})
+        if self.speed > 0:
+            sleep(record['elapsed'] / self.speed)
+        status = record['status']
+        headers = [(str(name), str(value))
+                   for name, value in record['headers'].items()]
+        if status == 429:
+            self.requests['throttled'] += 1
+        elif status == 404:
+            self.requests['not_found'] += 1
+        elif status == 200:
+            now = time()
+            for item in self.response_items(record):
+                self.changed.setdefault((item['id'], item['dateModified']),
+                                        now)
+            etag = record['headers'].get('ETag')
+            if etag is not None and\
+                    environ.get('HTTP_IF_NONE_MATCH') == etag:
+                self.requests['not_modified'] += 1
+                start_response(STATUSES[304], headers)
+                return ['']
+        start_response(STATUSES.get(status, '{} Recorded'.format(status)),
+                       headers)
+        return [record['body'].encode('utf-8')]
+
+
+class MemoryDatabase(object):
+
+    def __init__(self):
+        self.docs = {}
+        self.changes = OrderedDict()  # id -> seq of last change
+        self.seq = 0
+
+    def validate(self, doc, current):
+        # validate_doc_update installed by prepare_couchdb
+        if current is None or VALIDATE_BULK_DOCS_ID not in self.docs:
+            return True
+        date_modified = doc.get('dateModified')
+        current_date_modified = current.get('dateModified')
+        return date_modified is None or current_date_modified is None or\
+            date_modified > current_date_modified
+
+    def save(self, doc):
+        """Return (True, id, rev) or (False, id, (error, reason))"""
+        doc_id = doc.get('_id') or uuid.uuid4().hex
+        current = self.docs.get(doc_id)
+        current_rev = current['_rev'] if current is not None else None
+        if doc.get('_rev') != current_rev:
+            return False, doc_id, ('conflict', 'Document update conflict.')
+        if not self.validate(doc, current):
+            return False, doc_id, ('forbidden',
+                                   'New doc with oldest dateModified.')
+        number = int(current_rev.split('-')[0]) + 1 if current_rev else 1
+        doc = dict(doc, _id=doc_id,
+                   _rev='{}-{}'.format(number, uuid.uuid4().hex))
+        self.docs[doc_id] = doc
+        if not doc_id.startswith('_local/'):
+            self.seq += 1
+            self.changes.pop(doc_id, None)
+            self.changes[doc_id] = self.seq
+        return True, doc_id, doc['_rev']
+
+    def rows(self, ids, include_docs=False):
+        rows = []
+        for doc_id in ids:
+            doc = self.docs.get(doc_id)
+            if doc is None:
+                rows.append({'key': doc_id, 'error': 'not_found'})
+                continue
+            row = {'id': doc_id, 'key': doc_id,
+                   'value': {'rev': doc['_rev']}}
+            if include_docs:
+                row['doc'] = doc
+            rows.append(row)
+        return rows
+
+    def changes_since(self, since, limit=None):
+        ids = []
+        for doc_id in reversed(self.changes):
+            if self.changes[doc_id] <= since:
+                break
+            ids.append(doc_id)
+        ids.reverse()
+        return ids[:limit] if limit else ids
+
+
+class MemoryCouchDB(object):
+
+    """WSGI app answering the part of CouchDB API used by the bridge
+
+    Databases live in memory, ``validate_doc_update`` of the bridge is
+    imitated when its design document is saved, views aren't run but
+    ``by_dateModified`` views of resources are emulated. Stand-in is fast
+    and never fails, so benchmark results show the cost of the bridge
+    itself rather than of CouchDB.
+    """
+
+    def __init__(self):
+        self.dbs = {}
+
+    def view(self, db, design, params):
+        resource_type = design[:-1].title()
+        rows = sorted(
+            ({'id': doc['_id'], 'key': doc['dateModified'], 'value': {}}
+             for doc in db.docs.values()
+             if doc.get('doc_type') == resource_type and
+             'dateModified' in doc),
+            key=lambda row: (row['key'], row['id']))
+        return self.page(rows, params, db)
+
+    def page(self, rows, params, db):
+        if 'startkey' in params:
+            start = (loads(params['startkey']),
+                     params.get('startkey_docid', ''))
+            rows = [row for row in rows if (row['key'], row['id']) >= start]
+        skip = int(params.get('skip', 0))
+        limit = int(params['limit']) if 'limit' in params else None
+        total_rows = len(rows)
+        rows = rows[skip:skip + limit if limit is not None else None]
+        if params.get('include_docs') == 'true':
+            for row in rows:
+                row['doc'] = db.docs.get(row['id'])
+        return {'total_rows': total_rows, 'offset': skip, 'rows': rows}
+
+    def all_docs(self, db, params, keys=None):
+        include_docs = params.get('include_docs') == 'true'
+        if keys is None and 'keys' in params:
+            keys = loads(params['keys'])
+        if keys is not None:
+            return {'total_rows': len(db.docs), 'offset': 0,
+                    'rows': db.rows(keys, include_docs)}
+        ids = sorted(doc_id for doc_id in db.docs
+                     if not doc_id.startswith('_local/'))
+        return self.page(db.rows(ids), params, db)
+
+    def bulk_docs(self, db, body):
+        results = []
+        for doc in loads(body)['docs']:
+            success, doc_id, rev_or_error = db.save(doc)
+            if success:
+                results.append({'id': doc_id, 'rev': rev_or_error})
+            else:
+                results.append({'id': doc_id, 'error': rev_or_error[0],
+                                'reason': rev_or_error[1]})
+        return results
+
+    def changes(self, db, params):
+        since = int(params.get('since', 0) or 0)
+        limit = int(params['limit']) if 'limit' in params else None
+        results = []
+        for doc_id in db.changes_since(since, limit):
+            doc = db.docs[doc_id]
+            result = {'seq': db.changes[doc_id], 'id': doc_id,
+                      'changes': [{'rev': doc['_rev']}]}
+            if params.get('include_docs') == 'true':
+                result['doc'] = doc
+            results.append(result)
+        last_seq = results[-1]['seq'] if results else max(since, 0)
+        return {'results': results, 'last_seq': last_seq}
+
+    def document(self, environ, start_response, db, doc_id):
+        method = environ['REQUEST_METHOD']
+        if method in ('GET', 'HEAD'):
+            doc = db.docs.get(doc_id)
+            if doc is None:
+                return respond(start_response, 404, {'error': 'not_found',
+                                                     'reason': 'missing'})
+            return respond(start_response, 200, doc)
+        doc = loads(read_body(environ))
+        doc['_id'] = doc_id
+        success, doc_id, rev_or_error = db.save(doc)
+        if not success:
+            return respond(start_response, 409, {
+                'error': rev_or_error[0], 'reason': rev_or_error[1]})
+        return respond(start_response, 201, {'ok': True, 'id': doc_id,
+                                             'rev': rev_or_error})
+
+    def __call__(self, environ, start_response):
+        body = self.handle(environ, start_response)
+        return [] if environ['REQUEST_METHOD'] == 'HEAD' else body
+
+    def handle(self, environ, start_response):
+        method = environ['REQUEST_METHOD']
+        path = [segment for segment in
+                environ['PATH_INFO'].split('/') if segment]
+        params = dict(parse_qsl(environ.get('QUERY_STRING', '')))
+        if not path:
+            return respond(start_response, 200, {'couchdb': 'Welcome',
+                                                 'version': '1.6.1'})
+        if path[0] == '_active_tasks':
+            return respond(start_response, 200, [])
+        if path[0] == '_all_dbs':
+            return respond(start_response, 200, sorted(self.dbs))
+        db = self.dbs.get(path[0])
+        if len(path) == 1:
+            if method == 'PUT':
+                if db is not None:
+                    return respond(start_response, 412, {
+                        'error': 'file_exists',
+                        'reason': 'The database could not be created.'})
+                self.dbs[path[0]] = MemoryDatabase()
+                return respond(start_response, 201, {'ok': True})
+            if method == 'DELETE' and db is not None:
+                del self.dbs[path[0]]
+                return respond(start_response, 200, {'ok': True})
+            if db is None:
+                return respond(start_response, 404, {
+                    'error': 'not_found', 'reason': 'no_db_file'})
+            if method == 'POST':
+                return self.document(environ, start_response, db,
+                                     uuid.uuid4().hex)
+            return respond(start_response, 200, {
+                'db_name': path[0], 'doc_count': len(db.docs),
+                'update_seq': db.seq})
+        if db is None:
+            return respond(start_response, 404, {'error': 'not_found',
+                                                 'reason': 'no_db_file'})
+        if path[1] == '_all_docs':
+            keys = loads(read_body(environ))['keys']\
+                if method == 'POST' else None
+            return respond(start_response, 200,
+                           self.all_docs(db, params, keys))
+        if path[1] == '_bulk_docs':
+            return respond(start_response, 201,
+                           self.bulk_docs(db, read_body(environ)))
+        if path[1] == '_changes':
+            return respond(start_response, 200, self.changes(db, params))
+        if path[1] == '_ensure_full_commit':
+            return respond(start_response, 201, {'ok': True})
+        if path[1] in ('_design', '_local') and len(path) > 2:
+            if len(path) == 5 and path[3] == '_view':
+                return respond(start_response, 200,
+                               self.view(db, path[2], params))
+            if len(path) > 3 and method == 'PUT':
+                # Attachment of design document, content isn't needed
+                doc = db.docs.get('/'.join(path[1:3]))
+                return respond(start_response, 201, {
+                    'ok': True, 'id': '/'.join(path[1:3]),
+                    'rev': doc['_rev'] if doc else '1-0'})
+            return self.document(environ, start_response, db,
+                                 '/'.join(path[1:3]))
+        return self.document(environ, start_response, db, path[1])
+
+
+class BridgeBenchmark(object):
+
+    """Runs EdgeDataBridge against fake upstream for ``duration`` seconds
+
+    Saved documents are collected from ``_changes`` of database every
+    ``sample_interval`` seconds, so freshness lag (time from change in
+    upstream till it is seen in local database) is measured with that
+    resolution. Without ``couch_url`` in-memory stand-in is used, otherwise
+    a new database is created in given CouchDB and deleted afterwards.
+    Fake servers run in the same process, so RSS growth is reported besides
+    RSS itself.
+    """
+
+    def __init__(self, upstream, couch_url=None, options=None, duration=60,
+                 sample_interval=0.1, keep_db=False):
+        self.upstream = upstream
+        self.couch_url = couch_url
+        self.options = options or {}
+        self.duration = duration
+        self.sample_interval = sample_interval
+        self.keep_db = keep_db
+        self.db_name = 'edge_benchmark_{}'.format(uuid.uuid4().hex[:8])
+        self.process = psutil.Process(os.getpid())
+        self.resource_type = upstream.resource[:-1].title()
+        self.since = 0
+        self.docs_saved = 0
+        self.synced = set()
+        self.initial_sync = None
+        self.lags = []
+        self.started = None
+        self.servers = []
+
+    def serve(self, app):
+        server = WSGIServer(('127.0.0.1', 0), app, log=None)
+        server.start()
+        self.servers.append(server)
+        return 'http://127.0.0.1:{}'.format(server.server_port)
+
+    def bridge_config(self, api_url):
+        main = dict(BRIDGE_OPTIONS)
+        main.update(self.options)
+        main.update({
+            'resource': self.upstream.resource,
+            'resources_api_server': api_url,
+            'couch_url': self.couch_url,
+            'db_name': self.db_name
+        })
+        return {'main': main, 'version': 1}
+
+    def collect(self):
+        while True:
+            changes = self.db.changes(since=self.since, include_docs=True,
+                                      limit=1000)
+            now = time()
+            for change in changes['results']:
+                doc = change.get('doc') or {}
+                if doc.get('doc_type') != self.resource_type:
+                    continue
+                self.docs_saved += 1
+                if self.initial_sync is None:
+                    self.synced.add(doc['id'])
+                changed = self.upstream.changed.get(
+                    (doc['id'], doc['dateModified']))
+                if changed is not None and changed >= self.started:
+                    self.lags.append(now - changed)
+            if (self.initial_sync is None and
+                    len(self.synced) >= len(self.upstream.item_ids)):
+                self.initial_sync = now - self.started
+                self.synced = set()
+            self.since = changes['last_seq']
+            if len(changes['results']) < 1000:
+                return
+
+    def watch(self, bridge):
+        while True:
+            bridge.gevent_watcher()
+            sleep(bridge.watch_interval)
+
+    def run(self):
+        api_url = self.serve(self.upstream)
+        if self.couch_url is None:
+            self.couch_url = self.serve(MemoryCouchDB())
+        server = Server(self.couch_url)
+        bridge = EdgeDataBridge(self.bridge_config(api_url))
+        self.db = server[self.db_name]
+        rss_start = rss_peak = self.process.memory_info().rss
+        self.started = time()
+        requests_start = self.upstream.requests.copy()
+        changes_start = len(self.upstream.changed)
+        changer = spawn(self.upstream.changer)
+        bridge.start()
+        bridge.serve_metrics()
+        watcher = spawn(self.watch, bridge)
+        try:
+            while time() - self.started < self.duration:
+                sleep(self.sample_interval)
+                self.collect()
+                rss_peak = max(rss_peak, self.process.memory_info().rss)
+            duration = time() - self.started
+            changer.kill()
+            watcher.kill()
+            bridge.drain()
+        finally:
+            if not self.keep_db:
+                del server[self.db_name]
+            for api_server in self.servers:
+                api_server.stop()
+        requests = self.upstream.requests - requests_start
+        lags = sorted(self.lags)
+        mb = 1024.0 * 1024
+        return {
+            'duration': round(duration, 1),
+            'docs_saved': self.docs_saved,
+            'docs_per_sec': round(self.docs_saved / duration, 1),
+            'initial_sync_sec': round(self.initial_sync, 1)
+            if self.initial_sync is not None else None,
+            'changes_made': len(self.upstream.changed) - changes_start,
+            'changes_saved': len(lags),
+            'lag_p50': round(percentile(lags, 50), 3),
+            'lag_p95': round(percentile(lags, 95), 3),
+            'lag_p99': round(percentile(lags, 99), 3),
+            'lag_max': round(lags[-1], 3) if lags else 0,
+            'upstream_requests': requests['total'],
+            'document_requests': requests['document'],
+            'feed_requests': requests['feed'],
+            'throttled': requests['throttled'],
+            'not_found': requests['not_found'],
+            'not_modified': requests['not_modified'],
+            'not_recorded': requests['not_recorded'],
+            'requests_per_saved_doc': round(
+                requests['total'] / float(self.docs_saved), 2)
+            if self.docs_saved else None,
+            'rss_start_mb': round(rss_start / mb, 1),
+            'rss_peak_mb': round(rss_peak / mb, 1),
+            'rss_growth_mb': round((rss_peak - rss_start) / mb, 1)
+        }
+
+
+def deep_size(resource_item):
+    return sys.getsizeof(resource_item) + sum(
+        sys.getsizeof(value) for _, value in resource_item.items())
+
+
+def dict_item(feed_line):
+    feed_item = loads(feed_line)
+    return {'id': feed_item['id'], 'dateModified': feed_item['dateModified']}
+
+
+def dict_retry_item(resource_item):
+    return {'id': resource_item['id'],
+            'dateModified': resource_item['dateModified']}
+
+
+def queue_item(feed_line):
+    feed_item = loads(feed_line)
+    return QueueItem(feed_item['id'], feed_item['dateModified'])
+
+
+def measure_queue_items(make_item, retry_item, feed_lines, process):
+    """Bytes, RSS and time per item of queue items made from feed lines"""
+    gc.collect()
+    rss_start = process.memory_info().rss
+    started = time()
+    held = [make_item(feed_line) for feed_line in feed_lines]
+    duration = time() - started
+    rss_growth = process.memory_info().rss - rss_start
+    started = time()
+    for resource_item in held:
+        retry_delay(retry_item(resource_item), RETRY_CONFIG)
+    retry_duration = time() - started
+    size = deep_size(held[0])
+    del held
+    gc.collect()
+    return (size, rss_growth / float(1024 * 1024),
+            duration * 1e6 / len(feed_lines),
+            retry_duration * 1e6 / len(feed_lines))
+
+
+def queue_items_benchmark(count):
+    """Footprint of dict and QueueItem items holding ``count`` feed items
+
+    Items are made from parsed feed lines, as the bridge makes them, so
+    dict items keep unicode strings of parsed JSON. Retry path makes new
+    item of every queued one and updates its retry state.
+    """
+    now = datetime.now(TZ)
+    feed_lines = [dumps({'id': uuid.uuid4().hex,
+                         'dateModified': (now + timedelta(
+                             microseconds=i)).isoformat()})
+                  for i in xrange(count)]
+    process = psutil.Process(os.getpid())
+    # Memory freed by the first run may be reused by the second one, so
+    # compact items go first
+    queue_item_result = measure_queue_items(queue_item, QueueItem.for_retry,
+                                            feed_lines, process)
+    dict_result = measure_queue_items(dict_item, dict_retry_item,
+                                      feed_lines, process)
+    report = {'items': count}
+    for name, result in (('dict', dict_result),
+                         ('queue_item', queue_item_result)):
+        size, rss, usec, retry_usec = result
+        report.update({
+            name + '_bytes': size,
+            name + '_rss_mb': round(rss, 1),
+            name + '_usec': round(usec, 2),
+            name + '_retry_usec': round(retry_usec, 2)
+        })
+    return report
+
+
+def log_events_benchmark(make_upstream, couch_url=None, options=None,
+                         duration=60, sample_rate=0.01,
+                         level=logging.DEBUG):
+    """Bridge throughput with every event logged and with events sampled
+
+    Bridge runs twice against new upstream made by ``make_upstream``, with
+    pipeline loggers at the same ``level``: first every event is emitted,
+    then DEBUG events are sampled at ``sample_rate``. Records are formatted
+    and written to /dev/null, as a handler writing to file would do.
+    """
+    edge_logger = logging.getLogger('openprocurement.edge')
+    saved = edge_logger.level, edge_logger.propagate
+    stream = open(os.devnull, 'w')
+    handler = logging.StreamHandler(stream)
+    handler.setFormatter(logging.Formatter(
+        '%(asctime)s - %(name)s - %(levelname)s - %(message)s'))
+    edge_logger.addHandler(handler)
+    edge_logger.setLevel(level)
+    edge_logger.propagate = False
+    report = {'log_level': logging.getLevelName(level),
+              'log_sample_rate': sample_rate}
+    try:
+        for name, log_sample_rate in (('unsampled', 1),
+                                      ('sampled', sample_rate)):
+            run_options = dict(options or {})
+            run_options['log_sample_rate'] = log_sample_rate
+            result = BridgeBenchmark(make_upstream(), couch_url, run_options,
+                                     duration).run()
+            report['duration'] = result['duration']
+            for field in ('docs_saved', 'docs_per_sec', 'lag_p95',
+                          'upstream_requests'):
+                report['{}_{}'.format(name, field)] = result[field]
+    finally:
+        edge_logger.removeHandler(handler)
+        edge_logger.setLevel(saved[0])
+        edge_logger.propagate = saved[1]
+        stream.close()
+    return report
+
+
+def load_config(params):
+    config = {}
+    if params.config:
+        with open(params.config) as config_file_obj:
+            config = load(config_file_obj.read())
+    return config
+
+
+def make_upstream(params):
+    if params.replay:
+        return TrafficReplay(params.replay, params.resource, params.speed)
+    return FakeUpstream(
+        resource=params.resource or 'tenders', docs=params.docs,
+        doc_size=params.doc_size,
+        change_rate=params.change_rate, latency=params.latency,
+        latency_sigma=params.latency_sigma, rate_429=params.rate_429,
+        rate_404=params.rate_404, backends=params.backends,
+        replica_lag=params.replica_lag)
+
+
+def run_bridge_benchmark(params):
+    config = load_config(params)
+    if config.get('version'):
+        logging.config.dictConfig(config)
+    else:
+        logging.basicConfig(level=logging.WARNING)
+    return BridgeBenchmark(make_upstream(params), params.couch_url,
+                           config.get('main'), params.duration,
+                           keep_db=params.keep_db).run()
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='---- Edge Bridge Benchmark ----')
+    parser.add_argument('--config', type=str, default=None,
+                        help='Bridge configuration file, options of its '
+                             '\'main\' section override defaults')
+    parser.add_argument('--resource', type=str, default=None,
+                        help='Resource to sync (default: tenders or the '
+                             'first recorded one)')
+    parser.add_argument('--replay', type=str, default=None,
+                        help='Directory with recorded upstream traffic to '
+                             'replay instead of synthetic upstream')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='Replay speed, 0 for maximum')
+    parser.add_argument('--docs', type=int, default=1000,
+                        help='Number of resource items in upstream')
+    parser.add_argument('--doc-size', type=int, default=4096,
+                        help='Size of resource item in bytes')
+    parser.add_argument('--change-rate', type=float, default=10,
+                        help='Changes of resource items per second')
+    parser.add_argument('--latency', type=float, default=0.05,
+                        help='Median upstream latency in seconds')
+    parser.add_argument('--latency-sigma', type=float, default=0.5,
+                        help='Sigma of lognormal upstream latency')
+    parser.add_argument('--rate-429', type=float, default=0,
+                        help='Share of document requests answered 429')
+    parser.add_argument('--rate-404', type=float, default=0,
+                        help='Share of document requests answered 404')
+    parser.add_argument('--backends', type=int, default=1,
+                        help='Number of upstream backends')
+    parser.add_argument('--replica-lag', type=float, default=0,
+                        help='Replication lag of the slowest backend')
+    parser.add_argument('--duration', type=float, default=60,
+                        help='Duration of benchmark in seconds')
+    parser.add_argument('--couch-url', type=str, default=None,
+                        help='CouchDB to use instead of in-memory stand-in')
+    parser.add_argument('--keep-db', action='store_true',
+                        help='Don\'t delete benchmark database')
+    parser.add_argument('--json', action='store_true',
+                        help='Print report as JSON')
+    parser.add_argument('--queue-items', type=int, default=None,
+                        help='Measure memory and time per queue item on '
+                             'this number of items instead of running '
+                             'bridge')
+    parser.add_argument('--log-events', action='store_true',
+                        help='Run bridge with every event logged and with '
+                             'sampled events at the same level and compare '
+                             'throughput')
+    parser.add_argument('--log-level', type=str, default='DEBUG',
+                        help='Level of pipeline loggers for --log-events')
+    parser.add_argument('--log-sample-rate', type=float, default=0.01,
+                        help='Share of DEBUG events kept in sampled run of '
+                             '--log-events')
+    params = parser.parse_args()
+    if params.log_events:
+        logging.basicConfig(level=logging.WARNING)
+        report = log_events_benchmark(
+            lambda: make_upstream(params), params.couch_url,
+            load_config(params).get('main'), params.duration,
+            params.log_sample_rate, getattr(logging, params.log_level.upper()))
+        report_fields = LOG_EVENTS_REPORT_FIELDS
+    elif params.queue_items:
+        report = queue_items_benchmark(params.queue_items)
+        report_fields = QUEUE_ITEMS_REPORT_FIELDS
+    else:
+        report = run_bridge_benchmark(params)
+        report_fields = REPORT_FIELDS
+    if params.json:
+        print(dumps(report, indent=2, sort_keys=True))
+    else:
+        for field in report_fields:
+            print('{:<24} {}'.format(field, report[field]))
+
+
+##############################################################
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+from collections import deque
+from gevent.event import Event
+from gevent.queue import Empty
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class APIClientsPool(object):
+
+    """Idle API clients grouped by upstream backend they are pinned to
+
+    Upstream balancer pins client to backend with sticky ``cookie_name``
+    cookie, backend of client is read from its session every time it is
+    put back. ``get`` hands out idle client of backend with the fewest
+    clients in flight. Client put back to backend holding more than its
+    share of clients gets its cookies cleared, so balancer pins it anew
+    and clients end up spread evenly over backends seen within last
+    ``backend_ttl`` seconds.
+
+    Newest ``dateModified`` served by every backend is kept, backend that
+    served document modified at some time has replicated changes up to it,
+    so ``get_fresher`` can pick client of backend which already has the
+    document other backend returned not actual.
+
+    Has ``get``/``put``/``qsize``/``empty`` of ``gevent.queue.Queue``.
+    """
+
+    def __init__(self, cookie_name='SERVER_ID', backend_ttl=300):
+        self.cookie_name = cookie_name
+        self.backend_ttl = backend_ttl
+        self.idle = {}  # backend -> deque of idle client dicts
+        self.pinned = {}  # client id -> backend
+        self.seen_at = {}  # backend -> time client was put back from it
+        self.fresh = {}  # backend -> newest dateModified served
+        self.not_empty = Event()
+
+    def backend(self, api_client_dict):
+        return api_client_dict['client'].session.cookies.get(
+            self.cookie_name)
+
+    def backends(self):
+        """Backends clients were pinned to recently"""
+        oldest = time() - self.backend_ttl
+        return [backend for backend, seen_at in self.seen_at.items()
+                if seen_at >= oldest]
+
+    def clients_count(self, backend):
+        return sum(1 for pinned in self.pinned.values() if pinned == backend)
+
+    def qsize(self):
+        return sum(len(clients) for clients in self.idle.values())
+
+    def empty(self):
+        return not any(self.idle.values())
+
+    def _overloaded(self, backend):
+        backends = self.backends()
+        if backend is None or len(backends) < 2:
+            return False
+        share = -(-len(self.pinned) // len(backends))  # ceil
+        return self.clients_count(backend) > share
+
+    def put(self, api_client_dict, block=True, timeout=None):
+        backend = self.backend(api_client_dict)
+        if backend is not None:
+            self.seen_at[backend] = time()
+            self.pinned[api_client_dict['id']] = backend
+            if self._overloaded(backend):
+                api_client_dict['client'].session.cookies.clear()
+                logger.debug('Re-pin api_client {} from backend {}'.format(
+                    api_client_dict['id'], backend),
+                    extra={'MESSAGE_ID': 'repin_client'})
+                backend = None
+        if backend is None:
+            self.pinned[api_client_dict['id']] = None
+        self.idle.setdefault(backend, deque()).append(api_client_dict)
+        self.not_empty.set()
+
+    def put_nowait(self, api_client_dict):
+        self.put(api_client_dict, block=False)
+
+    def _pop(self, backends):
+        # Backend with the fewest clients in flight
+        backend = min(backends, key=lambda b: (
+            self.clients_count(b) - len(self.idle[b]), -len(self.idle[b])))
+        return self.idle[backend].popleft()
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while self.empty():
+            if not block:
+                raise Empty
+            self.not_empty.clear()
+            wait = None if deadline is None else max(deadline - time(), 0)
+            if not self.not_empty.wait(wait) and deadline is not None:
+                raise Empty
+        return self._pop([b for b, clients in self.idle.items() if clients])
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def get_fresher(self, date_modified, exclude=()):
+        """Idle client of other backend that served ``date_modified``
+
+        Returns None when there is no such client.
+        """
+        backends = [b for b, clients in self.idle.items()
+                    if clients and b is not None and b not in exclude and
+                    self.fresh.get(b, '') >= date_modified]
+        if not backends:
+            return None
+        return self._pop(backends)
+
+    def seen(self, api_client_dict, date_modified):
+        """Record document served by backend of client"""
+        backend = self.backend(api_client_dict)
+        if backend is not None and\
+                date_modified > self.fresh.get(backend, ''):
+            self.fresh[backend] = date_modified
+
+    def remove(self, api_client_dict):
+        """Forget client taken from pool for good"""
+        self.pinned.pop(api_client_dict['id'], None)
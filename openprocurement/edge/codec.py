@@ -0,0 +1,148 @@
+# -*- coding: utf-8 -*-
+import logging
+import sys
+from gevent.queue import Queue
+from gevent.subprocess import Popen, PIPE
+from json import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Fields of large document decoded in main process
+SUMMARY_FIELDS = ('id', 'dateModified')
+# Fields set by bridge, never taken from upstream document
+SERVICE_FIELDS = ('_id', '_rev', 'doc_type')
+
+
+class EncodedDocument(dict):
+
+    """Summary of document decoded out of process
+
+    Only ``SUMMARY_FIELDS`` are decoded, ``body`` is the whole document JSON
+    encoded by codec process. Fields set later on the dict (``_id``,
+    ``_rev``, ``doc_type``) are spliced into body by ``encode_document``.
+    """
+
+    def __init__(self, summary, body):
+        super(EncodedDocument, self).__init__(summary)
+        self.body = body
+
+
+def encode_document(resource_item):
+    """JSON for ``_bulk_docs``, large documents are not encoded again"""
+    if not isinstance(resource_item, EncodedDocument):
+        return dumps(resource_item)
+    service = dict((key, value) for key, value in resource_item.items()
+                   if key in SERVICE_FIELDS)
+    if not service:
+        return resource_item.body
+    service = dumps(service)
+    if resource_item.body == '{}':
+        return service
+    return service[:-1] + ',' + resource_item.body[1:]
+
+
+class CodecProcess(object):
+
+    """Child process decoding and encoding documents for one caller a time
+
+    Request is ``<length>\\n`` line followed by API response body, reply is
+    JSON ``[summary, length, error]`` line followed by encoded document.
+    Pipes are gevent cooperative, so waiting for reply doesn't block hub.
+    """
+
+    def __init__(self):
+        self.process = None
+        self.start()
+
+    def start(self):
+        self.process = Popen([sys.executable, '-m',
+                              'openprocurement.edge.codec'],
+                             stdin=PIPE, stdout=PIPE, close_fds=True)
+        logger.info('Started codec process with pid {}'.format(
+            self.process.pid), extra={'MESSAGE_ID': 'codec_process_start'})
+
+    def restart(self):
+        if self.process.poll() is None:
+            self.process.kill()
+            self.process.wait()
+        self.start()
+
+    def decode(self, content):
+        self.process.stdin.write('{}\n'.format(len(content)))
+        self.process.stdin.write(content)
+        self.process.stdin.flush()
+        line = self.process.stdout.readline()
+        if not line:
+            raise IOError('Codec process exited with code {}'.format(
+                self.process.poll()))
+        summary, length, error = loads(line)
+        if error is not None:
+            raise ValueError(error)
+        return EncodedDocument(summary, self.process.stdout.read(length))
+
+    def close(self):
+        self.process.stdin.close()
+        self.process.wait()
+
+
+class DocumentCodec(object):
+
+    """Decodes API responses, large ones in pool of codec processes
+
+    Responses smaller than ``threshold`` bytes are decoded in place, larger
+    ones are sent to one of ``processes`` codec processes, which decode and
+    encode them again for ``_bulk_docs``. Other greenlets keep running while
+    large document is processed.
+    """
+
+    def __init__(self, threshold, processes):
+        self.threshold = threshold
+        self.processes = Queue()
+        for _ in xrange(processes):
+            self.processes.put(CodecProcess())
+
+    def loads(self, content):
+        """Document from API response body"""
+        if len(content) < self.threshold:
+            return loads(content)['data']
+        return self.decode(content)
+
+    def decode(self, content):
+        process = self.processes.get()
+        try:
+            return process.decode(content)
+        except (IOError, OSError) as e:
+            logger.error('Codec process error: {}'.format(repr(e)),
+                         extra={'MESSAGE_ID': 'exceptions'})
+            process.restart()
+            raise
+        finally:
+            self.processes.put(process)
+
+    def close(self):
+        while not self.processes.empty():
+            self.processes.get().close()
+
+
+def serve(stdin, stdout):
+    while True:
+        line = stdin.readline()
+        if not line:
+            break
+        content = stdin.read(int(line))
+        try:
+            resource_item = loads(content)['data']
+            for key in SERVICE_FIELDS:
+                resource_item.pop(key, None)
+            body = dumps(resource_item)
+            summary = dict((key, resource_item[key]) for key in SUMMARY_FIELDS
+                           if key in resource_item)
+            stdout.write(dumps([summary, len(body), None]) + '\n')
+            stdout.write(body)
+        except Exception as e:
+            stdout.write(dumps([None, 0, repr(e)]) + '\n')
+        stdout.flush()
+
+
+if __name__ == '__main__':
+    serve(sys.stdin, sys.stdout)
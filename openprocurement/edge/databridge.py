@@ -2,18 +2,17 @@
 from gevent import monkey
 monkey.patch_all()
 
-import math
 import logging
 import logging.config
 import os
 import psutil
 import argparse
+import sys
 import uuid
+from time import time
 from couchdb import Server, Session
-from httplib import IncompleteRead
 from yaml import load
 from urlparse import urlparse
-from openprocurement_client.sync import ResourceFeeder
 from openprocurement_client.exceptions import RequestFailed
 from openprocurement_client.client import TendersClient as APIClient
 from openprocurement.edge.utils import (
@@ -22,11 +21,33 @@ from openprocurement.edge.utils import (
     DataBridgeConfigError
 )
 import gevent.pool
+import signal
 from gevent import spawn, sleep
+from gevent.event import Event
 from gevent.queue import Queue, Empty
-from datetime import datetime, timedelta
+from gevent.subprocess import Popen, PIPE
+from datetime import datetime
+from json import dumps
+from .autoscaler import WorkersAutoscaler
+from .clients import APIClientsPool
+from .codec import DocumentCodec
+from .events import EventLog, EventSampler
+from .feeder import ResourceFeeder, ShardFeeder, shard_for
+from .history import RevisionsCache
+from .index import ResourceItemsIndex
+from .items import QueueItem
+from .journal import Journal, UnsavedItems
+from .latency import LatencyStats, percentile
+from .metrics import MetricsRegistry, PipelineMetrics
+from .queues import CoalescingQueue
+from .ratelimit import RateLimiter, retry_after
+from .recorder import TrafficRecorder
+from .retry import RetryScheduler, retry_delay
+from .spill import SpillQueue
+from .trace import PipelineTracer
+from .validators import Validators
 from .workers import ResourceItemWorker
-from time import time
+from .writer import BulkWriter
 
 try:
     import urllib3.contrib.pyopenssl
@@ -41,20 +62,23 @@ WORKER_CONFIG = {
     'client_inc_step_timeout': 0.1,
     'client_dec_step_timeout': 0.02,
     'drop_threshold_client_cookies': 2,
-    'worker_sleep': 5,
     'retry_default_timeout': 3,
     'retries_count': 10,
+    'retry_max_timeout': 600,
+    'retry_jitter': 0.2,
     'queue_timeout': 3,
     'bulk_save_limit': 1000,
     'bulk_save_interval': 5,
+    'bulk_save_bytes': 4194304,
+    'bulk_save_concurrency': 2,
     'historical': False,
+    'historical_delta': False,
+    'historical_snapshot_interval': 20,
     'token': '',
 }
 
 DEFAULTS = {
     'retrieve_mode': '_all_',
-    'workers_inc_threshold': 75,
-    'workers_dec_threshold': 35,
     'workers_min': 1,
     'workers_max': 3,
     'workers_pool': 3,
@@ -69,23 +93,84 @@ DEFAULTS = {
     'resource_items_queue_size': 10000,
     'input_queue_size': 10000,
     'resource_items_limit': 1000,
-    'queues_controller_timeout': 60,
+    'autoscale_interval': 2,
+    'backlog_drain_time': 60,
+    'throttle_ratio_max': 0.05,
     'filter_workers_pool': 1,
     'bulk_query_interval': 5,
     'bulk_query_limit': 1000,
     'couch_url': 'http://127.0.0.1:5984',
     'db_name': 'edge_db',
-    'perfomance_window': 300
+    'perfomance_window': 300,
+    'latency_samples': 1000,
+    'feeder_checkpoint': False,
+    'index_bootstrap_batch': 10000,
+    'api_clients_max': 20,
+    'shards': 1,
+    'bulk_ingest': False,
+    'queue_spill_dir': None,
+    'queue_spill_hot_size': 1000,
+    'queue_spill_max_size': 1000000,
+    'historical_planners': 10,
+    'revisions_cache_size': 100,
+    'decode_offload': False,
+    'decode_offload_threshold': 1048576,
+    'decode_processes': 2,
+    'conditional_requests': False,
+    'validators_cache_size': 100000,
+    'rate_limit': False,
+    'upstream_rate': 10,
+    'upstream_rate_min': 1,
+    'upstream_rate_max': 100,
+    'backend_cookie': 'SERVER_ID',
+    'backend_ttl': 300,
+    'record_dir': None,
+    'record_segment_bytes': 67108864,
+    'journal_dir': None,
+    'drain_timeout': 30,
+    'metrics_host': '127.0.0.1',
+    'metrics_port': None,
+    'trace_sample_rate': 0,
+    'trace_slow_threshold': 60,
+    'trace_max_items': 1000,
+    'log_sample_rate': 1,
+    'log_events_rate': None
 }
 
 
+class APIClientsBudget(object):
+
+    """Limit of API clients shared by resource pipelines of one process
+
+    Every pipeline is always allowed to have one client, so a busy resource
+    can't starve the others completely.
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.used = 0
+
+    def acquire(self, owned=0):
+        if owned > 0 and self.used >= self.limit:
+            return False
+        self.used += 1
+        return True
+
+    def release(self):
+        self.used = max(self.used - 1, 0)
+
+
 class EdgeDataBridge(object):
 
     """Edge Bridge"""
 
-    def __init__(self, config):
+    def __init__(self, config, resource=None, server=None, db=None,
+                 api_clients_budget=None, process=None, shard=None,
+                 rate_limiter=None, registry=None):
         super(EdgeDataBridge, self).__init__()
         self.config = config
+        self.resource = resource
+        self.shard = shard
         self.workers_config = {}
         self.bridge_id = uuid.uuid4().hex
         self.api_host = self.config_get('resources_api_server')
@@ -103,6 +188,8 @@ class EdgeDataBridge(object):
         for key in WORKER_CONFIG:
             self.workers_config[key] = (self.config_get(key) or
                                         WORKER_CONFIG[key])
+        if self.resource is not None:
+            self.workers_config['resource'] = self.resource
 
         # Init config
         for key in DEFAULTS:
@@ -110,27 +197,66 @@ class EdgeDataBridge(object):
 
         # Pools
         self.workers_pool = gevent.pool.Pool(self.workers_max)
+        self.autoscaler = WorkersAutoscaler(self.workers_min, self.workers_max,
+                                            self.backlog_drain_time,
+                                            self.throttle_ratio_max)
         self.retry_workers_pool = gevent.pool.Pool(self.retry_workers_max)
         self.filter_workers_pool = gevent.pool.Pool(self.filter_workers_count)
+        # Main workers removed by autoscaler until they finish their items
+        self.stopping_workers = gevent.pool.Group()
 
         # Queues
-        if self.input_queue_size == -1:
+        if self.queue_spill_dir:
+            self.input_queue = self.spill_queue('input')
+        elif self.input_queue_size == -1:
             self.input_queue = Queue()
         else:
             self.input_queue = Queue(self.input_queue_size)
-        if self.resource_items_queue_size == -1:
-            self.resource_items_queue = Queue()
+        # Spilled queue keeps items on disk only, so it can't coalesce them
+        if self.queue_spill_dir:
+            self.resource_items_queue = self.spill_queue('resource_items')
         else:
-            self.resource_items_queue = Queue(self.resource_items_queue_size)
-        self.api_clients_queue = Queue()
-        # self.retry_api_clients_queue = Queue()
-        if self.retry_resource_items_queue_size == -1:
-            self.retry_resource_items_queue = Queue()
-        else:
-            self.retry_resource_items_queue = Queue(
-                self.retry_resource_items_queue_size)
+            self.resource_items_queue = CoalescingQueue(
+                self.resource_items_queue_size)
+        self.api_clients_queue = APIClientsPool(self.backend_cookie,
+                                                self.backend_ttl)
+        self.retry_resource_items_queue = CoalescingQueue(
+            self.retry_resource_items_queue_size)
+        self.retry_scheduler = RetryScheduler(self.retry_resource_items_queue)
 
-        self.process = psutil.Process(os.getpid())
+        self.process = process or psutil.Process(os.getpid())
+        self.api_clients_budget = api_clients_budget
+        if rate_limiter is None and self.rate_limit:
+            rate_limiter = RateLimiter(self.upstream_rate,
+                                       self.upstream_rate_min,
+                                       self.upstream_rate_max)
+        self.rate_limiter = rate_limiter
+        self.recorder = None
+        if self.record_dir:
+            self.recorder = TrafficRecorder(self.record_dir,
+                                            self.workers_config['resource'],
+                                            self.record_segment_bytes)
+        # Pipelines of multi-resource bridge are served together
+        self.registry = registry or MetricsRegistry()
+        self.metrics = PipelineMetrics(self.registry,
+                                       self.workers_config['resource'])
+        self.registry.add_collector(self.collect_metrics)
+        self.metrics_server = None
+        self.event_sampler = None
+        if self.log_sample_rate < 1 or self.log_events_rate:
+            self.event_sampler = EventSampler(self.log_sample_rate,
+                                              self.log_events_rate)
+        self.events = EventLog(logger, self.event_sampler)
+        self.documents_reported = self.metrics.totals()
+        self.tracer = None
+        # Revisions of one document are in flight together, traces are
+        # kept by document id
+        if (self.trace_sample_rate and
+                not self.workers_config['historical']):
+            self.tracer = PipelineTracer(self.trace_sample_rate,
+                                         self.trace_slow_threshold,
+                                         self.trace_max_items, self.registry,
+                                         self.workers_config['resource'])
 
         if self.api_host != '' and self.api_host is not None:
             api_host = urlparse(self.api_host)
@@ -140,33 +266,113 @@ class EdgeDataBridge(object):
         else:
             raise DataBridgeConfigError('In config dictionary empty or missing'
                                         ' \'tenders_api_server\'')
-        self.db = prepare_couchdb(self.couch_url, self.db_name, logger)
+        if db is None:
+            self.db = prepare_couchdb(self.couch_url, self.db_name, logger)
+        else:
+            self.db = db
         db_url = self.couch_url + '/' + self.db_name
         prepare_couchdb_views(db_url, self.workers_config['resource'], logger)
-        self.server = Server(self.couch_url,
-                             session=Session(retry_delays=range(10)))
+        if server is None:
+            self.server = Server(self.couch_url,
+                                 session=Session(retry_delays=range(10)))
+        else:
+            self.server = server
         self.view_path = '_design/{}/_view/by_dateModified'.format(
             self.workers_config['resource'])
+        self.index = ResourceItemsIndex()
+        self.revisions_cache = RevisionsCache(self.revisions_cache_size)
+        self.codec = None
+        self.validators = None
+        if (self.conditional_requests and
+                not self.workers_config['historical']):
+            self.validators = Validators(self.validators_cache_size)
+        self.journal = None
+        if self.journal_dir:
+            self.journal = Journal(self.state_path(self.journal_dir,
+                                                   'journal', '.jsonl'))
+        # Saved feed offset must not pass items which aren't saved yet
+        self.unsaved = None
+        if self.feeder_checkpoint:
+            if (not self.journal_dir or self.workers_config['historical'] or
+                    self.shards > 1):
+                raise DataBridgeConfigError(
+                    '\'feeder_checkpoint\' requires \'journal_dir\' and '
+                    'isn\'t supported in historical and sharded modes.')
+            self.unsaved = UnsavedItems()
+        self.bulk_writer = BulkWriter(self.db, self.workers_config,
+                                      self.index, self.retry_scheduler,
+                                      self.journal, self.metrics,
+                                      self.tracer, self.event_sampler,
+                                      self.unsaved)
         extra_params = {
             'mode': self.retrieve_mode,
             'limit': self.resource_items_limit
         }
-        self.feeder = ResourceFeeder(host=self.api_host,
-                                     version=self.api_version, key='',
-                                     resource=self.workers_config['resource'],
-                                     extra_params=extra_params,
-                                     retrievers_params=self.retrievers_params,
-                                     adaptive=True)
+        if self.bulk_ingest and not self.workers_config['historical']:
+            # Feed pages carry full documents
+            extra_params['opt_fields'] = '_all_'
+        if self.shard is not None:
+            self.feeder = ShardFeeder()
+        else:
+            self.feeder = ResourceFeeder(
+                db=self.db if self.feeder_checkpoint else None,
+                recorder=self.recorder, unsaved=self.unsaved,
+                rate_limiter=self.rate_limiter, host=self.api_host, version=self.api_version, key='',
+                resource=self.workers_config['resource'],
+                extra_params=extra_params,
+                retrievers_params=self.retrievers_params, adaptive=True)
         self.api_clients_info = {}
+        self.input_queue_filler = None
+        self.held_item = None
+        self.replanning = {}
+        self.filler = None
+        self.controller = None
+        self.planners = None
+        self.stopping = Event()
+
+    def state_path(self, directory, name, extension):
+        file_name = '{}_{}'.format(self.workers_config['resource'], name)
+        if self.shard is not None:
+            file_name += '_{}'.format(self.shard)
+        return os.path.join(directory, file_name + extension)
+
+    def spill_queue(self, name):
+        return SpillQueue(
+            self.state_path(self.queue_spill_dir, name, '.sqlite'),
+            self.queue_spill_hot_size,
+            None if self.queue_spill_max_size == -1
+            else self.queue_spill_max_size)
 
     def config_get(self, name):
         try:
-            return self.config.get('main').get(name)
+            main = self.config.get('main')
+            resources = main.get('resources')
         except AttributeError:
             raise DataBridgeConfigError('In config dictionary missed section'
                                         ' \'main\'')
+        # Per resource overrides of multi-resource bridge
+        if self.resource is not None and isinstance(resources, dict):
+            overrides = resources.get(self.resource) or {}
+            if name in overrides:
+                return overrides[name]
+        return main.get(name)
+
+    def release_api_client(self, api_client_dict):
+        del self.api_clients_info[api_client_dict['id']]
+        self.api_clients_queue.remove(api_client_dict)
+        if self.api_clients_budget is not None:
+            self.api_clients_budget.release()
 
     def create_api_client(self):
+        if (self.api_clients_budget is not None and
+                not self.api_clients_budget.acquire(
+                    len(self.api_clients_info))):
+            logger.info('API clients budget {} is exhausted, {} pipeline uses'
+                        ' {} clients'.format(self.api_clients_budget.limit,
+                                             self.workers_config['resource'],
+                                             len(self.api_clients_info)),
+                        extra={'MESSAGE_ID': 'api_clients_budget_exhausted'})
+            return False
         client_user_agent = self.user_agent + '/' + self.bridge_id
         timeout = 0.1
         while 1:
@@ -175,6 +381,8 @@ class EdgeDataBridge(object):
                     host_url=self.api_host, user_agent=client_user_agent,
                     api_version=self.api_version, key=self.workers_config['token'],
                     resource=self.workers_config['resource'])
+                if self.recorder is not None:
+                    self.recorder.attach(api_client.session)
                 client_id = uuid.uuid4().hex
                 logger.info('Started api_client {}'.format(
                     api_client.session.headers['User-Agent']),
@@ -187,12 +395,15 @@ class EdgeDataBridge(object):
                 }
                 self.api_clients_info[api_client_dict['id']] = {
                     'drop_cookies': False,
-                    'request_durations': {},
+                    'latency': LatencyStats(self.latency_samples,
+                                            self.perfomance_window),
                     'request_interval': 0,
-                    'avg_duration': 0
+                    'p50': 0,
+                    'p95': 0,
+                    'p99': 0
                 }
                 self.api_clients_queue.put(api_client_dict)
-                break
+                return True
             except RequestFailed as e:
                 logger.error(
                     'Failed start api_client with status code {}'.format(
@@ -210,84 +421,184 @@ class EdgeDataBridge(object):
                     'create_api_client will be sleep {} sec.'.format(timeout))
                 sleep(timeout)
 
-    def fill_api_clients_queue(self):
-        while self.api_clients_queue.qsize() < self.workers_min:
-            self.create_api_client()
+    def fill_api_clients_queue(self, attempts=5):
+        """Create clients up to 'workers_min', backing off when refused"""
+        timeout = 0.1
+        for _ in xrange(attempts):
+            while self.api_clients_queue.qsize() < self.workers_min:
+                if not self.create_api_client():
+                    break
+            else:
+                return
+            sleep(timeout)
+            timeout *= 2
+        logger.warning('Filled API clients queue with {} of {} clients'
+                       .format(self.api_clients_queue.qsize(),
+                               self.workers_min),
+                       extra={'MESSAGE_ID': 'api_clients_queue_not_filled'})
+
+    def missing_revisions(self, item_id, revs_num):
+        """Numbers of item revisions absent in local db
+
+        Existence of revisions is checked with ``_all_docs`` request per
+        ``bulk_query_limit`` keys instead of request per revision.
+        """
+        missing = []
+        revs = range(1, revs_num + 1)
+        for i in xrange(0, revs_num, self.bulk_query_limit):
+            chunk = revs[i:i + self.bulk_query_limit]
+            rows = self.db.view('_all_docs', keys=[
+                '{}-{}'.format(item_id, rev) for rev in chunk])
+            for rev, row in zip(chunk, rows):
+                if 'error' in row or (row.get('value') or {}).get('deleted'):
+                    missing.append(rev)
+        return missing
+
+    def plan_historical_item(self, resource_item):
+        client = self.api_clients_queue.get()
+        sleep_duration = 0.5
+        current = None
+        try:
+            for attempt in xrange(3):
+                try:
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.acquire()
+                    current = client['client'].get_resource_item_historical(
+                        resource_item['id'])
+                    if self.rate_limiter is not None:
+                        self.rate_limiter.on_success()
+                    break
+                except Exception as e:
+                    if attempt == 2:
+                        break
+                    if isinstance(e, RequestFailed) and \
+                            e.status_code == 429 and \
+                            self.rate_limiter is not None:
+                        self.rate_limiter.on_throttle(retry_after(e))
+                    else:
+                        gevent.sleep(sleep_duration)
+                        sleep_duration += 1
+        finally:
+            self.api_clients_queue.put(client)
+        if current is None:
+            self.replan_historical_item(resource_item)
+            return
+        revs_num = int(current['x_revision_n'])
+        for rev in self.missing_revisions(resource_item['id'], revs_num):
+            self.resource_items_queue.put(
+                QueueItem(resource_item['id'], rev=rev))
+            self.events.debug('received_from_sync',
+                              'Add to temp queue from sync: {} {}-{}',
+                              self.workers_config['resource'][:-1],
+                              resource_item['id'], rev,
+                              TEMP_QUEUE_SIZE=self.input_queue.qsize())
+
+    def replan_historical_item(self, resource_item):
+        """Plan item again after retry delay, it's dropped after retries"""
+        delay = retry_delay(resource_item, self.workers_config)
+        limit = self.workers_config['retries_count']
+        if resource_item['retries_count'] > limit:
+            self.replanning.pop(resource_item['id'], None)
+            self.metrics.dropped.inc()
+            logger.critical(
+                '{} {} reached limit retries count {} and dropped from '
+                'planning.'.format(
+                    self.workers_config['resource'][:-1].title(),
+                    resource_item['id'], limit),
+                extra={'MESSAGE_ID': 'dropped_documents'})
+            return
+        logger.error('Failed to plan revisions of {} {}, retry in {:.1f} '
+                     'sec.'.format(self.workers_config['resource'][:-1],
+                                   resource_item['id'], delay),
+                     extra={'MESSAGE_ID': 'historical_plan_failed'})
+        self.replanning[resource_item['id']] = gevent.spawn_later(
+            delay, self._replan, resource_item)
+
+    def _replan(self, resource_item):
+        try:
+            self.plan_historical_item(resource_item)
+        finally:
+            # Failed plan has already scheduled next attempt
+            if self.replanning.get(resource_item['id']) is \
+                    gevent.getcurrent():
+                del self.replanning[resource_item['id']]
 
     def fill_input_queue(self):
+        if self.workers_config['historical']:
+            # Revision probes of several items run concurrently, each on
+            # own API client
+            self.planners = gevent.pool.Pool(self.historical_planners)
+            for resource_item in self.feeder.get_resource_items():
+                self.held_item = resource_item
+                self.planners.spawn(self.plan_historical_item, resource_item)
+                self.held_item = None
+            self.planners.join()
+            return
         for resource_item in self.feeder.get_resource_items():
-            if self.workers_config['historical']:
-                client = self.api_clients_queue.get()
-                sleep_duration = 0.5
-                for _ in xrange(3):
-                    try:
-                        current = client['client'].get_resource_item_historical(resource_item['id'])
-                        sleep_duration = max(0., sleep_duration - 0.5)
-                        revs_num = int(current['x_revision_n'])
-                        for index in range(revs_num):
-                            if resource_item['id'] + "-{}".format(index + 1) in self.db:
-                                continue
-                            self.resource_items_queue.put({
-                                'id': resource_item['id'],
-                                'rev': index + 1
-                            })
-                            logger.debug('Add to temp queue from sync: {} {}-{}'.format(
-                                self.workers_config['resource'][:-1], resource_item['id'], index + 1),
-                                extra={'MESSAGE_ID': 'received_from_sync',
-                                       'TEMP_QUEUE_SIZE': self.input_queue.qsize()})
-                        break
-                    except RequestFailed as e:
-                        if e.status_code == 429:
-                            gevent.sleep(sleep_duration)
-                            sleep_duration += 1
+            if not self.bulk_ingest:
+                # Only id and version of feed item are needed further
+                resource_item = QueueItem(resource_item['id'],
+                                          resource_item['dateModified'])
+            if self.tracer is not None:
+                self.tracer.start(resource_item['id'])
+            # Drain kills filler waiting for place in queue, item it holds
+            # is journaled with the rest
+            self.held_item = resource_item
+            self.input_queue.put(resource_item)
+            self.held_item = None
+            self.events.debug('received_from_sync',
+                              'Add to temp queue from sync: {} {} {}',
+                              self.workers_config['resource'][:-1],
+                              resource_item['id'],
+                              resource_item['dateModified'],
+                              TEMP_QUEUE_SIZE=self.input_queue.qsize())
 
-                self.api_clients_queue.put(client)
-            else:
-                self.input_queue.put(resource_item)
-                logger.debug('Add to temp queue from sync: {} {} {}'.format(
-                    self.workers_config['resource'][:-1], resource_item['id'],
-                    resource_item['dateModified']),
-                    extra={'MESSAGE_ID': 'received_from_sync',
-                           'TEMP_QUEUE_SIZE': self.input_queue.qsize()})
-
-    def send_bulk(self, input_dict):
-        sleep_before_retry = 2
-        for i in xrange(0, 3):
-            try:
-                logger.debug('Send check bulk: {}'.format(len(input_dict)),
-                             extra={'CHECK_BULK_LEN': len(input_dict)})
-                start = time()
-                rows = self.db.view(self.view_path, keys=input_dict.values())
-                end = time() - start
-                logger.debug('Duration bulk check: {} sec.'.format(end),
-                             extra={'CHECK_BULK_DURATION': end * 1000})
-                resp_dict = {k.id: k.key for k in rows}
-                break
-            except (IncompleteRead, Exception) as e:
-                logger.error('Error while send bulk {}'.format(e.message),
-                             extra={'MESSAGE_ID': 'exceptions'})
-                if i == 2:
-                    raise e
-                sleep(sleep_before_retry)
-                sleep_before_retry *= 2
+    def send_bulk(self, input_dict, input_docs=None):
+        self.events.debug(None, 'Send check bulk: {}', len(input_dict),
+                          CHECK_BULK_LEN=len(input_dict))
+        start = time()
+        input_docs = input_docs or {}
         for item_id, date_modified in input_dict.items():
-            if item_id in resp_dict and date_modified == resp_dict[item_id]:
-                logger.debug('Ignored {} {}: SYNC - {}, EDGE - {}'.format(
-                    self.workers_config['resource'][:-1], item_id,
-                    date_modified, resp_dict[item_id]),
-                    extra={'MESSAGE_ID': 'skipped'})
+            if self.tracer is not None:
+                self.tracer.mark(item_id, 'batch')
+            local_date_modified = self.index.date_modified(item_id)
+            if (local_date_modified is not None and
+                    date_modified <= local_date_modified):
+                self.metrics.skip('check')
+                if self.tracer is not None:
+                    self.tracer.finish(item_id, 'skipped')
+                self.events.debug('skipped',
+                                  'Ignored {} {}: SYNC - {}, EDGE - {}',
+                                  self.workers_config['resource'][:-1],
+                                  item_id, date_modified, local_date_modified)
             else:
-                self.resource_items_queue.put(
-                    {'id': item_id, 'dateModified': date_modified})
-                logger.debug('Put to main queue {}: {} {}'.format(
-                    self.workers_config['resource'][:-1], item_id,
-                    date_modified),
-                    extra={'MESSAGE_ID': 'add_to_resource_items_queue'})
+                queue_item = QueueItem(item_id, date_modified)
+                doc = input_docs.get(item_id)
+                if doc is not None and doc['dateModified'] == date_modified:
+                    # Worker saves it without request to public API
+                    queue_item.doc = doc
+                if self.tracer is not None:
+                    # Waiting for place in main queue is its wait
+                    self.tracer.mark(item_id, 'check')
+                self.resource_items_queue.put(queue_item)
+                self.events.debug('add_to_resource_items_queue',
+                                  'Put to main queue {}: {} {}',
+                                  self.workers_config['resource'][:-1],
+                                  item_id, date_modified)
+        # Includes waiting for place in bounded main queue
+        self.metrics.send_bulk.observe(time() - start)
+        self.metrics.send_bulk_size.observe(len(input_dict))
 
     def fill_resource_items_queue(self):
         start_time = datetime.now()
         input_dict = {}
+        input_docs = {}
         while True:
+            if self.stopping.is_set():
+                # Pass collected items on, drain journals them
+                if input_dict:
+                    self.send_bulk(input_dict, input_docs)
+                return
             # Get resource_item from temp queue
             if not self.input_queue.empty():
                 resource_item = self.input_queue.get()
@@ -303,94 +614,116 @@ class EdgeDataBridge(object):
 
             # Add resource_item to bulk
             if resource_item is not None:
-                logger.debug('Add to input_dict {}'.format(resource_item['id']))
+                self.events.debug(None, 'Add to input_dict {}',
+                                  resource_item['id'])
+                if self.tracer is not None:
+                    self.tracer.mark(resource_item['id'], 'input_queue')
                 input_dict[resource_item['id']] = resource_item['dateModified']
+                # Feed item has more than id and dateModified only when full
+                # documents are requested
+                if self.bulk_ingest and len(resource_item) > 2:
+                    input_docs[resource_item['id']] = resource_item
 
             if (len(input_dict) >= self.bulk_query_limit or
                 (datetime.now() - start_time).total_seconds() >=
                     self.bulk_query_interval):
                 if len(input_dict) > 0:
-                    self.send_bulk(input_dict)
+                    self.send_bulk(input_dict, input_docs)
                     input_dict = {}
+                    input_docs = {}
                 start_time = datetime.now()
 
     def resource_items_filter(self, r_id, r_date_modified):
-        try:
-            local_document = self.db.get(r_id)
-            if local_document:
-                if local_document['dateModified'] < r_date_modified:
-                    return True
-                else:
-                    return False
-            else:
-                return True
-        except Exception as e:
-            logger.error(
-                'Filter error: Error while getting {} {} from couchdb: '
-                '{}'.format(self.workers_config['resource'][:-1], r_id,
-                            e.message), extra={'MESSAGE_ID': 'exceptions'})
+        local_date_modified = self.index.date_modified(r_id)
+        if local_date_modified is None:
             return True
+        return local_date_modified < r_date_modified
 
-    def _get_average_requests_duration(self):
-        req_durations = []
-        delta = timedelta(seconds=self.perfomance_window)
-        current_date = datetime.now() - delta
-        for cid, info in self.api_clients_info.items():
-            if len(info['request_durations']) > 0:
-                if min(info['request_durations'].keys()) <= current_date:
-                    info['grown'] = True
-                avg = round(
-                    sum(info['request_durations'].values()) * 1.0 /
-                    len(info['request_durations']), 3)
-                req_durations.append(avg)
-                info['avg_duration'] = avg
-
-        if len(req_durations) > 0:
-            return round(sum(req_durations) /
-                         len(req_durations), 3), req_durations
-        else:
-            return 0, req_durations
+    def _get_requests_percentiles(self):
+        """Percentiles of every client and of all requests together"""
+        all_durations = []
+        for info in self.api_clients_info.values():
+            durations = info['latency'].durations()
+            info['p50'], info['p95'], info['p99'] = [
+                percentile(durations, q) for q in (50, 95, 99)]
+            all_durations.extend(durations)
+        all_durations.sort()
+        return tuple(percentile(all_durations, q) for q in (50, 95, 99))
 
     # TODO: Add logic for restart sync if last response grater than some values
     # and no active tasks specific for resource
 
+    def _requests_counts(self):
+        requests = throttled = 0
+        for info in self.api_clients_info.values():
+            requests += info['latency'].count
+            throttled += info['latency'].throttled
+        return requests, throttled
+
     def queues_controller(self):
         while True:
-            if (self.workers_pool.free_count() > 0 and
-                (self.resource_items_queue.qsize() >
-                 ((float(self.resource_items_queue_size) / 100) *
-                  self.workers_inc_threshold))):
+            qsize = self.resource_items_queue.qsize()
+            requests, throttled = self._requests_counts()
+            self.autoscaler.update(time(), qsize,
+                                   self.resource_items_queue.got, requests,
+                                   throttled)
+            latency, _, _ = self._get_requests_percentiles()
+            workers = len(self.workers_pool)
+            desired = self.autoscaler.desired(workers, qsize, latency)
+            for _ in xrange(min(desired - workers,
+                                self.workers_pool.free_count())):
                 self.create_api_client()
                 w = ResourceItemWorker.spawn(self.api_clients_queue,
                                              self.resource_items_queue,
                                              self.db, self.workers_config,
                                              self.retry_resource_items_queue,
-                                             self.api_clients_info)
+                                             self.api_clients_info,
+                                             self.index, self.retry_scheduler,
+                                             self.bulk_writer,
+                                             self.revisions_cache,
+                                             self.codec, self.validators,
+                                             self.rate_limiter,
+                                             self.metrics, self.tracer,
+                                             self.event_sampler, self.unsaved)
                 self.workers_pool.add(w)
                 logger.info('Queue controller: Create main queue worker.')
-            elif (self.resource_items_queue.qsize() <
-                  ((float(self.resource_items_queue_size) / 100) *
-                   self.workers_dec_threshold)):
-                if len(self.workers_pool) > self.workers_min:
-                    wi = self.workers_pool.greenlets.pop()
-                    wi.shutdown()
-                    api_client_dict = self.api_clients_queue.get()
-                    del self.api_clients_info[api_client_dict['id']]
-                    logger.info('Queue controller: Kill main queue worker.')
-            filled_resource_items_queue = round(
-                self.resource_items_queue.qsize() /
-                (float(self.resource_items_queue_size) / 100), 2)
-            logger.info('Resource items queue filled on {} %'.format(
-                filled_resource_items_queue))
-            filled_retry_resource_items_queue \
-                = round(self.retry_resource_items_queue.qsize() / float(
-                    self.retry_resource_items_queue_size) / 100, 2)
-            logger.info('Retry resource items queue filled on {} %'.format(
-                filled_retry_resource_items_queue))
-            sleep(self.queues_controller_timeout)
+            for _ in xrange(workers - desired):
+                # Pool slot is freed when worker exits
+                wi = self.workers_pool.greenlets.pop()
+                self.stopping_workers.add(wi)
+                wi.shutdown()
+                api_client_dict = self.api_clients_queue.get()
+                self.release_api_client(api_client_dict)
+                logger.info('Queue controller: Kill main queue worker.')
+            # Steady state is logged only in debug, every tick would flood
+            logger.log(
+                logging.INFO if desired != workers else logging.DEBUG,
+                'Queue controller: arrival rate {} items/sec, completion '
+                'rate {} items/sec, 429 ratio {}, workers {} -> {}'.format(
+                    round(self.autoscaler.arrival_rate, 2),
+                    round(self.autoscaler.completion_rate, 2),
+                    round(self.autoscaler.throttle_ratio, 3), workers,
+                    desired),
+                extra={'ARRIVAL_RATE': self.autoscaler.arrival_rate,
+                       'COMPLETION_RATE': self.autoscaler.completion_rate,
+                       'THROTTLE_RATIO': self.autoscaler.throttle_ratio,
+                       'DESIRED_WORKERS': desired})
+            sleep(self.autoscale_interval)
+
+    def _all_workers(self):
+        return (list(self.workers_pool) + list(self.retry_workers_pool) +
+                list(self.stopping_workers))
+
+    def save_checkpoint(self):
+        if self.unsaved is not None:
+            # Saved and skipped items are known from index
+            self.unsaved.prune(self.index)
+        self.feeder.save_checkpoint(self.journal)
 
     def gevent_watcher(self):
         self.perfomance_watcher()
+        self.documents_summary()
+        self.save_checkpoint()
         for t in self.server.tasks():
             if (t['type'] == 'indexer' and t['database'] == self.db_name and
                     t.get('design_document', None) == '_design/{}'.format(
@@ -399,6 +732,37 @@ class EdgeDataBridge(object):
                     'Watcher: Waiting for end of view indexing. Current'
                     ' progress: {} %'.format(t['progress']))
 
+        # Check retry scheduler
+        if self.retry_scheduler.ready():
+            logger.error('Retry scheduler error: {}'.format(
+                self.retry_scheduler.exception),
+                extra={'MESSAGE_ID': 'exception'})
+            self.retry_scheduler = RetryScheduler(
+                self.retry_resource_items_queue, self.retry_scheduler.heap)
+            self.retry_scheduler.start()
+            for worker in self._all_workers():
+                worker.retry_scheduler = self.retry_scheduler
+            self.bulk_writer.retry_scheduler = self.retry_scheduler
+
+        # Check bulk writer
+        if self.bulk_writer.ready():
+            logger.error('Bulk writer error: {}'.format(
+                self.bulk_writer.exception),
+                extra={'MESSAGE_ID': 'exception'})
+            bulk_writer = BulkWriter(self.db, self.workers_config,
+                                     self.index, self.retry_scheduler,
+                                     self.journal, self.metrics,
+                                     self.tracer, self.event_sampler,
+                                     self.unsaved)
+            # Keep documents not flushed by failed writer
+            bulk_writer.bulk = self.bulk_writer.bulk
+            bulk_writer.bulk_bytes = self.bulk_writer.bulk_bytes
+            bulk_writer.start_time = self.bulk_writer.start_time
+            self.bulk_writer = bulk_writer
+            self.bulk_writer.start()
+            for worker in self._all_workers():
+                worker.bulk_writer = self.bulk_writer
+
         # Check fill threads
         input_threads = 1
         if self.input_queue_filler.exception:
@@ -406,6 +770,7 @@ class EdgeDataBridge(object):
             logger.error('Temp queue filler error: {}'.format(
                 self.input_queue_filler.exception.message),
                 extra={'MESSAGE_ID': 'exception'})
+            self.save_checkpoint()
             self.input_queue_filler = spawn(self.fill_input_queue)
         logger.info('Input threads {}'.format(input_threads),
                     extra={'INPUT_THREADS': input_threads})
@@ -429,7 +794,14 @@ class EdgeDataBridge(object):
                                              self.resource_items_queue,
                                              self.db, self.workers_config,
                                              self.retry_resource_items_queue,
-                                             self.api_clients_info)
+                                             self.api_clients_info,
+                                             self.index, self.retry_scheduler,
+                                             self.bulk_writer,
+                                             self.revisions_cache,
+                                             self.codec, self.validators,
+                                             self.rate_limiter,
+                                             self.metrics, self.tracer,
+                                             self.event_sampler, self.unsaved)
                 self.workers_pool.add(w)
                 logger.info('Watcher: Create main queue worker.')
                 self.create_api_client()
@@ -445,7 +817,14 @@ class EdgeDataBridge(object):
                                              self.retry_resource_items_queue,
                                              self.db, self.workers_config,
                                              self.retry_resource_items_queue,
-                                             self.api_clients_info)
+                                             self.api_clients_info,
+                                             self.index, self.retry_scheduler,
+                                             self.bulk_writer,
+                                             self.revisions_cache,
+                                             self.codec, self.validators,
+                                             self.rate_limiter,
+                                             self.metrics, self.tracer,
+                                             self.event_sampler, self.unsaved)
                 self.retry_workers_pool.add(w)
                 logger.info('Watcher: Create retry queue worker.')
 
@@ -456,31 +835,143 @@ class EdgeDataBridge(object):
         retry_queue_size = self.retry_resource_items_queue.qsize()
         logger.info('Resource items retry queue size {}'.format(
             retry_queue_size), extra={'RETRY_QUEUE_SIZE': retry_queue_size})
+        coalesced = getattr(self.resource_items_queue, 'coalesced', 0)
+        logger.info('Resource items queue coalesced {}'.format(coalesced),
+                    extra={'MAIN_QUEUE_COALESCED': coalesced})
+        retry_coalesced = self.retry_resource_items_queue.coalesced
+        logger.info('Resource items retry queue coalesced {}'.format(
+            retry_coalesced), extra={'RETRY_QUEUE_COALESCED': retry_coalesced})
+        retry_scheduled = len(self.retry_scheduler)
+        logger.info('Resource items scheduled for retry {}'.format(
+            retry_scheduled), extra={'RETRY_SCHEDULED': retry_scheduled})
+        bulk_len = len(self.bulk_writer.bulk)
+        logger.info('Documents waiting in save bulk {}'.format(bulk_len),
+                    extra={'SAVE_BULK_PENDING': bulk_len})
         api_clients_count = len(self.api_clients_info)
         logger.info('API Clients count: {}'.format(api_clients_count),
                     extra={'API_CLIENTS': api_clients_count})
+        backends = self.api_clients_queue.backends()
+        logger.info('API Clients spread over {} backends: {}'.format(
+            len(backends), ', '.join(
+                '{} {}'.format(backend,
+                               self.api_clients_queue.clients_count(backend))
+                for backend in backends)),
+            extra={'API_CLIENTS_BACKENDS': len(backends)})
+        if self.rate_limiter is not None:
+            logger.info('Upstream rate limit {} requests/sec'.format(
+                round(self.rate_limiter.rate, 2)),
+                extra={'UPSTREAM_RATE': self.rate_limiter.rate})
+        if self.recorder is not None:
+            logger.info('Recorded upstream responses {}'.format(
+                self.recorder.records),
+                extra={'RECORDED_RESPONSES': self.recorder.records})
 
-    def _calculate_st_dev(self, values):
-        if len(values) > 0:
-            avg = sum(values) * 1.0 / len(values)
-            variance = map(lambda x: (x - avg) ** 2, values)
-            avg_variance = sum(variance) * 1.0 / len(variance)
-            st_dev = math.sqrt(avg_variance)
-            return round(st_dev, 3)
-        else:
-            return 0
+    def collect_metrics(self):
+        """Copy state of pipeline to metrics when they are scraped"""
+        resource = self.workers_config['resource']
+        registry = self.registry
+        queue_size = registry.gauge('edge_queue_size',
+                                    'Resource items waiting in queue',
+                                    ('resource', 'queue'))
+        for queue, size in (
+                ('input', self.input_queue.qsize()),
+                ('main', self.resource_items_queue.qsize()),
+                ('retry', self.retry_resource_items_queue.qsize()),
+                ('scheduled', len(self.retry_scheduler)),
+                ('bulk', len(self.bulk_writer.bulk))):
+            queue_size.labels(resource, queue).set(size)
+        coalesced = registry.counter('edge_queue_coalesced_total',
+                                     'Resource items merged with pending ones',
+                                     ('resource', 'queue'))
+        coalesced.labels(resource, 'main').set(
+            getattr(self.resource_items_queue, 'coalesced', 0))
+        coalesced.labels(resource, 'retry').set(
+            self.retry_resource_items_queue.coalesced)
+        workers = registry.gauge('edge_workers', 'Running workers',
+                                 ('resource', 'pool'))
+        workers.labels(resource, 'main').set(len(self.workers_pool))
+        workers.labels(resource, 'retry').set(len(self.retry_workers_pool))
+        registry.gauge('edge_items_arrival_rate',
+                       'Resource items put to main queue per second',
+                       ('resource',)).labels(resource).set(
+                           self.autoscaler.arrival_rate)
+        registry.gauge('edge_items_completion_rate',
+                       'Resource items taken by workers per second',
+                       ('resource',)).labels(resource).set(
+                           self.autoscaler.completion_rate)
+        registry.gauge('edge_index_size', 'Documents in local index',
+                       ('resource',)).labels(resource).set(len(self.index))
+
+        registry.gauge('edge_api_clients', 'API clients',
+                       ('resource',)).labels(resource).set(
+                           len(self.api_clients_info))
+        registry.gauge('edge_api_clients_backends',
+                       'Upstream backends API clients are bound to',
+                       ('resource',)).labels(resource).set(
+                           len(self.api_clients_queue.backends()))
+        client_latency = registry.gauge(
+            'edge_api_client_request_seconds',
+            'Request duration percentiles of API client over performance '
+            'window', ('resource', 'client', 'quantile'))
+        client_interval = registry.gauge(
+            'edge_api_client_request_interval_seconds',
+            'Delay of API client requests after 429 answers',
+            ('resource', 'client'))
+        client_requests = registry.counter(
+            'edge_api_client_requests_total', 'Requests made by API client',
+            ('resource', 'client'))
+        # Replaced clients disappear
+        for metric in (client_latency, client_interval, client_requests):
+            metric.clear(resource)
+        for client_id, info in self.api_clients_info.items():
+            for quantile, value in zip(('0.5', '0.95', '0.99'),
+                                       info['latency'].percentiles(50, 95,
+                                                                   99)):
+                client_latency.labels(resource, client_id, quantile).set(
+                    value)
+            client_interval.labels(resource, client_id).set(
+                info['request_interval'])
+            client_requests.labels(resource, client_id).set(
+                info['latency'].count)
+        if self.rate_limiter is not None:
+            registry.gauge('edge_upstream_rate_limit',
+                           'Upstream requests per second allowed',
+                           ('resource',)).labels(resource).set(
+                               self.rate_limiter.rate)
+        if self.recorder is not None:
+            registry.counter('edge_recorded_responses_total',
+                             'Upstream responses recorded',
+                             ('resource',)).labels(resource).set(
+                                 self.recorder.records)
+        registry.gauge('edge_process_rss_bytes',
+                       'Resident memory of bridge process').labels().set(
+                           self.process.memory_info().rss)
 
-    def _mark_bad_clients(self, dev):
+    def serve_metrics(self):
+        if self.metrics_port is None:
+            return
+        port = self.metrics_port
+        if self.shard is not None:
+            # Coordinator serves configured port, shards the next ones
+            port += self.shard + 1
+        self.metrics_server = self.registry.serve(self.metrics_host, port)
+
+    def _slow_threshold(self):
+        """Median of clients p95, p50 of healthy client stays below it"""
+        p95s = sorted(info['p95'] for info in self.api_clients_info.values()
+                      if len(info['latency']) > 0)
+        return percentile(p95s, 50)
+
+    def _mark_bad_clients(self, threshold):
         # Mark bad api clients
         for cid, info in self.api_clients_info.items():
-            if info.get('grown', False) and info['avg_duration'] > dev:
+            if info['latency'].grown and info['p50'] > threshold:
                 info['drop_cookies'] = True
                 logger.debug(
-                    'Perfomance watcher: Mark client {} as bad, avg.'
-                    ' request_duration is {} sec.'.format(
-                        cid, info['avg_duration']),
+                    'Perfomance watcher: Mark client {} as bad, p50'
+                    ' request_duration is {} sec.'.format(cid, info['p50']),
                     extra={'MESSAGE_ID': 'marked_as_bad'})
-            elif info['avg_duration'] < dev and info['request_interval'] > 0:
+            elif info['p50'] < threshold and info['request_interval'] > 0:
                 info['drop_cookies'] = True
                 logger.debug(
                     'Perfomance watcher: Mark client {} as bad,'
@@ -488,59 +979,444 @@ class EdgeDataBridge(object):
                         cid, info['request_interval']),
                     extra={'MESSAGE_ID': 'marked_as_bad'})
 
+    def documents_summary(self):
+        """Log documents handled since previous watcher run
+
+        One line with counts stands for info lines per document.
+        """
+        totals = self.metrics.totals()
+        counts = dict((key, value - self.documents_reported[key])
+                      for key, value in totals.items())
+        self.documents_reported = totals
+        logger.info(
+            'Documents {}: {} created, {} updated, {} skipped, {} retried, '
+            '{} dropped'.format(
+                self.workers_config['resource'], counts['created'],
+                counts['updated'], counts['skipped'], counts['retried'],
+                counts['dropped']),
+            extra={'MESSAGE_ID': 'documents_summary',
+                   'CREATED_DOCUMENTS': counts['created'],
+                   'UPDATED_DOCUMENTS': counts['updated'],
+                   'SKIPPED_DOCUMENTS': counts['skipped'],
+                   'RETRIED_DOCUMENTS': counts['retried'],
+                   'DROPPED_DOCUMENTS': counts['dropped']})
+        return counts
+
     def perfomance_watcher(self):
-            avg_duration, values = self._get_average_requests_duration()
-            for _, info in self.api_clients_info.items():
-                delta = timedelta(
-                    seconds=self.perfomance_window + self.watch_interval)
-                current_date = datetime.now() - delta
-                delete_list = [key for key in info['request_durations'] if key < current_date]
-                for k in delete_list:
-                    del info['request_durations'][k]
-
-            st_dev = self._calculate_st_dev(values)
-            if len(values) > 0:
-                min_avg = min(values) * 1000
-                max_avg = max(values) * 1000
+        p50, p95, p99 = self._get_requests_percentiles()
+        threshold = self._slow_threshold()
+        logger.info(
+            'Performance watcher:\nREQUESTS_P50 - {} ms.\n'
+            'REQUESTS_P95 - {} ms.\nREQUESTS_P99 - {} ms.\n'
+            'REQUESTS_SLOW_THRESHOLD - {} ms.'.format(
+                p50 * 1000, p95 * 1000, p99 * 1000, threshold * 1000),
+            extra={'REQUESTS_P50': p50 * 1000,
+                   'REQUESTS_P95': p95 * 1000,
+                   'REQUESTS_P99': p99 * 1000,
+                   'REQUESTS_SLOW_THRESHOLD': threshold * 1000})
+        self._mark_bad_clients(threshold)
+
+    def in_shard(self, item_id):
+        return shard_for(item_id, self.shards) == self.shard
+
+    def start(self):
+        logger.info('Start {} data sync...'.format(
+            self.workers_config['resource']),
+            extra={'MESSAGE_ID': 'edge_bridge__data_sync'})
+        if not self.workers_config['historical']:
+            self.index.bootstrap(self.db, self.view_path,
+                                 self.index_bootstrap_batch,
+                                 self.in_shard if self.shard is not None
+                                 else None)
+        if self.decode_offload and not self.workers_config['historical']:
+            self.codec = DocumentCodec(self.decode_offload_threshold,
+                                       self.decode_processes)
+        if self.journal is not None:
+            # Journal is read before writer appends to it
+            spawn(self.recover_journal, self.journal.recover())
+        self.retry_scheduler.start()
+        self.bulk_writer.start()
+        self.input_queue_filler = spawn(self.fill_input_queue)
+        if not self.workers_config['historical']:
+            self.filler = spawn(self.fill_resource_items_queue)
+        self.controller = spawn(self.queues_controller)
+
+    def recover_journal(self, resource_items):
+        if resource_items:
+            logger.info('Recovered {} {} from journal'.format(
+                len(resource_items), self.workers_config['resource']),
+                extra={'MESSAGE_ID': 'journal_recovered'})
+        planners = gevent.pool.Pool(self.historical_planners)
+        for resource_item in resource_items:
+            if self.unsaved is not None:
+                # Kept in journal with next checkpoints until saved
+                self.unsaved.add(resource_item['id'],
+                                 resource_item.get('dateModified'))
+            if self.workers_config['historical'] and 'rev' not in resource_item:
+                # Feed item, its missing revisions aren't known yet
+                planners.spawn(self.plan_historical_item, resource_item)
             else:
-                max_avg = 0
-                min_avg = 0
-            dev = round(st_dev + avg_duration, 3)
-
-            logger.info(
-                'Performance watcher:\nREQUESTS_STDEV - {} sec.\n'
-                'REQUESTS_DEV - {} ms.\nREQUESTS_MIN_AVG - {} ms.\n'
-                'REQUESTS_MAX_AVG - {} ms.\nREQUESTS_AVG - {} sec.'.format(
-                    round(st_dev, 3), dev, min_avg, max_avg, avg_duration),
-                extra={'REQUESTS_DEV': dev * 1000,
-                       'REQUESTS_MIN_AVG': min_avg,
-                       'REQUESTS_MAX_AVG': max_avg,
-                       'REQUESTS_AVG': avg_duration * 1000})
-            self._mark_bad_clients(dev)
+                self.resource_items_queue.put(
+                    QueueItem.from_item(resource_item))
+        planners.join()
+
+    def shutdown(self):
+        """Ask running bridge to drain and stop"""
+        self.stopping.set()
+
+    def drain(self):
+        """Stop pipeline keeping resource items it hasn't saved yet
+
+        Feed is stopped and checkpointed first, workers finish items they
+        are fetching and writer flushes every bulk and waits for its save,
+        each step waits at most 'drain_timeout' seconds. Items left in
+        feeder and queues are written to journal, so next start continues
+        with them. Spill queues write items they keep in memory to their
+        file when closed.
+        """
+        logger.info('Drain {} pipeline...'.format(
+            self.workers_config['resource']),
+            extra={'MESSAGE_ID': 'edge_bridge_drain'})
+        self.stopping.set()
+        for greenlet in (self.controller, self.input_queue_filler):
+            if greenlet is not None:
+                greenlet.kill()
+        pending = self.feeder.stop()
+        if self.held_item is not None:
+            pending.append(self.held_item)
+        self.save_checkpoint()
+        for greenlet in (self.planners, self.filler):
+            if greenlet is not None:
+                greenlet.join(timeout=self.drain_timeout)
+                greenlet.kill()
+        # Items waiting for replan or being replanned are planned again on
+        # next start
+        for greenlet in self.replanning.values():
+            greenlet.kill()
+            pending.append(greenlet.args[0])
+        self.replanning.clear()
+
+        workers = self._all_workers()
+        for worker in workers:
+            worker.shutdown()
+        gevent.joinall(workers, timeout=self.drain_timeout)
+        busy = [worker for worker in workers if not worker.dead]
+        if busy:
+            logger.warning('{} workers didn\'t finish in {} sec.'.format(
+                len(busy), self.drain_timeout),
+                extra={'MESSAGE_ID': 'drain_timeout'})
+            gevent.killall(busy)
+
+        self.retry_scheduler.shutdown()
+        self.bulk_writer.shutdown()
+        self.bulk_writer.join(timeout=self.drain_timeout)
+
+        spilled = set()
+        for queue in (self.input_queue, self.resource_items_queue,
+                      self.retry_resource_items_queue):
+            if isinstance(queue, SpillQueue):
+                # Items read last are delivered again by spill queue
+                spilled.update(Journal.key(Journal.ref(item))
+                               for item in queue.read_items())
+                queue.close()
+                continue
+            while not queue.empty():
+                pending.append(queue.get())
+        pending.extend(item for _, _, item in self.retry_scheduler.heap)
+        pending = [item for item in pending
+                   if Journal.key(Journal.ref(item)) not in spilled]
+        if self.journal is not None:
+            self.journal.begin(pending)
+            self.journal.close()
+            logger.info('Journaled {} unsaved {}'.format(
+                len(pending), self.workers_config['resource']),
+                extra={'MESSAGE_ID': 'journal_written'})
+        elif pending:
+            logger.warning('Dropped {} unsaved {}, set journal_dir to keep '
+                           'them'.format(len(pending),
+                                         self.workers_config['resource']),
+                           extra={'MESSAGE_ID': 'dropped_documents'})
+        if self.codec is not None:
+            self.codec.close()
+        if self.recorder is not None:
+            self.recorder.close()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
     def run(self):
         logger.info('Start Edge Bridge',
                     extra={'MESSAGE_ID': 'edge_bridge_start_bridge'})
-        logger.info('Start data sync...',
-                    extra={'MESSAGE_ID': 'edge_bridge__data_sync'})
+        self.start()
+        self.serve_metrics()
+        try:
+            while True:
+                self.gevent_watcher()
+                if self.stopping.wait(self.watch_interval):
+                    self.drain()
+                    return
+        except (KeyboardInterrupt, SystemExit):
+            # Interrupted or shard stream is closed by coordinator
+            self.drain()
+            raise
+
+
+class ShardedEdgeDataBridge(EdgeDataBridge):
+
+    """Coordinator of hash-sharded Edge Bridge processes
+
+    Runs the feeder and routes every feed item to one of ``shards`` child
+    processes by hash of its id. Each child is an ordinary EdgeDataBridge
+    started with ``--shard`` option, which reads items from stdin instead of
+    the feed and keeps index, queues and worker pools for its ids only.
+    """
+
+    def __init__(self, config, config_path):
+        super(ShardedEdgeDataBridge, self).__init__(config)
+        self.config_path = config_path
+        self.shard_processes = [None] * self.shards
+        self.routed = self.registry.counter('edge_shard_items_total',
+                                            'Feed items routed to shard',
+                                            ('resource', 'shard'))
+
+    def spawn_shard(self, shard):
+        process = Popen([sys.executable, '-m',
+                         'openprocurement.edge.databridge', self.config_path,
+                         '--shard', str(shard)], stdin=PIPE, close_fds=True)
+        self.shard_processes[shard] = process
+        logger.info('Started shard {} with pid {}'.format(shard, process.pid),
+                    extra={'MESSAGE_ID': 'edge_bridge_start_shard'})
+        return process
+
+    def send_to_shard(self, resource_item):
+        shard = shard_for(resource_item['id'], self.shards)
+        line = dumps(resource_item) + '\n'
+        for _ in xrange(2):
+            process = self.shard_processes[shard]
+            try:
+                process.stdin.write(line)
+                process.stdin.flush()
+                self.routed.labels(self.workers_config['resource'],
+                                   shard).inc()
+                return
+            except (IOError, OSError) as e:
+                logger.error('Failed send {} to shard {}: {}'.format(
+                    resource_item['id'], shard, repr(e)),
+                    extra={'MESSAGE_ID': 'exceptions'})
+                self.restart_shard(shard)
+
+    def restart_shard(self, shard):
+        process = self.shard_processes[shard]
+        if process is not None and process.poll() is None:
+            process.kill()
+            process.wait()
+        self.spawn_shard(shard)
+
+    def fill_input_queue(self):
+        for resource_item in self.feeder.get_resource_items():
+            self.send_to_shard(resource_item)
+
+    def collect_metrics(self):
+        # Pipelines run in shards, which serve their own metrics
+        alive = sum(1 for process in self.shard_processes
+                    if process is not None and process.poll() is None)
+        self.registry.gauge('edge_shards_alive', 'Shard processes running',
+                            ('resource',)).labels(
+                                self.workers_config['resource']).set(alive)
+
+    def gevent_watcher(self):
+        self.feeder.save_checkpoint()
+        alive = 0
+        for shard, process in enumerate(self.shard_processes):
+            if process.poll() is None:
+                alive += 1
+                continue
+            logger.error('Shard {} exited with code {}'.format(
+                shard, process.returncode),
+                extra={'MESSAGE_ID': 'exception'})
+            self.spawn_shard(shard)
+        logger.info('Shards alive {}'.format(alive),
+                    extra={'SHARDS_ALIVE': alive})
+        if self.input_queue_filler.exception:
+            logger.error('Temp queue filler error: {}'.format(
+                self.input_queue_filler.exception.message),
+                extra={'MESSAGE_ID': 'exception'})
+            self.feeder.save_checkpoint()
+            self.input_queue_filler = spawn(self.fill_input_queue)
+
+    def run(self):
+        logger.info('Start Edge Bridge coordinator with {} shards'.format(
+            self.shards), extra={'MESSAGE_ID': 'edge_bridge_start_bridge'})
+        for shard in xrange(self.shards):
+            self.spawn_shard(shard)
         self.input_queue_filler = spawn(self.fill_input_queue)
-        if not self.workers_config['historical']:
-            self.filler = spawn(self.fill_resource_items_queue)
-        spawn(self.queues_controller)
-        while True:
-            self.gevent_watcher()
-            sleep(self.watch_interval)
+        self.serve_metrics()
+        try:
+            while True:
+                self.gevent_watcher()
+                if self.stopping.wait(self.watch_interval):
+                    self.drain()
+                    return
+        except (KeyboardInterrupt, SystemExit):
+            self.drain()
+            raise
+
+    def drain(self):
+        """Stop feed and let shards drain their pipelines
+
+        Shard drains when its stream is closed, shards which don't exit in
+        'drain_timeout' seconds are killed.
+        """
+        logger.info('Drain shards...',
+                    extra={'MESSAGE_ID': 'edge_bridge_drain'})
+        self.stopping.set()
+        self.input_queue_filler.kill()
+        for resource_item in self.feeder.stop():
+            self.send_to_shard(resource_item)
+        self.feeder.save_checkpoint()
+        processes = [process for process in self.shard_processes
+                     if process is not None and process.poll() is None]
+        for process in processes:
+            process.stdin.close()
+        deadline = time() + self.drain_timeout
+        for process in processes:
+            while process.poll() is None and time() < deadline:
+                sleep(0.1)
+            if process.poll() is None:
+                logger.warning('Shard with pid {} didn\'t drain in {} '
+                               'sec.'.format(process.pid, self.drain_timeout),
+                               extra={'MESSAGE_ID': 'drain_timeout'})
+                process.kill()
+                process.wait()
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
+
+
+class MultiResourceEdgeDataBridge(object):
+
+    """Edge Bridge hosting pipelines of several resources
+
+    Resources are listed in ``resources`` option of ``main`` section either
+    as list of names or as mapping of name to options overriding ``main``
+    for that resource. Pipelines have own feeders, queues and worker pools
+    but share CouchDB connection pool and API clients budget.
+    """
+
+    def __init__(self, config):
+        super(MultiResourceEdgeDataBridge, self).__init__()
+        self.config = config
+        resources = self.config_get('resources')
+        if not resources:
+            raise DataBridgeConfigError('In config dictionary empty or missing'
+                                        ' \'resources\'')
+        if isinstance(resources, basestring):
+            resources = [r.strip() for r in resources.split(',')
+                         if r.strip()]
+        self.resources = sorted(resources) if isinstance(resources, dict)\
+            else list(resources)
+        self.couch_url = self.config_get('couch_url') or DEFAULTS['couch_url']
+        self.db_name = self.config_get('db_name') or DEFAULTS['db_name']
+        self.watch_interval = (self.config_get('watch_interval') or
+                               DEFAULTS['watch_interval'])
+        self.api_clients_budget = APIClientsBudget(
+            self.config_get('api_clients_max') or DEFAULTS['api_clients_max'])
+        # All pipelines talk to the same upstream, so they share its limit
+        self.rate_limiter = None
+        if self.config_get('rate_limit'):
+            self.rate_limiter = RateLimiter(
+                self.config_get('upstream_rate') or DEFAULTS['upstream_rate'],
+                self.config_get('upstream_rate_min') or
+                DEFAULTS['upstream_rate_min'],
+                self.config_get('upstream_rate_max') or
+                DEFAULTS['upstream_rate_max'])
+        self.process = psutil.Process(os.getpid())
+        self.stopping = Event()
+        self.registry = MetricsRegistry()
+        self.registry.add_collector(self.collect_metrics)
+        self.metrics_server = None
+        self.server = Server(self.couch_url,
+                             session=Session(retry_delays=range(10)))
+        prepare_couchdb(self.couch_url, self.db_name, logger)
+        self.db = self.server[self.db_name]
+        self.bridges = [
+            EdgeDataBridge(config, resource=resource, server=self.server,
+                           db=self.db,
+                           api_clients_budget=self.api_clients_budget,
+                           process=self.process,
+                           rate_limiter=self.rate_limiter,
+                           registry=self.registry)
+            for resource in self.resources
+        ]
+
+    def config_get(self, name):
+        try:
+            return self.config.get('main').get(name)
+        except AttributeError:
+            raise DataBridgeConfigError('In config dictionary missed section'
+                                        ' \'main\'')
+
+    def run(self):
+        logger.info('Start Edge Bridge for {}'.format(
+            ', '.join(self.resources)),
+            extra={'MESSAGE_ID': 'edge_bridge_start_bridge'})
+        for bridge in self.bridges:
+            bridge.start()
+        metrics_port = self.config_get('metrics_port')
+        if metrics_port:
+            self.metrics_server = self.registry.serve(
+                self.config_get('metrics_host') or DEFAULTS['metrics_host'],
+                metrics_port)
+        try:
+            while True:
+                for bridge in self.bridges:
+                    bridge.gevent_watcher()
+                logger.info('API clients budget used {} of {}'.format(
+                    self.api_clients_budget.used,
+                    self.api_clients_budget.limit),
+                    extra={'API_CLIENTS_BUDGET_USED':
+                           self.api_clients_budget.used})
+                if self.stopping.wait(self.watch_interval):
+                    self.drain()
+                    return
+        except (KeyboardInterrupt, SystemExit):
+            self.drain()
+            raise
+
+    def collect_metrics(self):
+        self.registry.gauge('edge_api_clients_budget_used',
+                            'API clients of all pipelines').labels().set(
+                                self.api_clients_budget.used)
+
+    def shutdown(self):
+        self.stopping.set()
+
+    def drain(self):
+        gevent.joinall([spawn(bridge.drain) for bridge in self.bridges])
+        if self.metrics_server is not None:
+            self.metrics_server.stop()
 
 
 def main():
     parser = argparse.ArgumentParser(description='---- Edge Bridge ----')
     parser.add_argument('config', type=str, help='Path to configuration file')
+    parser.add_argument('--shard', type=int, default=None,
+                        help='Number of shard to run (used by coordinator)')
     params = parser.parse_args()
     if os.path.isfile(params.config):
         with open(params.config) as config_file_obj:
             config = load(config_file_obj.read())
         logging.config.dictConfig(config)
-        EdgeDataBridge(config).run()
+        main_config = config.get('main', {})
+        if params.shard is not None:
+            bridge = EdgeDataBridge(config, shard=params.shard)
+        elif main_config.get('resources'):
+            bridge = MultiResourceEdgeDataBridge(config)
+        elif (main_config.get('shards') or DEFAULTS['shards']) > 1:
+            bridge = ShardedEdgeDataBridge(config, params.config)
+        else:
+            bridge = EdgeDataBridge(config)
+        # Drain pipelines instead of dying on deploy
+        gevent.signal(signal.SIGTERM, bridge.shutdown)
+        bridge.run()
 
 
 ##############################################################
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import logging
+from random import random
+from openprocurement.edge.latency import monotonic
+
+
+class EventSampler(object):
+
+    """Sampling and rate limit of hot path events, shared by pipeline
+
+    Events are told apart by MESSAGE_ID, or by template when they have
+    none. ``sample_rate`` of DEBUG events is passed, events of every level
+    are limited to ``rate`` per second of each kind.
+    """
+
+    def __init__(self, sample_rate=1, rate=None):
+        self.sample_rate = sample_rate
+        self.rate = rate
+        self.buckets = {}
+        self.suppressed = {}
+
+    def allow(self, key, level):
+        """Events suppressed since previous allowed one, None to suppress"""
+        if (level <= logging.DEBUG and self.sample_rate < 1 and
+                random() >= self.sample_rate):
+            return self._suppress(key)
+        if self.rate:
+            now = monotonic()
+            tokens, updated = self.buckets.get(key, (self.rate, now))
+            tokens = min(self.rate, tokens + (now - updated) * self.rate)
+            if tokens < 1:
+                self.buckets[key] = (tokens, now)
+                return self._suppress(key)
+            self.buckets[key] = (tokens - 1, now)
+        return self.suppressed.pop(key, 0)
+
+    def _suppress(self, key):
+        self.suppressed[key] = self.suppressed.get(key, 0) + 1
+        return None
+
+
+class EventLog(object):
+
+    """Events of one logger, formatted only when they are emitted
+
+    Template is formatted with ``str.format`` after level check and
+    sampling, so disabled per item events cost one level check. Keyword
+    arguments are passed in ``extra`` as structured fields. Number of
+    events suppressed by sampler is added as SUPPRESSED_EVENTS field.
+    """
+
+    def __init__(self, logger, sampler=None):
+        self.logger = logger
+        self.sampler = sampler
+
+    def enabled(self, level=logging.DEBUG):
+        """Check before computing costly event arguments"""
+        return self.logger.isEnabledFor(level)
+
+    def debug(self, message_id, template, *args, **fields):
+        if self.logger.isEnabledFor(logging.DEBUG):
+            self._emit(self.logger.debug, logging.DEBUG, message_id,
+                       template, args, fields)
+
+    def info(self, message_id, template, *args, **fields):
+        if self.logger.isEnabledFor(logging.INFO):
+            self._emit(self.logger.info, logging.INFO, message_id, template,
+                       args, fields)
+
+    def _emit(self, log, level, message_id, template, args, fields):
+        if self.sampler is not None:
+            suppressed = self.sampler.allow(message_id or template, level)
+            if suppressed is None:
+                return
+            if suppressed:
+                fields['SUPPRESSED_EVENTS'] = suppressed
+        if message_id is not None:
+            fields['MESSAGE_ID'] = message_id
+        message = template.format(*args)
+        if fields:
+            log(message, extra=fields)
+        else:
+            log(message)
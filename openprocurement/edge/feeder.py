@@ -0,0 +1,231 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import sys
+from couchdb import ResourceConflict
+from gevent import spawn
+from gevent.fileobject import FileObject
+from json import loads
+from zlib import crc32
+from openprocurement_client.exceptions import RequestFailed
+from openprocurement_client.sync import (
+    ResourceFeeder as BaseResourceFeeder
+)
+from openprocurement.edge.ratelimit import retry_after
+
+logger = logging.getLogger(__name__)
+
+CHECKPOINT_ID = '_local/feeder_{}'
+
+
+def shard_for(item_id, shards):
+    """Return number of shard owning resource item"""
+    return (crc32(item_id) & 0xffffffff) % shards
+
+
+class ResourceFeeder(BaseResourceFeeder):
+
+    """ResourceFeeder with durable feed checkpoints
+
+    Forward and backward offsets are stored together with the load balancer
+    cookies they belong to in a CouchDB ``_local`` document, which is neither
+    replicated nor indexed by views. When the feed is (re)started by
+    ``get_resource_items`` or retrievers are restarted after an error, the
+    checkpoint is restored, so the feeder continues from the last saved
+    position instead of walking the whole feed again.
+
+    Items fetched before saved offsets must not be lost when the process
+    crashes before they are saved. Feeder adds every fetched item to
+    ``unsaved`` and records the ones still unsaved in journal together with
+    each checkpoint, next start continues with them.
+
+    Responses of feed clients are written by ``recorder`` if given. Feed
+    requests share upstream ``rate_limiter`` with workers if given, so 429
+    responses to feed slow down the whole bridge.
+    """
+
+    def __init__(self, db=None, recorder=None, unsaved=None,
+                 rate_limiter=None, **kwargs):
+        super(ResourceFeeder, self).__init__(**kwargs)
+        self.db = db
+        self.recorder = recorder
+        self.unsaved = unsaved
+        self.rate_limiter = rate_limiter
+        self.checkpoint_id = CHECKPOINT_ID.format(self.resource)
+        self.checkpoint = None
+        self.backward_done = False
+
+    def get_resource_items(self):
+        # Retrievers of previous sync are still alive when feed is restarted
+        # after an error, stop them before continuing from checkpoint.
+        for worker in ('forward_worker', 'backward_worker'):
+            if getattr(self, worker, None) is not None:
+                getattr(self, worker).kill()
+        return super(ResourceFeeder, self).get_resource_items()
+
+    def init_api_clients(self):
+        # Called on every (re)start of retrievers with fresh params
+        super(ResourceFeeder, self).init_api_clients()
+        if self.recorder is not None:
+            self.recorder.attach(self.forward_client.session)
+            self.recorder.attach(self.backward_client.session)
+        if self.rate_limiter is not None:
+            self.limit_requests(self.forward_client)
+            self.limit_requests(self.backward_client)
+        if self.db is not None:
+            self.restore_checkpoint()
+
+    def limit_requests(self, client):
+        """Pass feed requests of ``client`` through rate limiter"""
+        sync_tenders = client.sync_tenders
+
+        def limited_sync_tenders(params):
+            self.rate_limiter.acquire()
+            try:
+                response = sync_tenders(params)
+            except RequestFailed as e:
+                # Retrievers back off on their own as well
+                if e.status_code == 429:
+                    self.rate_limiter.on_throttle(retry_after(e))
+                raise
+            self.rate_limiter.on_success()
+            return response
+        client.sync_tenders = limited_sync_tenders
+
+    def handle_response_data(self, data):
+        if self.unsaved is not None:
+            for resource_item in data:
+                self.unsaved.add(resource_item['id'],
+                                 resource_item['dateModified'])
+        super(ResourceFeeder, self).handle_response_data(data)
+
+    def load_checkpoint(self):
+        try:
+            return self.db.get(self.checkpoint_id)
+        except Exception as e:
+            logger.error('Feeder: error while loading checkpoint {}: '
+                         '{}'.format(self.checkpoint_id, repr(e)),
+                         extra={'MESSAGE_ID': 'exceptions'})
+
+    def restore_checkpoint(self):
+        # Last saved checkpoint is kept in memory after first load
+        if self.checkpoint is None:
+            self.checkpoint = self.load_checkpoint()
+        if not self.checkpoint or not self.checkpoint.get('forward_offset'):
+            logger.info('Feeder: checkpoint {} not found, start sync from '
+                        'scratch.'.format(self.checkpoint_id))
+            return
+        self.forward_params['offset'] = self.checkpoint['forward_offset']
+        if self.checkpoint.get('backward_offset'):
+            self.backward_params['offset'] = self.checkpoint['backward_offset']
+        self.backward_done = self.checkpoint.get('backward_done', False)
+        self.cookies.update(self.checkpoint.get('cookies', {}))
+        logger.info('Feeder: restored checkpoint forward offset {}, backward '
+                    'offset {}, backward done {}'.format(
+                        self.forward_params.get('offset'),
+                        self.backward_params.get('offset'),
+                        self.backward_done),
+                    extra={'MESSAGE_ID': 'feeder_checkpoint_restored'})
+
+    def save_checkpoint(self, journal=None):
+        """Save current offsets, unsaved items fetched before are journaled
+
+        Unsaved items are recorded first, retrievers can't advance offsets
+        in between as nothing here switches greenlets before ``db.save``.
+        """
+        if self.db is None or not hasattr(self, 'forward_params'):
+            return
+        if not self.forward_params.get('offset'):
+            return
+        checkpoint = dict(self.checkpoint or {'_id': self.checkpoint_id})
+        checkpoint.update({
+            'forward_offset': self.forward_params.get('offset'),
+            'backward_offset': self.backward_params.get('offset'),
+            'backward_done': self.backward_done,
+            'cookies': self.cookies.get_dict()
+        })
+        if self.unsaved is not None and journal is not None:
+            try:
+                journal.checkpoint(self.unsaved.refs())
+            except Exception as e:
+                logger.error('Feeder: error while journaling {} unsaved items,'
+                             ' checkpoint isn\'t saved: {}'.format(
+                                 len(self.unsaved), repr(e)),
+                             extra={'MESSAGE_ID': 'exceptions'})
+                return
+        try:
+            self.db.save(checkpoint)
+            self.checkpoint = checkpoint
+            logger.debug('Feeder: saved checkpoint, forward offset {}, '
+                         'backward offset {}'.format(
+                             checkpoint['forward_offset'],
+                             checkpoint['backward_offset']))
+        except ResourceConflict:
+            # Checkpoint was changed by someone else, load actual revision on
+            # next save.
+            self.checkpoint = self.load_checkpoint()
+        except Exception as e:
+            logger.error('Feeder: error while saving checkpoint {}: '
+                         '{}'.format(self.checkpoint_id, repr(e)),
+                         extra={'MESSAGE_ID': 'exceptions'})
+
+    def start_sync(self):
+        if not self.forward_params.get('offset'):
+            self.backward_done = False
+            return super(ResourceFeeder, self).start_sync()
+        # Offsets are restored from checkpoint, so initial backward request
+        # is not needed.
+        if self.backward_done:
+            self.backward_worker = spawn(lambda: 0)
+        else:
+            self.backward_worker = spawn(self.retriever_backward)
+        self.forward_worker = spawn(self.retriever_forward)
+
+    def retriever_backward(self):
+        result = super(ResourceFeeder, self).retriever_backward()
+        self.backward_done = result == 0
+        return result
+
+    def stop(self):
+        """Stop retrievers and return items fetched but not consumed
+
+        Saved checkpoint is already past them, they are journaled.
+        """
+        for worker in ('forward_worker', 'backward_worker'):
+            if getattr(self, worker, None) is not None:
+                getattr(self, worker).kill()
+        resource_items = []
+        while not self.queue.empty():
+            resource_items.append(self.queue.get())
+        return resource_items
+
+
+class ShardFeeder(object):
+
+    """Feeds resource items routed to shard process by coordinator
+
+    Coordinator writes one JSON encoded feed item per line to stdin of shard
+    process. When coordinator exits the stream is closed and shard stops.
+    """
+
+    def __init__(self, stream=None):
+        self.stream = stream
+
+    def get_resource_items(self):
+        if self.stream is None:
+            self.stream = FileObject(sys.stdin, 'rb')
+        for line in self.stream:
+            yield loads(line)
+        logger.info('Feeder: coordinator closed shard stream, stop shard.',
+                    extra={'MESSAGE_ID': 'shard_stream_closed'})
+        raise SystemExit(0)
+
+    def save_checkpoint(self, journal=None):
+        # Feed position is checkpointed by coordinator
+        pass
+
+    def stop(self):
+        # Items not read from stream yet are left to coordinator
+        return []
@@ -0,0 +1,83 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import OrderedDict
+from jsonpatch import apply_patch, make_patch
+
+logger = logging.getLogger(__name__)
+
+# Fields of stored revision which are not part of the document itself
+SERVICE_FIELDS = ('_id', '_rev', '_revisions', 'doc_type', 'patch')
+
+
+class RevisionsCache(object):
+
+    """Bounded LRU cache of full revisions: (id, rev) -> document
+
+    Workers of historical mode take previous revision from here to encode
+    the next one as a patch, without reading it back from CouchDB.
+    """
+
+    def __init__(self, size=100):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, item_id, rev):
+        doc = self.items.pop((item_id, int(rev)), None)
+        if doc is not None:
+            self.items[(item_id, int(rev))] = doc
+        return doc
+
+    def put(self, item_id, rev, doc):
+        self.items.pop((item_id, int(rev)), None)
+        self.items[(item_id, int(rev))] = doc
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
+
+
+def is_snapshot_rev(rev, interval):
+    """Every ``interval`` revisions starting from the first are stored full"""
+    return (int(rev) - 1) % interval == 0
+
+
+def strip_service_fields(doc):
+    return dict((k, v) for k, v in doc.items() if k not in SERVICE_FIELDS)
+
+
+def make_delta(previous, resource_item):
+    """Stored form of ``resource_item`` as patch against ``previous``"""
+    return {
+        'id': resource_item['id'],
+        'rev': resource_item['rev'],
+        'patch': make_patch(strip_service_fields(previous),
+                            strip_service_fields(resource_item)).patch
+    }
+
+
+def rebuild_revision(db, item_id, rev, interval):
+    """Rebuild full document of revision ``rev`` of item ``item_id``
+
+    Revision and up to ``interval`` - 1 revisions before it are read with
+    one ``_all_docs`` request, the nearest full revision is patched forward.
+    Returns None when revision or part of its patch chain is missing.
+    """
+    rev = int(rev)
+    revs = range(max(rev - interval + 1, 1), rev + 1)
+    rows = db.view('_all_docs', include_docs=True, keys=[
+        '{}-{}'.format(item_id, r) for r in revs])
+    docs = [row.get('doc') for row in rows]
+    for start in xrange(len(docs) - 1, -1, -1):
+        if docs[start] is None:
+            return None
+        if 'patch' not in docs[start]:
+            break
+    else:
+        logger.error('No full revision of {} found before {}'.format(
+            item_id, rev), extra={'MESSAGE_ID': 'exceptions'})
+        return None
+    doc = strip_service_fields(docs[start])
+    for delta in docs[start + 1:]:
+        doc = apply_patch(doc, delta['patch'])
+    return doc
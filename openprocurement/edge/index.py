@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import logging
+from time import time
+
+logger = logging.getLogger(__name__)
+
+
+class ResourceItemsIndex(object):
+
+    """In-process index of local documents: id -> (dateModified, _rev)
+
+    Values are kept in two plain lists addressed by position, the only
+    per-document overhead besides the strings themselves is one dict slot
+    and two list slots. The index is bootstrapped once from the
+    ``by_dateModified`` view and ``_all_docs`` and then kept up to date from
+    ``_bulk_docs`` results, so checking whether a document must be fetched
+    does not need a request to CouchDB.
+    """
+
+    __slots__ = ('positions', 'dates', 'revs')
+
+    def __init__(self):
+        self.positions = {}
+        self.dates = []
+        self.revs = []
+
+    def __len__(self):
+        return len(self.positions)
+
+    def __contains__(self, item_id):
+        return item_id in self.positions
+
+    def get(self, item_id):
+        """Return (dateModified, _rev) tuple or None for unknown document"""
+        position = self.positions.get(item_id)
+        if position is None:
+            return None
+        return self.dates[position], self.revs[position]
+
+    def date_modified(self, item_id):
+        position = self.positions.get(item_id)
+        if position is None:
+            return None
+        return self.dates[position]
+
+    def update(self, item_id, date_modified=None, rev=None):
+        position = self.positions.get(item_id)
+        if position is None:
+            self.positions[item_id] = len(self.dates)
+            self.dates.append(date_modified)
+            self.revs.append(rev)
+            return
+        if date_modified is not None:
+            self.dates[position] = date_modified
+        if rev is not None:
+            self.revs[position] = rev
+
+    def load_revs(self, db, ids):
+        for row in db.view('_all_docs', keys=ids):
+            if 'error' not in row:
+                self.update(row['id'], rev=row['value']['rev'])
+
+    def refresh(self, db, item_id):
+        """Reload single entry from CouchDB after failed save"""
+        doc = db.get(item_id)
+        if doc:
+            self.update(item_id, doc.get('dateModified'), doc['_rev'])
+
+    def bootstrap(self, db, view_path, batch=10000, accept=None):
+        """Load index, ``accept`` predicate limits it to subset of ids
+
+        Only documents of the resource view are loaded, revisions of each
+        ``batch`` of them are requested from ``_all_docs`` by keys, so other
+        documents of shared database are never read.
+        """
+        start = time()
+        ids = []
+        for row in db.iterview(view_path, batch):
+            if accept is None or accept(row.id):
+                self.update(row.id, date_modified=row.key)
+                ids.append(row.id)
+                if len(ids) >= batch:
+                    self.load_revs(db, ids)
+                    ids = []
+        if ids:
+            self.load_revs(db, ids)
+        end = time() - start
+        logger.info('Index bootstrapped with {} docs in {} sec.'.format(
+            len(self), round(end, 3)),
+            extra={'INDEX_SIZE': len(self),
+                   'INDEX_BOOTSTRAP_DURATION': end * 1000})
@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+
+FIELDS = ('id', 'dateModified', 'rev', 'doc', 'timeout', 'retries_count')
+
+
+def compact_str(value, intern_value=False):
+    """ASCII unicode as byte string, a quarter of its size in memory
+
+    Strings compare and hash equal to unicode they were made of, so they
+    are interchangeable as dict keys and in comparisons.
+    """
+    if isinstance(value, unicode):
+        try:
+            value = value.encode('ascii')
+        except UnicodeEncodeError:
+            return value
+    if intern_value and isinstance(value, str):
+        value = intern(value)
+    return value
+
+
+class QueueItem(object):
+
+    """Resource item queued for fetching
+
+    Millions of items pass through queues every day, so fields are kept in
+    slots instead of per-item dict. Ids are interned: items of the same
+    document in different queues share one id string. Field set to None
+    is absent, dict-style access of the pipeline works as with dict items.
+    """
+
+    __slots__ = FIELDS
+    __hash__ = None
+
+    def __init__(self, id, dateModified=None, rev=None, doc=None):
+        self.id = compact_str(id, intern_value=True)
+        self.dateModified = compact_str(dateModified)
+        self.rev = rev
+        self.doc = doc
+        self.timeout = None
+        self.retries_count = None
+
+    @classmethod
+    def from_item(cls, resource_item):
+        """Queue item of feed, journal or spilled dict item"""
+        queue_item = cls(resource_item['id'],
+                         resource_item.get('dateModified'),
+                         resource_item.get('rev'), resource_item.get('doc'))
+        queue_item.timeout = resource_item.get('timeout')
+        queue_item.retries_count = resource_item.get('retries_count')
+        return queue_item
+
+    @classmethod
+    def for_retry(cls, resource_item):
+        """Item to fetch the same version again, retry state starts over"""
+        return cls(resource_item['id'], resource_item.get('dateModified'),
+                   resource_item.get('rev'))
+
+    def __getitem__(self, key):
+        try:
+            return getattr(self, key)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __setitem__(self, key, value):
+        try:
+            setattr(self, key, value)
+        except AttributeError:
+            raise KeyError(key)
+
+    def __contains__(self, key):
+        return getattr(self, key, None) is not None
+
+    def get(self, key, default=None):
+        value = getattr(self, key, None)
+        return default if value is None else value
+
+    def keys(self):
+        return [key for key in FIELDS if getattr(self, key) is not None]
+
+    def items(self):
+        return [(key, getattr(self, key)) for key in self.keys()]
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self.keys())
+
+    def __eq__(self, other):
+        if not isinstance(other, (QueueItem, dict)):
+            return NotImplemented
+        return dict(self.items()) == dict(
+            (key, value) for key, value in other.items() if value is not None)
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    def __repr__(self):
+        return 'QueueItem({!r})'.format(dict(self.items()))
@@ -0,0 +1,170 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import os
+from collections import OrderedDict
+from json import dumps, loads
+
+logger = logging.getLogger(__name__)
+
+# Fields enough to fetch resource item again
+REF_FIELDS = ('id', 'dateModified', 'rev')
+
+
+class Journal(object):
+
+    """Write-ahead journal of resource items which aren't saved yet
+
+    Bulk writer calls ``begin`` with items of bulk before sending it to
+    CouchDB and ``done`` when the request is over, bridge calls ``begin``
+    with items left in queues when it is drained on shutdown. Records are
+    appended to file as JSON lines, ``begin`` is synced to disk, so items
+    of bulks in flight survive even a crash of the process. ``checkpoint``
+    replaces items recorded with previous feed checkpoint. ``recover``
+    returns items begun but not done together with checkpointed ones and
+    empties the journal, it is called before the bridge starts writing.
+    File is rewritten with pending items only after every
+    ``compact_records`` records.
+    """
+
+    def __init__(self, path, compact_records=10000):
+        self.path = path
+        self.compact_records = compact_records
+        self.pending = OrderedDict()  # (id, version) -> item ref
+        self.checkpointed = []
+        self.records = 0
+        self.file = None
+
+    @staticmethod
+    def ref(resource_item):
+        return dict((field, resource_item[field]) for field in REF_FIELDS
+                    if field in resource_item)
+
+    @staticmethod
+    def key(ref):
+        return ref['id'], ref.get('rev', ref.get('dateModified'))
+
+    def _open(self):
+        if self.file is None:
+            self.file = open(self.path, 'ab')
+
+    def _append(self, record, sync=False):
+        self._open()
+        self.file.write(dumps(record) + '\n')
+        self.file.flush()
+        if sync:
+            os.fsync(self.file.fileno())
+        self.records += 1
+        if self.records >= self.compact_records:
+            self.compact()
+
+    def begin(self, resource_items):
+        refs = [self.ref(resource_item) for resource_item in resource_items]
+        if not refs:
+            return
+        for ref in refs:
+            self.pending[self.key(ref)] = ref
+        self._append(['+', refs], sync=True)
+
+    def done(self, resource_items):
+        keys = [self.key(self.ref(resource_item))
+                for resource_item in resource_items]
+        for key in keys:
+            self.pending.pop(key, None)
+        self._append(['-', keys])
+
+    def checkpoint(self, resource_items):
+        """Record items fetched before feed checkpoint and not saved yet
+
+        File is rewritten, so it doesn't grow with every checkpoint.
+        """
+        self.checkpointed = [self.ref(resource_item)
+                             for resource_item in resource_items]
+        self.compact()
+
+    def compact(self):
+        self.close()
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, 'wb') as tmp:
+            if self.pending:
+                tmp.write(dumps(['+', self.pending.values()]) + '\n')
+            if self.checkpointed:
+                tmp.write(dumps(['=', self.checkpointed]) + '\n')
+            tmp.flush()
+            os.fsync(tmp.fileno())
+        os.rename(tmp_path, self.path)
+        self.records = 0
+
+    def recover(self):
+        """Items begun but not done or checkpointed by previous run"""
+        self.pending = OrderedDict()
+        checkpointed = []
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as journal:
+                for line in journal:
+                    if not line.endswith('\n'):
+                        # Record was written partially
+                        break
+                    op, values = loads(line)
+                    if op == '+':
+                        for ref in values:
+                            self.pending[self.key(ref)] = ref
+                    elif op == '=':
+                        checkpointed = values
+                    else:
+                        for key in values:
+                            self.pending.pop(tuple(key), None)
+        for ref in checkpointed:
+            self.pending.setdefault(self.key(ref), ref)
+        items = self.pending.values()
+        self.pending = OrderedDict()
+        self.checkpointed = []
+        self.compact()
+        return items
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+
+class UnsavedItems(object):
+
+    """Feed items fetched but not kept in local db yet, id -> dateModified
+
+    Feeder adds items before it queues them, so every item fetched before
+    current feed offsets is either here or already saved. Items saved or
+    skipped as not newer than local documents are pruned by index, items
+    which will never be saved (archived, dropped after retries) are settled
+    by workers. Newer version of an item replaces older one.
+    """
+
+    def __init__(self):
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def add(self, item_id, date_modified):
+        self.items[item_id] = date_modified
+
+    def settle(self, item_id, date_modified=None):
+        """Forget item unless its newer version was fetched meanwhile"""
+        current = self.items.get(item_id)
+        if item_id in self.items and (date_modified is None or
+                                      current is None or
+                                      current <= date_modified):
+            del self.items[item_id]
+
+    def prune(self, index):
+        for item_id, date_modified in self.items.items():
+            local_date_modified = index.date_modified(item_id)
+            if (local_date_modified is not None and
+                    local_date_modified >= date_modified):
+                del self.items[item_id]
+
+    def refs(self):
+        return [{'id': item_id, 'dateModified': date_modified}
+                for item_id, date_modified in self.items.items()]
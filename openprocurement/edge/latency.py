@@ -0,0 +1,101 @@
+# -*- coding: utf-8 -*-
+import math
+from collections import deque
+
+try:
+    from time import monotonic
+except ImportError:
+    # Python 2 has no monotonic clock. Elapsed time of os.times() ticks in
+    # 10 ms, too coarse for stage spans and request pacing, so
+    # CLOCK_MONOTONIC is read from libc when it's available.
+    import ctypes
+    import sys
+    from os import times
+
+    class timespec(ctypes.Structure):
+        _fields_ = [('tv_sec', ctypes.c_long), ('tv_nsec', ctypes.c_long)]
+
+    CLOCK_MONOTONIC = 6 if sys.platform == 'darwin' else 1
+
+    def _clock_gettime():
+        # Before glibc 2.17 clock_gettime lives in librt
+        for name in (None, 'librt.so.1'):
+            try:
+                clock_gettime = ctypes.CDLL(name, use_errno=True).clock_gettime
+            except (OSError, AttributeError):
+                continue
+            clock_gettime.argtypes = [ctypes.c_int, ctypes.POINTER(timespec)]
+            if clock_gettime(CLOCK_MONOTONIC, ctypes.byref(timespec())) == 0:
+                return clock_gettime
+
+    clock_gettime = _clock_gettime()
+
+    if clock_gettime is not None:
+        def monotonic():
+            t = timespec()
+            clock_gettime(CLOCK_MONOTONIC, ctypes.byref(t))
+            return t.tv_sec + t.tv_nsec * 1e-9
+    else:
+        def monotonic():
+            return times()[4]
+
+
+def percentile(values, q):
+    """Nearest-rank percentile ``q`` of sorted ``values``"""
+    if not values:
+        return 0
+    rank = int(math.ceil(q / 100.0 * len(values))) - 1
+    return values[min(max(rank, 0), len(values) - 1)]
+
+
+class LatencyStats(object):
+
+    """Request durations of one API client over sliding time window
+
+    Samples are kept in ring buffer of ``size`` (monotonic time, duration)
+    pairs, so memory is fixed whatever request rate is. Samples older than
+    ``window`` seconds are dropped from the head of buffer when percentiles
+    are calculated. ``count`` and ``throttled`` are totals of requests and
+    of 429 answers among them, they aren't cleared by ``reset``.
+    """
+
+    __slots__ = ('window', 'samples', 'started', 'count', 'throttled')
+
+    def __init__(self, size=1000, window=300):
+        self.window = window
+        self.samples = deque(maxlen=size)
+        self.started = monotonic()
+        self.count = 0
+        self.throttled = 0
+
+    def __len__(self):
+        return len(self.samples)
+
+    def add(self, duration):
+        self.samples.append((monotonic(), duration))
+        self.count += 1
+
+    def throttle(self):
+        self.throttled += 1
+
+    def reset(self):
+        self.samples.clear()
+        self.started = monotonic()
+
+    @property
+    def grown(self):
+        """Client is observed for whole window"""
+        return monotonic() - self.started >= self.window
+
+    def prune(self):
+        oldest = monotonic() - self.window
+        while self.samples and self.samples[0][0] < oldest:
+            self.samples.popleft()
+
+    def durations(self):
+        self.prune()
+        return sorted(duration for _, duration in self.samples)
+
+    def percentiles(self, *qs):
+        durations = self.durations()
+        return tuple(percentile(durations, q) for q in qs)
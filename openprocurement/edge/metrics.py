@@ -0,0 +1,256 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+from bisect import bisect_left
+from collections import OrderedDict
+from gevent.pywsgi import WSGIServer
+
+logger = logging.getLogger(__name__)
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+# Seconds, from CouchDB round trip to slow public API answer
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10,
+                   30)
+# Items in send_bulk check or in _bulk_docs request
+SIZE_BUCKETS = (1, 5, 10, 25, 50, 100, 250, 500, 1000)
+
+
+def format_value(value):
+    if isinstance(value, float):
+        if value == float('inf'):
+            return '+Inf'
+        return repr(value)
+    return str(value)
+
+
+def format_labels(names, values):
+    if not names:
+        return ''
+    return '{' + ','.join(
+        '{}="{}"'.format(name, unicode(value).replace('\\', '\\\\').replace(
+            '"', '\\"').replace('\n', '\\n').encode('utf-8'))
+        for name, value in zip(names, values)) + '}'
+
+
+class Value(object):
+
+    """Value of counter or gauge with one set of label values"""
+
+    __slots__ = ('value',)
+
+    def __init__(self):
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def set(self, value):
+        # Counters kept elsewhere are copied by collectors
+        self.value = value
+
+
+class HistogramValue(object):
+
+    """Observations counted by bucket, cumulated when rendered"""
+
+    __slots__ = ('buckets', 'counts', 'sum', 'count')
+
+    def __init__(self, buckets):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+
+class Metric(object):
+
+    """Metric family, values are kept by tuple of label values"""
+
+    def __init__(self, name, help, kind, labelnames=(), buckets=None):
+        self.name = name
+        self.help = help
+        self.kind = kind
+        self.labelnames = tuple(labelnames)
+        self.buckets = buckets
+        self.values = OrderedDict()
+
+    def labels(self, *labelvalues):
+        value = self.values.get(labelvalues)
+        if value is None:
+            if self.kind == 'histogram':
+                value = HistogramValue(self.buckets)
+            else:
+                value = Value()
+            self.values[labelvalues] = value
+        return value
+
+    def clear(self, *labelvalues):
+        """Forget values with labels starting with ``labelvalues``"""
+        for key in self.values.keys():
+            if key[:len(labelvalues)] == labelvalues:
+                del self.values[key]
+
+    def render(self, lines):
+        lines.append('# HELP {} {}'.format(self.name, self.help))
+        lines.append('# TYPE {} {}'.format(self.name, self.kind))
+        for labelvalues, value in self.values.items():
+            if self.kind != 'histogram':
+                lines.append('{}{} {}'.format(
+                    self.name, format_labels(self.labelnames, labelvalues),
+                    format_value(value.value)))
+                continue
+            names = self.labelnames + ('le',)
+            cumulative = 0
+            for bound, count in zip(self.buckets + (float('inf'),),
+                                    value.counts):
+                cumulative += count
+                lines.append('{}_bucket{} {}'.format(
+                    self.name, format_labels(
+                        names, labelvalues + (format_value(bound),)),
+                    cumulative))
+            labels = format_labels(self.labelnames, labelvalues)
+            lines.append('{}_sum{} {}'.format(self.name, labels,
+                                              format_value(value.sum)))
+            lines.append('{}_count{} {}'.format(self.name, labels,
+                                                value.count))
+
+
+class MetricsRegistry(object):
+
+    """Metrics of bridge process in Prometheus text format
+
+    Hot path only increments counters and histogram buckets. Values the
+    bridge already keeps elsewhere, like queue sizes and API clients, are
+    copied by ``collectors`` when metrics are scraped. Registry is WSGI
+    application serving them on ``/metrics``.
+    """
+
+    def __init__(self):
+        self.metrics = OrderedDict()
+        self.collectors = []
+
+    def metric(self, name, help, kind, labelnames=(), buckets=None):
+        # Pipelines of several resources share families
+        metric = self.metrics.get(name)
+        if metric is None:
+            metric = Metric(name, help, kind, labelnames, buckets)
+            self.metrics[name] = metric
+        return metric
+
+    def counter(self, name, help, labelnames=()):
+        return self.metric(name, help, 'counter', labelnames)
+
+    def gauge(self, name, help, labelnames=()):
+        return self.metric(name, help, 'gauge', labelnames)
+
+    def histogram(self, name, help, labelnames=(), buckets=LATENCY_BUCKETS):
+        return self.metric(name, help, 'histogram', labelnames,
+                           tuple(buckets))
+
+    def add_collector(self, collector):
+        self.collectors.append(collector)
+
+    def render(self):
+        for collector in self.collectors:
+            try:
+                collector()
+            except Exception as e:
+                logger.error('Metrics collector error: {}'.format(repr(e)),
+                             extra={'MESSAGE_ID': 'exceptions'})
+        lines = []
+        for metric in self.metrics.values():
+            metric.render(lines)
+        return '\n'.join(lines) + '\n'
+
+    def __call__(self, environ, start_response):
+        if environ.get('PATH_INFO') not in ('/', '/metrics'):
+            start_response('404 Not Found', [('Content-Type', 'text/plain')])
+            return ['Not Found']
+        body = self.render()
+        start_response('200 OK', [('Content-Type', CONTENT_TYPE),
+                                  ('Content-Length', str(len(body)))])
+        return [body]
+
+    def serve(self, host, port):
+        server = WSGIServer((host, port), self, log=None)
+        server.start()
+        logger.info('Serve metrics on {}:{}'.format(host, server.server_port),
+                    extra={'MESSAGE_ID': 'metrics_server_start'})
+        return server
+
+
+class PipelineMetrics(object):
+
+    """Metrics updated by workers and writer of one resource pipeline
+
+    Values are bound to resource label once, so updates cost an attribute
+    lookup and an addition. Without registry metrics are kept, but not
+    served.
+    """
+
+    def __init__(self, registry=None, resource=''):
+        registry = registry or MetricsRegistry()
+        self.resource = resource
+        self.upstream_request = registry.histogram(
+            'edge_upstream_request_seconds',
+            'Duration of resource item requests to public API',
+            ('resource',)).labels(resource)
+        self.upstream_throttled = registry.counter(
+            'edge_upstream_throttled_total',
+            'Requests to public API answered with 429',
+            ('resource',)).labels(resource)
+        self.send_bulk = registry.histogram(
+            'edge_send_bulk_seconds',
+            'Duration of checking feed items against local index',
+            ('resource',)).labels(resource)
+        self.send_bulk_size = registry.histogram(
+            'edge_send_bulk_items', 'Feed items checked at once',
+            ('resource',), SIZE_BUCKETS).labels(resource)
+        self.bulk_docs = registry.histogram(
+            'edge_bulk_docs_seconds', 'Duration of _bulk_docs requests',
+            ('resource',)).labels(resource)
+        self.bulk_docs_size = registry.histogram(
+            'edge_bulk_docs_items', 'Documents in _bulk_docs request',
+            ('resource',), SIZE_BUCKETS).labels(resource)
+        self.saved = registry.counter(
+            'edge_documents_saved_total', 'Documents saved to CouchDB',
+            ('resource', 'result'))
+        self.created = self.saved.labels(resource, 'created')
+        self.updated = self.saved.labels(resource, 'updated')
+        self.skipped = registry.counter(
+            'edge_documents_skipped_total',
+            'Resource items not saved as local document is up to date',
+            ('resource', 'stage'))
+        self.retried = registry.counter(
+            'edge_documents_retried_total', 'Resource items put to retry',
+            ('resource', 'reason'))
+        self.dropped = registry.counter(
+            'edge_documents_dropped_total',
+            'Resource items dropped after last retry',
+            ('resource',)).labels(resource)
+
+    def skip(self, stage):
+        self.skipped.labels(self.resource, stage).inc()
+
+    def retry(self, reason):
+        self.retried.labels(self.resource, reason).inc()
+
+    def totals(self):
+        """Documents counted so far by outcome, all stages and reasons"""
+        totals = {'created': self.created.value,
+                  'updated': self.updated.value,
+                  'dropped': self.dropped.value}
+        for name, metric in (('skipped', self.skipped),
+                             ('retried', self.retried)):
+            totals[name] = sum(value.value for labels, value in
+                               metric.values.items()
+                               if labels[0] == self.resource)
+        return totals
@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+from collections import OrderedDict
+from gevent.event import Event
+from gevent.queue import Empty, Full
+from time import time
+
+
+def item_key(resource_item):
+    # Revisions of historical mode are different documents
+    if 'rev' in resource_item:
+        return resource_item['id'], resource_item['rev']
+    return resource_item['id']
+
+
+def is_newer(resource_item, pending_item):
+    date_modified = resource_item.get('dateModified')
+    if date_modified is None:
+        return False
+    pending_date_modified = pending_item.get('dateModified')
+    return pending_date_modified is None or\
+        date_modified > pending_date_modified
+
+
+class CoalescingQueue(object):
+
+    """FIFO queue of resource items keyed by document id
+
+    Item put while another item with the same id is pending doesn't take a
+    new place in the queue: the pending item is replaced in place when the
+    new one has newer ``dateModified`` and the new one is dropped otherwise.
+    So every document is fetched once per burst of changes; ``coalesced``
+    counts fetches saved this way, ``got`` counts items taken from queue.
+
+    Has the same interface as ``gevent.queue.Queue``, ``maxsize`` of -1 or
+    None means unbounded queue.
+    """
+
+    def __init__(self, maxsize=None):
+        self.maxsize = maxsize if maxsize > 0 else None
+        self.items = OrderedDict()
+        self.coalesced = 0
+        self.got = 0
+        self.not_empty = Event()
+        self.not_full = Event()
+        self.not_full.set()
+
+    def qsize(self):
+        return len(self.items)
+
+    def empty(self):
+        return not self.items
+
+    def full(self):
+        return self.maxsize is not None and len(self.items) >= self.maxsize
+
+    def put(self, item, block=True, timeout=None):
+        key = item_key(item)
+        deadline = None if timeout is None else time() + timeout
+        while 1:
+            pending_item = self.items.get(key)
+            if pending_item is not None:
+                self.coalesced += 1
+                if is_newer(item, pending_item):
+                    # Assignment to existing key keeps its position
+                    self.items[key] = item
+                return
+            if not self.full():
+                break
+            if not block:
+                raise Full
+            self.not_full.clear()
+            wait = None if deadline is None else max(deadline - time(), 0)
+            if not self.not_full.wait(wait) and deadline is not None:
+                raise Full
+        self.items[key] = item
+        self.not_empty.set()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while not self.items:
+            if not block:
+                raise Empty
+            self.not_empty.clear()
+            wait = None if deadline is None else max(deadline - time(), 0)
+            if not self.not_empty.wait(wait) and deadline is not None:
+                raise Empty
+        _, item = self.items.popitem(last=False)
+        self.got += 1
+        self.not_full.set()
+        return item
+
+    def get_nowait(self):
+        return self.get(block=False)
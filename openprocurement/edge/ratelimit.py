@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+from email.utils import mktime_tz, parsedate_tz
+from gevent import sleep
+from time import time
+from openprocurement.edge.latency import monotonic
+
+
+def retry_after(exc):
+    """Seconds from ``Retry-After`` header of failed request or None"""
+    headers = getattr(getattr(exc, 'response', None), 'headers', None)
+    value = headers.get('Retry-After') if headers else None
+    if not value:
+        return None
+    try:
+        return max(float(value), 0)
+    except ValueError:
+        date = parsedate_tz(value)
+        if date is None:
+            return None
+        return max(mktime_tz(date) - time(), 0)
+
+
+class RateLimiter(object):
+
+    """Token bucket shared by all API clients of the bridge
+
+    Rate is adjusted by AIMD: every successful request adds ``increase`` /
+    rate, so rate grows by about ``increase`` requests/sec every second,
+    429 answer multiplies it by ``decrease`` (at most once per second, so a
+    burst of 429 to requests sent before the cut counts once). When 429
+    carries ``Retry-After`` nobody sends requests until it passes.
+
+    Refill is timed by ``latency.monotonic``, which has sub-millisecond
+    resolution on Python 2 too, so rates above 100 requests/sec are paced
+    evenly rather than in bursts at clock ticks.
+    """
+
+    def __init__(self, rate=10, rate_min=1, rate_max=100, increase=1.0,
+                 decrease=0.5):
+        self.rate = float(rate)
+        self.rate_min = rate_min
+        self.rate_max = rate_max
+        self.increase = increase
+        self.decrease = decrease
+        self.tokens = 1.0
+        self.updated = monotonic()
+        self.blocked_until = 0
+        self.decreased = None
+
+    def _refill(self, now):
+        # Bucket holds at most one second of requests
+        self.tokens = min(self.tokens + (now - self.updated) * self.rate,
+                          max(self.rate, 1.0))
+        self.updated = now
+
+    def acquire(self):
+        """Wait for permission to send one request"""
+        while True:
+            now = monotonic()
+            if now < self.blocked_until:
+                sleep(self.blocked_until - now)
+                continue
+            self._refill(now)
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            sleep((1 - self.tokens) / self.rate)
+
+    def on_success(self):
+        self.rate = min(self.rate + self.increase / self.rate, self.rate_max)
+
+    def on_throttle(self, retry_after=None):
+        now = monotonic()
+        if retry_after:
+            self.blocked_until = max(self.blocked_until, now + retry_after)
+            self.tokens = 0.0
+        if self.decreased is not None and now - self.decreased < 1:
+            return
+        self.rate = max(self.rate * self.decrease, self.rate_min)
+        self.decreased = now
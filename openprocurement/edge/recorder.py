@@ -0,0 +1,115 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import glob
+import gzip
+import logging
+import os
+import zlib
+from json import dumps, loads
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Response headers needed to replay conditional requests, sticky backends
+# and throttling
+RECORDED_HEADERS = ('Content-Type', 'ETag', 'Retry-After', 'Set-Cookie')
+
+SEGMENT_PATTERN = '*.jsonl.gz'
+
+
+class TrafficRecorder(object):
+
+    """Writes upstream responses seen by the bridge to segment files
+
+    ``record`` is a response hook of ``requests`` session, every response is
+    written as a line of JSON with time it was received, its latency,
+    request path and response status, headers and body. Lines are appended
+    to gzip compressed segment files in ``directory``, a new segment is
+    started after ``segment_bytes`` of uncompressed records. Segment is
+    flushed every ``flush_interval`` seconds, so records written before a
+    crash are readable. Segment names sort in order of recording.
+    """
+
+    def __init__(self, directory, prefix='upstream', segment_bytes=67108864,
+                 flush_interval=1):
+        self.directory = directory
+        self.prefix = '{}-{}-{}'.format(prefix, int(time()), os.getpid())
+        self.segment_bytes = segment_bytes
+        self.flush_interval = flush_interval
+        self.segment = None
+        self.segment_number = 0
+        self.written = 0
+        self.flushed_at = 0
+        self.records = 0
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def open_segment(self):
+        self.close()
+        self.segment_number += 1
+        path = os.path.join(self.directory, '{}-{:06d}.jsonl.gz'.format(
+            self.prefix, self.segment_number))
+        self.segment = gzip.open(path, 'wb')
+        self.written = 0
+        logger.info('Recording upstream traffic to {}'.format(path),
+                    extra={'MESSAGE_ID': 'record_segment'})
+
+    def record(self, response, *args, **kwargs):
+        request = response.request
+        line = dumps({
+            'time': time(),
+            'elapsed': response.elapsed.total_seconds(),
+            'method': request.method,
+            'path': request.path_url,
+            'status': response.status_code,
+            'headers': dict((name, response.headers[name])
+                            for name in RECORDED_HEADERS
+                            if name in response.headers),
+            'body': response.content.decode('utf-8', 'replace')
+        }) + '\n'
+        try:
+            if self.segment is None or self.written >= self.segment_bytes:
+                self.open_segment()
+            self.segment.write(line)
+            self.written += len(line)
+            self.records += 1
+            if time() - self.flushed_at >= self.flush_interval:
+                self.segment.flush()
+                self.flushed_at = time()
+        except (IOError, OSError) as e:
+            logger.error('Failed record upstream response: {}'.format(
+                repr(e)), extra={'MESSAGE_ID': 'exceptions'})
+
+    def attach(self, session):
+        """Record responses of ``requests`` session"""
+        session.hooks['response'].append(self.record)
+
+    def close(self):
+        if self.segment is not None:
+            self.segment.close()
+            self.segment = None
+
+
+def read_records(directory):
+    """Records of all segments in ``directory`` in order of recording
+
+    Segment which is still written or wasn't closed properly is read up to
+    its last flushed record.
+    """
+    paths = sorted(glob.glob(os.path.join(directory, SEGMENT_PATTERN)))
+    for path in paths:
+        with open(path, 'rb') as segment:
+            # Unlike GzipFile decompressor doesn't fail on missing trailer
+            decompressor = zlib.decompressobj(16 + zlib.MAX_WBITS)
+            try:
+                data = decompressor.decompress(segment.read())
+            except zlib.error as e:
+                logger.warning('Skipped broken segment {}: {}'.format(
+                    path, repr(e)))
+                continue
+        lines = data.split('\n')
+        # Last line is either empty or written partially
+        for line in lines[:-1]:
+            yield loads(line)
@@ -0,0 +1,105 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+from gevent import Greenlet
+from gevent.event import Event
+from heapq import heappush, heappop
+from itertools import count
+from random import uniform
+from time import time
+
+logger = logging.getLogger(__name__)
+
+# Backoff policy per error class:
+#   initial - first delay as part of 'retry_default_timeout'
+#   factor - multiplier applied to delay after each attempt
+#   count - whether attempt is counted against 'retries_count'
+RETRY_POLICIES = {
+    # Unknown errors, connection problems, CouchDB unavailable
+    'default': {'initial': 1, 'factor': 2, 'count': True},
+    # Upstream is overloaded, client request interval is already increased,
+    # so keep constant pace. Attempts are counted, item throttled every
+    # time is dropped instead of cycling forever
+    'too_many_requests': {'initial': 1, 'factor': 1, 'count': True},
+    # Replica has not caught up yet, usually resolved in seconds
+    'not_found': {'initial': 0.5, 'factor': 1.5, 'count': True},
+    'not_actual': {'initial': 0.5, 'factor': 1.5, 'count': True},
+    # Upstream answered with unexpected response, give it more time
+    'invalid_response': {'initial': 1, 'factor': 3, 'count': True},
+    # CouchDB save conflict, index entry is already refreshed so retry soon
+    'conflict': {'initial': 0.1, 'factor': 2, 'count': True}
+}
+
+STATUS_CODE_REASONS = {
+    404: 'not_found',
+    429: 'too_many_requests'
+}
+
+
+def retry_delay(resource_item, config, reason='default'):
+    """Update item retry state and return delay before next attempt
+
+    Stored ``timeout`` is the delay of the next attempt without jitter,
+    returned delay is jittered so retries of many items failed at once are
+    spread in time.
+    """
+    policy = RETRY_POLICIES.get(reason, RETRY_POLICIES['default'])
+    timeout = resource_item.get('timeout') or\
+        config['retry_default_timeout'] * policy['initial']
+    resource_item['timeout'] = min(timeout * policy['factor'],
+                                   config['retry_max_timeout'])
+    resource_item['retries_count'] = (resource_item.get('retries_count') or
+                                      0) + int(policy['count'])
+    jitter = config['retry_jitter']
+    return timeout * uniform(1 - jitter, 1 + jitter)
+
+
+class RetryScheduler(Greenlet):
+
+    """Holds retried items in min-heap by due time
+
+    Items are released to the retry queue when their time comes, so workers
+    never sleep on behalf of a retry.
+    """
+
+    def __init__(self, retry_resource_items_queue=None, heap=None):
+        Greenlet.__init__(self)
+        self.exit = False
+        self.retry_resource_items_queue = retry_resource_items_queue
+        self.heap = heap if heap is not None else []
+        self.counter = count()
+        self.wakeup = Event()
+
+    def __len__(self):
+        return len(self.heap)
+
+    def schedule(self, resource_item, timeout):
+        due = time() + timeout
+        heappush(self.heap, (due, next(self.counter), resource_item))
+        if self.heap[0][2] is resource_item:
+            # New item is due earlier than the one scheduler waits for
+            self.wakeup.set()
+
+    def release_due(self):
+        now = time()
+        released = 0
+        while self.heap and self.heap[0][0] <= now:
+            _, _, resource_item = heappop(self.heap)
+            self.retry_resource_items_queue.put(resource_item)
+            released += 1
+        return released
+
+    def _run(self):
+        while not self.exit:
+            self.wakeup.clear()
+            self.release_due()
+            if self.heap:
+                self.wakeup.wait(max(self.heap[0][0] - time(), 0))
+            else:
+                self.wakeup.wait()
+
+    def shutdown(self):
+        self.exit = True
+        self.wakeup.set()
@@ -0,0 +1,195 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import sqlite3
+from collections import deque
+from gevent import get_hub
+from gevent.event import Event
+from gevent.lock import RLock
+from gevent.queue import Empty, Full
+from json import dumps, loads
+from time import time
+from openprocurement.edge.items import QueueItem
+
+logger = logging.getLogger(__name__)
+
+
+class SpillQueue(object):
+
+    """FIFO queue of resource items spilled to SQLite file
+
+    Up to ``hot_size`` items are kept in memory when put, only backlog
+    beyond them is appended to the file, so queue keeping up with its
+    consumers costs no file writes. Spilled items are read back in batches
+    of ``hot_size`` and removed from the file when the next batch is read,
+    so memory used by the queue doesn't depend on backlog size. Items in
+    memory are written to the file on ``close``, on a crash they are lost
+    like items of ``gevent.queue.Queue`` are. Items taken from the last
+    batch before a crash are delivered again after restart, which is
+    harmless as saving is idempotent.
+
+    Has the same ``put``/``get``/``qsize``/``empty``/``full`` interface as
+    ``gevent.queue.Queue``, ``put`` blocks while ``max_size`` items are
+    queued. SQLite calls run in thread pool of gevent hub, so greenlets
+    keep running while file is written. Items are returned as
+    ``QueueItem``. ``got`` counts items taken from queue.
+    """
+
+    def __init__(self, path, hot_size=1000, max_size=None):
+        self.path = path
+        self.hot_size = hot_size
+        self.max_size = max_size
+        # Items read from file and items put but not spilled, the latter
+        # always precede items in file after read position
+        self.hot = deque()
+        self.memory = deque()
+        self.got = 0
+        self.not_empty = Event()
+        self.not_full = Event()
+        # Connection is used by one call at a time, in order of calls
+        self.lock = RLock()
+        self.conn = sqlite3.connect(path, isolation_level=None,
+                                    check_same_thread=False)
+        self.conn.execute('PRAGMA journal_mode=WAL')
+        # Losing items on power failure is acceptable, on process crash they
+        # are kept by OS anyway.
+        self.conn.execute('PRAGMA synchronous=OFF')
+        # AUTOINCREMENT keeps sequence growing after table becomes empty
+        self.conn.execute('CREATE TABLE IF NOT EXISTS items '
+                          '(seq INTEGER PRIMARY KEY AUTOINCREMENT, item TEXT)')
+        # Position of last item read to hot buffer
+        self.read_seq = 0
+        self.size = self.conn.execute(
+            'SELECT COUNT(*) FROM items').fetchone()[0]
+        # Items in file after read position
+        self.spilled = self.size
+        if self.size:
+            logger.info('Restored {} items from spill queue {}'.format(
+                self.size, path), extra={'MESSAGE_ID': 'spill_restored'})
+            self.not_empty.set()
+
+    def qsize(self):
+        return self.size
+
+    def empty(self):
+        return self.size == 0
+
+    def full(self):
+        return bool(self.max_size) and self.size >= self.max_size
+
+    def _call(self, func, *args):
+        with self.lock:
+            return get_hub().threadpool.apply(func, args)
+
+    def _insert(self, item):
+        self.conn.execute('INSERT INTO items (item) VALUES (?)', (item,))
+
+    def put(self, item, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while self.full():
+            self.not_full.clear()
+            if not block:
+                raise Full
+            wait = None if deadline is None else max(deadline - time(), 0)
+            if not self.not_full.wait(wait) and deadline is not None:
+                raise Full
+        if not self.spilled and len(self.memory) < self.hot_size:
+            self.memory.append(dumps(dict(item)))
+        else:
+            with self.lock:
+                # Counted before write, so next puts don't overtake item
+                self.spilled += 1
+                try:
+                    self._call(self._insert, dumps(dict(item)))
+                except Exception:
+                    self.spilled -= 1
+                    raise
+        self.size += 1
+        self.not_empty.set()
+
+    def put_nowait(self, item):
+        self.put(item, block=False)
+
+    def _read_batch(self, read_seq):
+        # Items of previous batch are processed, forget them
+        self.conn.execute('DELETE FROM items WHERE seq <= ?', (read_seq,))
+        return self.conn.execute(
+            'SELECT seq, item FROM items WHERE seq > ? ORDER BY seq LIMIT ?',
+            (read_seq, self.hot_size)).fetchall()
+
+    def _read_ahead(self):
+        with self.lock:
+            if self.hot or self.memory:
+                # Read or put by other greenlet meanwhile
+                return
+            rows = self._call(self._read_batch, self.read_seq)
+            if rows:
+                self.read_seq = rows[-1][0]
+                self.spilled -= len(rows)
+                self.hot.extend(item for _, item in rows)
+
+    def get(self, block=True, timeout=None):
+        deadline = None if timeout is None else time() + timeout
+        while True:
+            while not self.size:
+                self.not_empty.clear()
+                if not block:
+                    raise Empty
+                wait = None if deadline is None else max(deadline - time(),
+                                                         0)
+                if not self.not_empty.wait(wait) and deadline is not None:
+                    raise Empty
+            if self.hot or self.memory:
+                break
+            # Other greenlets may take items while batch is read
+            self._read_ahead()
+        self.size -= 1
+        self.got += 1
+        self.not_full.set()
+        item = self.hot.popleft() if self.hot else self.memory.popleft()
+        return QueueItem.from_item(loads(item))
+
+    def get_nowait(self):
+        return self.get(block=False)
+
+    def read_items(self):
+        """Items of last batch read from file
+
+        They stay in the file until the next batch is read, so they are
+        delivered again after restart even if they were taken already.
+        Items which were never spilled aren't here.
+        """
+        return [loads(item) for _, item in self._call(
+            self._select_read, self.read_seq)]
+
+    def _select_read(self, read_seq):
+        return self.conn.execute(
+            'SELECT seq, item FROM items WHERE seq <= ? ORDER BY seq',
+            (read_seq,)).fetchall()
+
+    def _write_memory(self, items, read_seq):
+        # Spilled items follow items kept in memory, they are moved behind
+        # them to keep order after restart
+        self.conn.execute('BEGIN')
+        last_seq = self.conn.execute(
+            'SELECT MAX(seq) FROM items').fetchone()[0] or 0
+        self.conn.executemany('INSERT INTO items (item) VALUES (?)',
+                              [(item,) for item in items])
+        self.conn.execute('INSERT INTO items (item) SELECT item FROM items '
+                          'WHERE seq > ? AND seq <= ? ORDER BY seq',
+                          (read_seq, last_seq))
+        self.conn.execute('DELETE FROM items WHERE seq > ? AND seq <= ?',
+                          (read_seq, last_seq))
+        self.conn.execute('COMMIT')
+
+    def close(self):
+        """Write items kept in memory to file and close it"""
+        with self.lock:
+            if self.memory:
+                self._call(self._write_memory, list(self.memory),
+                           self.read_seq)
+                self.spilled += len(self.memory)
+                self.memory.clear()
+            self.conn.close()
@@ -0,0 +1,62 @@
+# -*- coding: utf-8 -*-
+import unittest
+from openprocurement.edge.autoscaler import WorkersAutoscaler
+
+
+class TestWorkersAutoscaler(unittest.TestCase):
+
+    def test_update(self):
+        autoscaler = WorkersAutoscaler(1, 10, smoothing=1)
+        autoscaler.update(0.0, 100, 0, 0, 0)
+        self.assertEqual(autoscaler.arrival_rate, 0)
+        self.assertEqual(autoscaler.completion_rate, 0)
+
+        # 20 items completed, backlog grew by 10 in 2 seconds
+        autoscaler.update(2.0, 110, 20, 40, 2)
+        self.assertEqual(autoscaler.completion_rate, 10)
+        self.assertEqual(autoscaler.arrival_rate, 15)
+        self.assertEqual(autoscaler.throttle_ratio, 0.05)
+
+        # API client released, its counters are gone
+        autoscaler.update(3.0, 110, 30, 30, 0)
+        self.assertEqual(autoscaler.throttle_ratio, 0)
+
+        autoscaler = WorkersAutoscaler(1, 10, smoothing=0.5)
+        autoscaler.update(0.0, 0, 0, 0, 0)
+        autoscaler.update(1.0, 0, 10, 10, 0)
+        self.assertEqual(autoscaler.completion_rate, 5)
+
+    def test_desired(self):
+        autoscaler = WorkersAutoscaler(1, 10, drain_time=10, smoothing=1)
+        # Nothing measured yet
+        self.assertEqual(autoscaler.desired(0, 0), 1)
+        self.assertEqual(autoscaler.desired(1, 100), 2)
+        # Worker rate from latency: 100 / 10 sec. needs 10 items/sec
+        self.assertEqual(autoscaler.desired(0, 100, latency=0.5), 5)
+
+        # 2 workers complete 4 items/sec, 6 items/sec arrive
+        autoscaler.update(0.0, 100, 0, 0, 0)
+        autoscaler.update(1.0, 102, 4, 4, 0)
+        # (6 + 102 / 10) / 2 -> 9 workers
+        self.assertEqual(autoscaler.desired(2, 102), 9)
+        self.assertEqual(autoscaler.desired(2, 1000), 10)
+
+        # Shrinks by one worker a time
+        autoscaler.arrival_rate = 0
+        self.assertEqual(autoscaler.desired(9, 0), 8)
+        self.assertEqual(autoscaler.desired(2, 0), 1)
+        self.assertEqual(autoscaler.desired(1, 0), 1)
+
+        # Upstream throttles requests
+        autoscaler.throttle_ratio = 0.1
+        self.assertEqual(autoscaler.desired(5, 1000), 4)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestWorkersAutoscaler))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
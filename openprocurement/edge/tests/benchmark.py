@@ -0,0 +1,258 @@
+# -*- coding: utf-8 -*-
+import gzip
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+import webtest
+from couchdb import Server
+from couchdb.http import ResourceConflict, ServerError
+from gevent.pywsgi import WSGIServer
+from json import dumps
+from openprocurement.edge.benchmark import (
+    FakeUpstream,
+    MemoryCouchDB,
+    TrafficReplay,
+    log_events_benchmark,
+    queue_items_benchmark
+)
+from openprocurement.edge.utils import VALIDATE_BULK_DOCS_ID
+
+
+class TestFakeUpstream(unittest.TestCase):
+
+    def setUp(self):
+        self.upstream = FakeUpstream(docs=5, doc_size=512, latency=0)
+        self.app = webtest.TestApp(self.upstream)
+        self.url = '/api/2.3/tenders'
+
+    def test_feed(self):
+        # Backward feed walks over all items newest first
+        response = self.app.get(self.url, {'feed': 'changes',
+                                           'descending': '1', 'limit': 2})
+        ids = [item['id'] for item in response.json['data']]
+        forward_offset = response.json['prev_page']['offset']
+        self.assertEqual(ids, self.upstream.item_ids[:-3:-1])
+        while response.json['data']:
+            response = self.app.get(self.url, {
+                'feed': 'changes', 'descending': '1', 'limit': 2,
+                'offset': response.json['next_page']['offset']})
+            ids.extend(item['id'] for item in response.json['data'])
+        self.assertEqual(ids, self.upstream.item_ids[::-1])
+
+        # Forward feed returns changed items only
+        response = self.app.get(self.url, {'feed': 'changes',
+                                           'offset': forward_offset})
+        self.assertEqual(response.json['data'], [])
+        self.upstream.change(self.upstream.item_ids[0])
+        response = self.app.get(self.url, {
+            'feed': 'changes', 'offset': response.json['next_page']['offset'],
+            'opt_fields': '_all_'})
+        self.assertEqual([item['id'] for item in response.json['data']],
+                         self.upstream.item_ids[:1])
+        self.assertIn('description', response.json['data'][0])
+        self.assertEqual(self.upstream.requests['feed'], 6)
+
+    def test_document(self):
+        item_id = self.upstream.item_ids[0]
+        response = self.app.get('{}/{}'.format(self.url, item_id))
+        self.assertIn('SERVER_ID', response.headers['Set-Cookie'])
+        self.assertEqual(response.json['data']['id'], item_id)
+        self.assertGreaterEqual(len(response.body), 512)
+        self.assertIn((item_id, response.json['data']['dateModified']),
+                      self.upstream.changed)
+
+        self.app.get('{}/{}'.format(self.url, item_id), status=304, headers={
+            'If-None-Match': response.headers['ETag']})
+        self.app.get('{}/{}'.format(self.url, 'missing'), status=404)
+        self.upstream.rate_429 = 1
+        self.app.get('{}/{}'.format(self.url, item_id), status=429)
+        self.assertEqual(self.upstream.requests['document'], 4)
+        self.assertEqual(self.upstream.requests['not_modified'], 1)
+        self.assertEqual(self.upstream.requests['not_found'], 1)
+        self.assertEqual(self.upstream.requests['throttled'], 1)
+
+    def test_replica_lag(self):
+        upstream = FakeUpstream(docs=1, latency=0, backends=2,
+                                replica_lag=60)
+        url = '{}/{}'.format(self.url, upstream.item_ids[0])
+        app = webtest.TestApp(upstream)
+        app.set_cookie('SERVER_ID', 'backend0')
+        app.get(url, status=200)
+        app.set_cookie('SERVER_ID', 'backend1')
+        app.get(url, status=404)
+
+
+def feed_record(time, query, ids):
+    return {'time': time, 'elapsed': 0, 'method': 'GET',
+            'path': '/api/2.3/tenders?' + query, 'status': 200,
+            'headers': {'Content-Type': 'application/json'},
+            'body': dumps({'data': [{'id': item_id,
+                                     'dateModified': '2017-01-01'}
+                                    for item_id in ids]})}
+
+
+class TestTrafficReplay(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        document = {
+            'time': 150, 'elapsed': 0, 'method': 'GET',
+            'path': '/api/2.3/tenders/a', 'status': 200,
+            'headers': {'Content-Type': 'application/json',
+                        'ETag': '"2017-01-01"',
+                        'Set-Cookie': 'SERVER_ID=backend0; Path=/'},
+            'body': dumps({'data': {'id': 'a',
+                                    'dateModified': '2017-01-01'}})}
+        records = [feed_record(100, 'feed=changes&offset=1', ['a']),
+                   document,
+                   feed_record(200, 'offset=1&feed=changes', ['a', 'b']),
+                   dict(document, time=160, status=304, body='')]
+        segment = gzip.open(os.path.join(
+            self.directory, 'tenders-0-0-000001.jsonl.gz'), 'wb')
+        for record in records:
+            segment.write(dumps(record) + '\n')
+        segment.close()
+        self.url = '/api/2.3/tenders'
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def feed_ids(self, app):
+        response = app.get(self.url, {'offset': 1, 'feed': 'changes'})
+        return [item['id'] for item in response.json['data']]
+
+    def test_maximum_speed(self):
+        replay = TrafficReplay(self.directory, speed=0)
+        self.assertEqual(replay.resource, 'tenders')
+        self.assertEqual(replay.item_ids, ['a', 'b'])
+        app = webtest.TestApp(replay)
+        # Responses are handed out in recorded order, the last is repeated
+        self.assertEqual(self.feed_ids(app), ['a'])
+        self.assertEqual(self.feed_ids(app), ['a', 'b'])
+        self.assertEqual(self.feed_ids(app), ['a', 'b'])
+        self.assertEqual(sorted(replay.changed),
+                         [('a', '2017-01-01'), ('b', '2017-01-01')])
+
+        response = app.get('{}/a'.format(self.url))
+        self.assertIn('SERVER_ID=backend0', response.headers['Set-Cookie'])
+        self.assertEqual(response.json['data']['id'], 'a')
+        app.get('{}/a'.format(self.url), status=304, headers={
+            'If-None-Match': response.headers['ETag']})
+        app.get('{}/b'.format(self.url), status=404)
+        app.head('/api/2.3/spore', status=200)
+        self.assertEqual(replay.requests['feed'], 3)
+        self.assertEqual(replay.requests['document'], 3)
+        self.assertEqual(replay.requests['not_modified'], 1)
+        self.assertEqual(replay.requests['not_recorded'], 1)
+
+    def test_replay_clock(self):
+        replay = TrafficReplay(self.directory, speed=10)
+        app = webtest.TestApp(replay)
+        self.assertEqual(self.feed_ids(app), ['a'])
+        self.assertEqual(self.feed_ids(app), ['a'])
+        # 10 seconds of replay are 100 seconds of recording
+        replay.started -= 10
+        self.assertEqual(self.feed_ids(app), ['a', 'b'])
+
+
+class TestMemoryCouchDB(unittest.TestCase):
+
+    def setUp(self):
+        self.server = WSGIServer(('127.0.0.1', 0), MemoryCouchDB(), log=None)
+        self.server.start()
+        self.couch = Server('http://127.0.0.1:{}/'.format(
+            self.server.server_port))
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_database(self):
+        db = self.couch.create('test_db')
+        self.assertIn('test_db', self.couch)
+        self.assertNotIn('other_db', self.couch)
+
+        doc_id, rev = db.save({'_id': 'a', 'dateModified': '2017-01-02',
+                               'doc_type': 'Tender'})
+        self.assertEqual(db.get('a')['_rev'], rev)
+        self.assertIsNone(db.get('missing'))
+
+        # Any update is accepted until validate_doc_update is saved
+        results = db.update([{'_id': 'a', '_rev': rev,
+                              'dateModified': '2017-01-01',
+                              'doc_type': 'Tender'},
+                             {'_id': 'b', 'dateModified': '2017-01-03',
+                              'doc_type': 'Tender'},
+                             {'_id': 'a', 'dateModified': '2017-01-04'}])
+        self.assertEqual([success for success, _, _ in results],
+                         [True, True, False])
+        self.assertIsInstance(results[2][2], ResourceConflict)
+
+        db.save({'_id': VALIDATE_BULK_DOCS_ID})
+        doc = db.get('a')
+        doc['dateModified'] = '2016-12-31'
+        (success, _, error), = db.update([doc])
+        self.assertFalse(success)
+        self.assertIsInstance(error, ServerError)
+        self.assertIn('dateModified', error.args[0])
+
+        rows = db.view('_all_docs', keys=['a', 'missing'])
+        self.assertEqual([row.id for row in rows], ['a', None])
+        view = db.view('tenders/by_dateModified', include_docs=True)
+        self.assertEqual([row.id for row in view], ['a', 'b'])
+        self.assertEqual(view.rows[0].doc['_rev'], doc['_rev'])
+
+        changes = db.changes(since=0)
+        self.assertEqual([change['id'] for change in changes['results']],
+                         ['a', 'b', VALIDATE_BULK_DOCS_ID])
+        self.assertEqual(db.changes(since=changes['last_seq'])['results'],
+                         [])
+
+        del self.couch['test_db']
+        self.assertNotIn('test_db', self.couch)
+
+
+class TestQueueItemsBenchmark(unittest.TestCase):
+
+    def test_report(self):
+        report = queue_items_benchmark(1000)
+        self.assertEqual(report['items'], 1000)
+        self.assertLess(report['queue_item_bytes'], report['dict_bytes'])
+        self.assertGreater(report['queue_item_usec'], 0)
+        self.assertGreater(report['dict_retry_usec'], 0)
+
+
+class TestLogEventsBenchmark(unittest.TestCase):
+
+    def test_report(self):
+        edge_logger = logging.getLogger('openprocurement.edge')
+        level = edge_logger.level
+        report = log_events_benchmark(
+            lambda: FakeUpstream(docs=20, doc_size=512, latency=0),
+            options={'worker_sleep': 0.1, 'queue_timeout': 0.1,
+                     'bulk_save_interval': 0.5,
+                     'bulk_query_interval': 0.5},
+            duration=3, sample_rate=0.1)
+        self.assertEqual(report['log_level'], 'DEBUG')
+        self.assertEqual(report['log_sample_rate'], 0.1)
+        for name in ('unsampled', 'sampled'):
+            self.assertGreaterEqual(report[name + '_docs_saved'], 20)
+            self.assertGreater(report[name + '_docs_per_sec'], 0)
+        # Pipeline loggers are restored
+        self.assertEqual(edge_logger.level, level)
+        self.assertTrue(edge_logger.propagate)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestFakeUpstream))
+    suite.addTest(unittest.makeSuite(TestTrafficReplay))
+    suite.addTest(unittest.makeSuite(TestMemoryCouchDB))
+    suite.addTest(unittest.makeSuite(TestQueueItemsBenchmark))
+    suite.addTest(unittest.makeSuite(TestLogEventsBenchmark))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
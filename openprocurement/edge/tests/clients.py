@@ -0,0 +1,100 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from gevent import spawn, sleep
+from gevent.queue import Empty
+from mock import MagicMock
+from openprocurement.edge.clients import APIClientsPool
+
+
+def client_dict(backend=None):
+    client = MagicMock()
+    client.session.cookies = {'SERVER_ID': backend} if backend else {}
+    return {'id': uuid.uuid4().hex, 'client': client, 'request_interval': 0}
+
+
+class TestAPIClientsPool(unittest.TestCase):
+
+    def test_put_get(self):
+        pool = APIClientsPool()
+        self.assertTrue(pool.empty())
+        self.assertRaises(Empty, pool.get, block=False)
+        self.assertRaises(Empty, pool.get, timeout=0.01)
+
+        a = client_dict('a')
+        pool.put(a)
+        self.assertEqual(pool.qsize(), 1)
+        self.assertEqual(pool.backends(), ['a'])
+        self.assertEqual(pool.clients_count('a'), 1)
+        self.assertIs(pool.get(), a)
+        self.assertTrue(pool.empty())
+
+        # Blocked get waits for client
+        getter = spawn(pool.get)
+        sleep(0)
+        pool.put(a)
+        self.assertIs(getter.get(timeout=1), a)
+
+        pool.remove(a)
+        self.assertEqual(pool.clients_count('a'), 0)
+
+    def test_get_spreads_backends(self):
+        pool = APIClientsPool()
+        a1, a2, b1 = client_dict('a'), client_dict('a'), client_dict('b')
+        for client in (a1, a2, b1):
+            pool.put(client)
+        # Both backends are idle, 'a' has more idle clients
+        self.assertIs(pool.get(), a1)
+        # 'a' has client in flight now
+        self.assertIs(pool.get(), b1)
+        self.assertIs(pool.get(), a2)
+
+    def test_put_repins_overloaded_backend(self):
+        pool = APIClientsPool()
+        b = client_dict('b')
+        pool.put(b)
+        clients = [client_dict('a') for _ in xrange(3)]
+        for client in clients[:2]:
+            pool.put(client)
+        self.assertEqual(pool.clients_count('a'), 2)
+
+        # Third client of 'a' is over share of 2 clients per backend
+        pool.put(clients[2])
+        self.assertEqual(clients[2]['client'].session.cookies, {})
+        self.assertEqual(pool.clients_count('a'), 2)
+        self.assertEqual(pool.clients_count(None), 1)
+        self.assertEqual(pool.qsize(), 4)
+
+        # Forgotten backend doesn't take share
+        pool.seen_at['b'] -= pool.backend_ttl + 1
+        pool.put(client_dict('a'))
+        self.assertEqual(pool.clients_count('a'), 3)
+
+    def test_get_fresher(self):
+        pool = APIClientsPool()
+        a, b, c = client_dict('a'), client_dict('b'), client_dict()
+        for client in (a, b, c):
+            pool.put(client)
+        self.assertIs(pool.get_fresher('2017-01-02'), None)
+
+        pool.seen(a, '2017-01-03')
+        pool.seen(a, '2017-01-01')
+        pool.seen(b, '2017-01-02')
+        pool.seen(c, '2017-01-05')
+        self.assertEqual(pool.fresh, {'a': '2017-01-03', 'b': '2017-01-02'})
+
+        self.assertIs(pool.get_fresher('2017-01-03', exclude=('a',)), None)
+        self.assertIs(pool.get_fresher('2017-01-02', exclude=('a',)), b)
+        self.assertIs(pool.get_fresher('2017-01-02'), a)
+        self.assertIs(pool.get_fresher('2017-01-02'), None)
+        self.assertEqual(pool.qsize(), 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestAPIClientsPool))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
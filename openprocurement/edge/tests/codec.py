@@ -0,0 +1,91 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from json import dumps, loads
+from StringIO import StringIO
+from openprocurement.edge.codec import (
+    DocumentCodec,
+    EncodedDocument,
+    encode_document,
+    serve
+)
+
+
+class TestCodec(unittest.TestCase):
+
+    def setUp(self):
+        self.doc = {'id': uuid.uuid4().hex,
+                    'dateModified': '2017-05-10T10:00:00.000000+03:00',
+                    'bids': [{'value': {'amount': i}} for i in xrange(100)]}
+        self.content = dumps({'data': self.doc})
+
+    def test_encode_document(self):
+        self.assertEqual(loads(encode_document(self.doc)), self.doc)
+
+        encoded = EncodedDocument({'id': self.doc['id']}, dumps(self.doc))
+        self.assertEqual(encode_document(encoded), encoded.body)
+        encoded['_id'] = encoded['id']
+        encoded['doc_type'] = 'Tender'
+        self.assertEqual(loads(encode_document(encoded)),
+                         dict(self.doc, _id=self.doc['id'],
+                              doc_type='Tender'))
+
+        encoded = EncodedDocument({}, '{}')
+        encoded['_rev'] = '1-' + uuid.uuid4().hex
+        self.assertEqual(loads(encode_document(encoded)),
+                         {'_rev': encoded['_rev']})
+
+    def test_serve(self):
+        bad = '{"data": '
+        stdin = StringIO('{}\n{}{}\n{}'.format(len(self.content),
+                                               self.content, len(bad), bad))
+        stdout = StringIO()
+        serve(stdin, stdout)
+        stdout.seek(0)
+        summary, length, error = loads(stdout.readline())
+        self.assertEqual(summary, {'id': self.doc['id'],
+                                   'dateModified': self.doc['dateModified']})
+        self.assertIsNone(error)
+        self.assertEqual(loads(stdout.read(length)), self.doc)
+        summary, length, error = loads(stdout.readline())
+        self.assertIsNone(summary)
+        self.assertIn('ValueError', error)
+
+    def test_loads(self):
+        codec = DocumentCodec(threshold=len(self.content) + 1, processes=1)
+        # Small document is decoded in place
+        resource_item = codec.loads(self.content)
+        self.assertNotIsInstance(resource_item, EncodedDocument)
+        self.assertEqual(resource_item, self.doc)
+
+        # Large document is decoded by codec process
+        codec.threshold = 1
+        resource_item = codec.loads(self.content)
+        self.assertIsInstance(resource_item, EncodedDocument)
+        self.assertEqual(resource_item['dateModified'],
+                         self.doc['dateModified'])
+        self.assertNotIn('bids', resource_item)
+        self.assertEqual(loads(resource_item.body), self.doc)
+
+        with self.assertRaises(ValueError):
+            codec.loads('{"data": ')
+
+        # Process is restarted after it died
+        process = codec.processes.peek()
+        process.process.kill()
+        process.process.wait()
+        with self.assertRaises((IOError, OSError)):
+            codec.loads(self.content)
+        resource_item = codec.loads(self.content)
+        self.assertEqual(loads(resource_item.body), self.doc)
+        codec.close()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCodec))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
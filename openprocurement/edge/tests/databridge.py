@@ -5,18 +5,34 @@ monkey.patch_all()
 import unittest
 import datetime
 import os
+import shutil
+import tempfile
 import logging
+import urllib2
 import uuid
-from gevent import sleep
+from copy import deepcopy
+from json import dumps
+from gevent import killall, sleep, spawn, spawn_later
+from gevent.event import Event
 from gevent.queue import Queue
 from couchdb import Server
 from mock import MagicMock, patch
 from munch import munchify
 from random import randint
-from httplib import IncompleteRead
+from requests.cookies import RequestsCookieJar
 from openprocurement_client.exceptions import RequestFailed
 from openprocurement.edge.tests.base import TenderBaseWebTest
-from openprocurement.edge.databridge import EdgeDataBridge
+from openprocurement.edge.databridge import (
+    APIClientsBudget,
+    EdgeDataBridge,
+    MultiResourceEdgeDataBridge,
+    ShardedEdgeDataBridge
+)
+from openprocurement.edge.feeder import ShardFeeder, shard_for
+from openprocurement.edge.journal import Journal
+from openprocurement.edge.latency import LatencyStats
+from openprocurement.edge.queues import CoalescingQueue
+from openprocurement.edge.spill import SpillQueue
 from openprocurement.edge.utils import (
     DataBridgeConfigError,
     push_views,
@@ -66,7 +82,7 @@ class TestEdgeDataBridge(TenderBaseWebTest):
             'bulk_query_interval': 0.5,
             'retrieve_mode': '_all_',
             'perfomance_window': 0.1,
-            'queues_controller_timeout': 0.01,
+            'autoscale_interval': 0.01,
             'retrievers_params': {
                 'down_requests_sleep': 5,
                 'up_requests_sleep': 1,
@@ -134,6 +150,38 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         self.assertEqual(bridge.input_queue_size, -1)
         self.config['main']['input_queue_size'] = 1
         bridge = EdgeDataBridge(self.config)
+
+        # Bulk ingest requests full documents in feed
+        self.assertNotIn('opt_fields', bridge.feeder.extra_params)
+        self.config['main']['bulk_ingest'] = True
+        bridge = EdgeDataBridge(self.config)
+        self.assertEqual(bridge.feeder.extra_params['opt_fields'], '_all_')
+        del self.config['main']['bulk_ingest']
+
+        # Main and retry queues coalesce items by id
+        self.assertIsInstance(bridge.resource_items_queue, CoalescingQueue)
+        self.assertIsInstance(bridge.retry_resource_items_queue,
+                              CoalescingQueue)
+        self.assertEqual(bridge.retry_resource_items_queue.maxsize, None)
+
+        # Spill queues
+        spill_dir = tempfile.mkdtemp()
+        self.config['main']['queue_spill_dir'] = spill_dir
+        bridge = EdgeDataBridge(self.config)
+        self.assertIsInstance(bridge.input_queue, SpillQueue)
+        self.assertIsInstance(bridge.resource_items_queue, SpillQueue)
+        self.assertEqual(bridge.resource_items_queue.path,
+                         os.path.join(spill_dir,
+                                      'tenders_resource_items.sqlite'))
+        self.assertEqual(bridge.resource_items_queue.hot_size, 1000)
+        self.assertEqual(bridge.resource_items_queue.max_size, 1000000)
+        self.config['main']['queue_spill_max_size'] = -1
+        bridge = EdgeDataBridge(self.config)
+        self.assertIsNone(bridge.input_queue.max_size)
+        del self.config['main']['queue_spill_max_size']
+        del self.config['main']['queue_spill_dir']
+        shutil.rmtree(spill_dir)
+
         self.assertIn('resources_api_server', bridge.config['main'])
         self.assertIn('resources_api_version', bridge.config['main'])
         self.assertIn('public_resources_api_server', bridge.config['main'])
@@ -141,6 +189,19 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         self.assertIn('db_name', bridge.config['main'])
         self.assertEqual(self.config['main']['couch_url'], bridge.couch_url)
         self.assertEqual(len(bridge.server.uuids()[0]), 32)
+        self.assertEqual(bridge.feeder.db, None)
+
+        # Checkpoint is kept only with journal of items fetched before it
+        self.config['main']['feeder_checkpoint'] = True
+        with self.assertRaises(DataBridgeConfigError):
+            EdgeDataBridge(self.config)
+        self.config['main']['journal_dir'] = tempfile.mkdtemp()
+        bridge = EdgeDataBridge(self.config)
+        self.assertEqual(bridge.feeder.db, bridge.db)
+        self.assertIs(bridge.feeder.unsaved, bridge.unsaved)
+        self.assertIs(bridge.bulk_writer.unsaved, bridge.unsaved)
+        shutil.rmtree(self.config['main'].pop('journal_dir'))
+        del self.config['main']['feeder_checkpoint']
 
         del bridge
         self.config['main']['resource_items_queue_size'] = 101
@@ -263,6 +324,20 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         self.assertEqual(bridge.api_clients_queue.qsize(),
                          bridge.workers_min)
 
+        # Clients refused by budget are retried with backoff a few times
+        bridge = EdgeDataBridge(self.config,
+                                api_clients_budget=APIClientsBudget(1))
+        bridge.workers_min = 2
+        with patch('openprocurement.edge.databridge.sleep') as mock_sleep, \
+                patch('openprocurement.edge.databridge.logger') as mock_logger:
+            bridge.fill_api_clients_queue(attempts=3)
+        self.assertEqual(bridge.api_clients_queue.qsize(), 1)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list],
+                         [0.1, 0.2, 0.4])
+        self.assertEqual(
+            mock_logger.warning.call_args[1]['extra']['MESSAGE_ID'],
+            'api_clients_queue_not_filled')
+
     def test_fill_input_queue(self):
         bridge = EdgeDataBridge(self.config)
         bridge.workers_config['historical'] = True
@@ -295,6 +370,8 @@ class TestEdgeDataBridge(TenderBaseWebTest):
             munchify({'status_code': 429}))
         bridge.fill_input_queue()
         self.assertEqual(bridge.resource_items_queue.qsize(), 0)
+        self.assertEqual(bridge.replanning.keys(), [return_value[0]['id']])
+        killall(bridge.replanning.values())
 
         bridge = EdgeDataBridge(self.config)
         return_value = [
@@ -307,28 +384,99 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         self.assertEqual(bridge.input_queue.qsize(), 1)
         self.assertEqual(bridge.input_queue.get(), return_value[0])
 
+    @patch('openprocurement.edge.databridge.gevent.sleep')
+    def test_plan_historical_item_failed(self, mock_sleep):
+        bridge = EdgeDataBridge(self.config)
+        bridge.workers_config['historical'] = True
+        bridge.workers_config['retries_count'] = 1
+        mock_api_client = MagicMock()
+        mock_api_client.get_resource_item_historical.side_effect = \
+            RequestFailed(munchify({'status_code': 500}))
+        bridge.api_clients_queue.put({'id': uuid.uuid4().hex,
+                                      'client': mock_api_client})
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat()}
+        bridge.plan_historical_item(item)
+        # Backs off between every attempt
+        self.assertEqual(
+            mock_api_client.get_resource_item_historical.call_count, 3)
+        self.assertEqual([c[0][0] for c in mock_sleep.call_args_list],
+                         [0.5, 1.5])
+        self.assertEqual(bridge.api_clients_queue.qsize(), 1)
+        # Failed item is planned again later
+        self.assertEqual(item['retries_count'], 1)
+        replan = bridge.replanning[item['id']]
+        self.assertEqual(replan.args, (item,))
+
+        # Replan runs in greenlet scheduled before, drain journals it
+        with patch('openprocurement.edge.databridge.gevent.spawn_later') \
+                as mock_spawn_later:
+            bridge._replan(item)
+        self.assertEqual(bridge.replanning, {})
+        self.assertEqual(item['retries_count'], 2)
+        self.assertEqual(mock_spawn_later.call_count, 0)
+        self.assertEqual(bridge.metrics.dropped.value, 1)
+        replan.kill()
+
+        mock_api_client.get_resource_item_historical.side_effect = None
+        mock_api_client.get_resource_item_historical.return_value = {
+            'x_revision_n': 2}
+        bridge.db.view = MagicMock(return_value=[{'error': 'not_found'}] * 2)
+        bridge._replan(item)
+        self.assertEqual(bridge.resource_items_queue.qsize(), 2)
+
+    def test_missing_revisions(self):
+        bridge = EdgeDataBridge(self.config)
+        bridge.bulk_query_limit = 2
+        item_id = uuid.uuid4().hex
+        bridge.db.view = MagicMock(side_effect=[
+            [{'id': item_id + '-1', 'key': item_id + '-1',
+              'value': {'rev': '1-' + uuid.uuid4().hex}},
+             {'key': item_id + '-2', 'error': 'not_found'}],
+            [{'id': item_id + '-3', 'key': item_id + '-3',
+              'value': {'rev': '2-' + uuid.uuid4().hex, 'deleted': True}}]
+        ])
+        self.assertEqual(bridge.missing_revisions(item_id, 3), [2, 3])
+        # One request per bulk_query_limit keys
+        self.assertEqual(bridge.db.view.call_count, 2)
+        bridge.db.view.assert_called_with('_all_docs',
+                                          keys=[item_id + '-3'])
+
     def test_send_bulk(self):
         old_date_modified = datetime.datetime.utcnow().isoformat()
         id_1 = uuid.uuid4().hex
         date_modified_1 = datetime.datetime.utcnow().isoformat()
         id_2 = uuid.uuid4().hex
         date_modified_2 = datetime.datetime.utcnow().isoformat()
-        input_dict = {id_1: date_modified_1, id_2: date_modified_2}
-        return_value = [
-            munchify({'id': id_1, 'key': date_modified_1}),
-            munchify({'id': id_2, 'key': old_date_modified})
-        ]
+        id_3 = uuid.uuid4().hex
+        date_modified_3 = datetime.datetime.utcnow().isoformat()
+        input_dict = {id_1: date_modified_1, id_2: date_modified_2,
+                      id_3: date_modified_3}
         bridge = EdgeDataBridge(self.config)
-        bridge.db.view = MagicMock(return_value=return_value)
+        bridge.index.update(id_1, date_modified_1, '1-' + uuid.uuid4().hex)
+        bridge.index.update(id_2, old_date_modified, '1-' + uuid.uuid4().hex)
+        bridge.db.view = MagicMock()
         self.assertEqual(bridge.resource_items_queue.qsize(), 0)
         bridge.send_bulk(input_dict)
-        self.assertEqual(bridge.resource_items_queue.qsize(), 1)
-        bridge.db.view.side_effect = [Exception(), Exception(),
-                                      Exception('test')]
-        input_dict = {}
-        with self.assertRaises(Exception) as e:
-            bridge.send_bulk(input_dict)
-        self.assertEqual(e.exception.message, 'test')
+        self.assertEqual(bridge.resource_items_queue.qsize(), 2)
+        self.assertEqual(bridge.db.view.call_count, 0)
+        queued = [bridge.resource_items_queue.get(),
+                  bridge.resource_items_queue.get()]
+        self.assertIn({'id': id_2, 'dateModified': date_modified_2}, queued)
+        self.assertIn({'id': id_3, 'dateModified': date_modified_3}, queued)
+
+        # Full documents from feed are passed to workers
+        doc_2 = {'id': id_2, 'dateModified': date_modified_2,
+                 'status': 'active'}
+        doc_3 = {'id': id_3, 'dateModified': old_date_modified,
+                 'status': 'active'}
+        bridge.send_bulk(input_dict, {id_2: doc_2, id_3: doc_3})
+        queued = [bridge.resource_items_queue.get(),
+                  bridge.resource_items_queue.get()]
+        self.assertIn({'id': id_2, 'dateModified': date_modified_2,
+                       'doc': doc_2}, queued)
+        # Document doesn't match feed item, fetch it from public API
+        self.assertIn({'id': id_3, 'dateModified': date_modified_3}, queued)
 
         # historical
         rev_1 = randint(10, 99)
@@ -342,6 +490,31 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         bridge.send_bulk(input_dict)
         self.assertEqual(bridge.resource_items_queue.qsize(), 1)
 
+    def test_send_bulk_tracer(self):
+        self.assertIsNone(EdgeDataBridge(self.config).tracer)
+        self.config['main']['trace_sample_rate'] = 1
+        try:
+            bridge = EdgeDataBridge(self.config)
+            self.assertIs(bridge.bulk_writer.tracer, bridge.tracer)
+            saved_id, new_id = uuid.uuid4().hex, uuid.uuid4().hex
+            date_modified = datetime.datetime.utcnow().isoformat()
+            bridge.index.update(saved_id, date_modified,
+                                '1-' + uuid.uuid4().hex)
+            bridge.tracer.start(saved_id)
+            bridge.tracer.start(new_id)
+            bridge.send_bulk({saved_id: date_modified,
+                              new_id: date_modified})
+            self.assertEqual(bridge.tracer.total_seconds['skipped'].count, 1)
+            self.assertEqual(bridge.tracer.traces.keys(), [new_id])
+            self.assertEqual(bridge.tracer.stage_seconds['check'].count, 1)
+
+            # Traces are kept by id, revisions of historical mode share it
+            self.config['main']['historical'] = True
+            self.assertIsNone(EdgeDataBridge(self.config).tracer)
+        finally:
+            del self.config['main']['trace_sample_rate']
+            self.config['main'].pop('historical', None)
+
     def test_fill_resource_items_queue(self):
         bridge = EdgeDataBridge(self.config)
         db_dict_list = [
@@ -368,17 +541,26 @@ class TestEdgeDataBridge(TenderBaseWebTest):
                 'id': item['id'],
                 'dateModified': datetime.datetime.utcnow().isoformat()
             })
-        view_return_list = [
-            munchify({
-                'id': db_dict_list[0]['id'],
-                'key': db_dict_list[0]['dateModified']
-            })
-        ]
-        bridge.db.view = MagicMock(return_value=view_return_list)
+        bridge.index.update(db_dict_list[0]['id'],
+                            db_dict_list[0]['dateModified'],
+                            '1-' + uuid.uuid4().hex)
         with patch('__builtin__.True', AlmostAlwaysTrue(1)):
             bridge.fill_resource_items_queue()
         self.assertEqual(bridge.resource_items_queue.qsize(), 1)
 
+        # Bulk ingest
+        bridge.input_queue = Queue()
+        bridge.resource_items_queue = Queue()
+        bridge.bulk_ingest = True
+        doc = {'id': uuid.uuid4().hex, 'status': 'active',
+               'dateModified': datetime.datetime.utcnow().isoformat()}
+        bridge.input_queue.put(doc)
+        with patch('__builtin__.True', AlmostAlwaysTrue(1)):
+            bridge.fill_resource_items_queue()
+        self.assertEqual(bridge.resource_items_queue.get(),
+                         {'id': doc['id'], 'dateModified': doc['dateModified'],
+                          'doc': doc})
+
         bridge.input_queue = Queue()
         bridge.resource_items_queue = Queue()
         bridge.workers_config['historical'] = True
@@ -404,6 +586,7 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         bridge.filler.exception = Exception('test_filler')
         bridge.input_queue_filler = MagicMock()
         bridge.input_queue_filler.exception = Exception('test_temp_filler')
+        bridge.feeder.save_checkpoint = MagicMock()
         self.assertEqual(bridge.workers_pool.free_count(),
                          bridge.workers_max)
         self.assertEqual(bridge.retry_workers_pool.free_count(),
@@ -413,37 +596,97 @@ class TestEdgeDataBridge(TenderBaseWebTest):
                          bridge.workers_max - bridge.workers_min)
         self.assertEqual(bridge.retry_workers_pool.free_count(),
                          bridge.retry_workers_max - bridge.retry_workers_min)
+        self.assertEqual(bridge.feeder.save_checkpoint.call_count, 2)
+
+        # Restart failed retry scheduler with its heap
+        retry_item = {'id': uuid.uuid4().hex, 'dateModified': None}
+        bridge.retry_scheduler.schedule(retry_item, 10)
+        bridge.retry_scheduler.start()
+        bridge.retry_scheduler.kill()
+        old_scheduler = bridge.retry_scheduler
+        bridge.gevent_watcher()
+        self.assertIsNot(bridge.retry_scheduler, old_scheduler)
+        self.assertEqual(len(bridge.retry_scheduler), 1)
+        self.assertFalse(bridge.retry_scheduler.ready())
+        self.assertIs(bridge.bulk_writer.retry_scheduler,
+                      bridge.retry_scheduler)
+
+        # Restart failed bulk writer with its pending bulk
+        bridge.bulk_writer.add({'id': 'a', '_id': 'a',
+                                'dateModified': '2017-01-01'})
+        bridge.bulk_writer.start()
+        bridge.bulk_writer.kill()
+        old_writer = bridge.bulk_writer
+        bridge.gevent_watcher()
+        self.assertIsNot(bridge.bulk_writer, old_writer)
+        self.assertIn('a', bridge.bulk_writer.bulk)
+        self.assertFalse(bridge.bulk_writer.ready())
+        bridge.bulk_writer.kill()
+        bridge.retry_scheduler.kill()
         del bridge
 
     @patch('openprocurement.edge.databridge.APIClient')
     @patch('openprocurement.edge.databridge.ResourceItemWorker.spawn')
     def test_queues_controller(self, mock_riw_spawn, mock_APIClient):
+        # Clients aren't pinned to backend
+        mock_APIClient.return_value.session.cookies = {}
         bridge = EdgeDataBridge(self.config)
-        bridge.resource_items_queue_size = 10
-        bridge.resource_items_queue = Queue(10)
+        bridge.resource_items_queue = CoalescingQueue(-1)
         for i in xrange(0, 10):
-            bridge.resource_items_queue.put('a')
+            bridge.resource_items_queue.put({'id': str(i)})
         self.assertEqual(len(bridge.workers_pool), 0)
         self.assertEqual(bridge.resource_items_queue.qsize(), 10)
+        # Nothing measured yet, one worker is added to probe throughput
         with patch('__builtin__.True', AlmostAlwaysTrue()):
             bridge.queues_controller()
         self.assertEqual(len(bridge.workers_pool), 1)
         bridge.workers_pool.add(mock_riw_spawn)
         self.assertEqual(len(bridge.workers_pool), 2)
 
+        # Backlog is drained, workers are killed one by one
         for i in xrange(0, 10):
             bridge.resource_items_queue.get()
         with patch('__builtin__.True', AlmostAlwaysTrue()):
             bridge.queues_controller()
         self.assertEqual(len(bridge.workers_pool), 1)
+        # Killed worker is tracked until it finishes its item
+        self.assertEqual(len(bridge.stopping_workers), 1)
         self.assertEqual(bridge.resource_items_queue.qsize(), 0)
+        self.assertGreater(bridge.autoscaler.completion_rate, 0)
+
+        # Rates are logged at INFO only when pool is resized
+        levels = []
+        bridge.create_api_client()
+        desired = iter([1, 0])
+        bridge.autoscaler.desired = lambda *args: next(desired)
+        with patch('openprocurement.edge.databridge.logger.log',
+                   lambda level, *args, **kwargs: levels.append(level)):
+            for _ in xrange(2):
+                with patch('__builtin__.True', AlmostAlwaysTrue()):
+                    bridge.queues_controller()
+        self.assertEqual(levels, [logging.DEBUG, logging.INFO])
+        self.assertEqual(len(bridge.workers_pool), 0)
+
+    def test__requests_counts(self):
+        bridge = EdgeDataBridge(self.config)
+        self.assertEqual(bridge._requests_counts(), (0, 0))
+        bridge.api_clients_info = {
+            'a': {'latency': LatencyStats()},
+            'b': {'latency': LatencyStats()}
+        }
+        bridge.api_clients_info['a']['latency'].add(1)
+        bridge.api_clients_info['b']['latency'].add(1)
+        bridge.api_clients_info['b']['latency'].add(2)
+        bridge.api_clients_info['b']['latency'].throttle()
+        self.assertEqual(bridge._requests_counts(), (3, 1))
 
     @patch('openprocurement.edge.databridge.APIClient')
     def test_create_api_client(self, mock_APIClient):
         mock_APIClient.side_effect = [
             RequestFailed(), Exception('Test create client exception'),
             munchify({
-                'session': {'headers': {'User-Agent': 'test.agent'}}
+                'session': {'headers': {'User-Agent': 'test.agent'},
+                            'cookies': {}}
                 })
         ]
         bridge = EdgeDataBridge(self.config)
@@ -451,28 +694,39 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         bridge.create_api_client()
         self.assertEqual(bridge.api_clients_queue.qsize(), 1)
 
+        # Budget allows only first client when exhausted
+        mock_APIClient.side_effect = None
+        mock_APIClient.return_value = munchify({
+            'session': {'headers': {'User-Agent': 'test.agent'},
+                        'cookies': {}}
+        })
+        budget = APIClientsBudget(1)
+        bridge = EdgeDataBridge(self.config, api_clients_budget=budget)
+        bridge.create_api_client()
+        bridge.create_api_client()
+        self.assertEqual(bridge.api_clients_queue.qsize(), 1)
+        self.assertEqual(budget.used, 1)
+        bridge.release_api_client(bridge.api_clients_queue.get())
+        self.assertEqual(budget.used, 0)
+        self.assertEqual(len(bridge.api_clients_info), 0)
+
         del bridge
 
     def test_resource_items_filter(self):
         bridge = EdgeDataBridge(self.config)
         date_modified_old = datetime.datetime.utcnow().isoformat()
         date_modified_newest = datetime.datetime.utcnow().isoformat()
-        side_effect = [{'dateModified': date_modified_old},
-                       {'dateModified': date_modified_newest}, None,
-                       Exception('db exception')]
-        bridge.db.get = MagicMock(side_effect=side_effect)
-        result = bridge.resource_items_filter(uuid.uuid4().hex,
-                                              date_modified_newest)
-        self.assertEqual(result, True)
-        result = bridge.resource_items_filter(uuid.uuid4().hex,
-                                              date_modified_old)
-        self.assertEqual(result, False)
-        result = bridge.resource_items_filter(uuid.uuid4().hex,
-                                              date_modified_old)
+        doc_id = uuid.uuid4().hex
+        bridge.db.get = MagicMock()
+        result = bridge.resource_items_filter(doc_id, date_modified_old)
         self.assertEqual(result, True)
-        result = bridge.resource_items_filter(uuid.uuid4().hex,
-                                              date_modified_old)
+        bridge.index.update(doc_id, date_modified_old,
+                            '1-' + uuid.uuid4().hex)
+        result = bridge.resource_items_filter(doc_id, date_modified_newest)
         self.assertEqual(result, True)
+        result = bridge.resource_items_filter(doc_id, date_modified_old)
+        self.assertEqual(result, False)
+        self.assertEqual(bridge.db.get.call_count, 0)
 
     def test_config_get(self):
         test_config = {
@@ -502,53 +756,51 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         server = Server(test_config['main'].get('couch_url') or 'http://127.0.0.1:5984')
         del server[test_config['main']['db_name']]
 
+        # Per resource overrides
+        bridge.config['main']['resources'] = {'plans': {'workers_max': 7}}
+        bridge.config['main']['workers_max'] = 3
+        self.assertEqual(bridge.config_get('workers_max'), 3)
+        bridge.resource = 'plans'
+        self.assertEqual(bridge.config_get('workers_max'), 7)
+        bridge.resource = 'contracts'
+        self.assertEqual(bridge.config_get('workers_max'), 3)
+
         del bridge.config['main']
         with self.assertRaises(DataBridgeConfigError):
             bridge.config_get('couch_url')
 
-    def test__get_average_request_duration(self):
+    def test__get_requests_percentiles(self):
         bridge = EdgeDataBridge(self.config)
         bridge.create_api_client()
         bridge.create_api_client()
         bridge.create_api_client()
-        res, _ = bridge._get_average_requests_duration()
-        self.assertEqual(res, 0)
+        self.assertEqual(bridge._get_requests_percentiles(), (0, 0, 0))
         request_duration = 1
         for k in bridge.api_clients_info:
             for i in xrange(0, 3):
-                bridge.api_clients_info[k]['request_durations'][datetime.datetime.now()] =\
-                    request_duration
+                bridge.api_clients_info[k]['latency'].add(request_duration)
             request_duration += 1
-        res, res_list = bridge._get_average_requests_duration()
-        self.assertEqual(res, 2)
-        self.assertEqual(len(res_list), 3)
-
-        delta = datetime.timedelta(seconds=301)
-        grown_date = datetime.datetime.now() - delta
-        bridge.api_clients_info[uuid.uuid4().hex] = {
-            'request_durations': {grown_date: 1},
-            'destroy': False,
-            'request_interval': 0,
-            'avg_duration': 0
-        }
-        self.assertEqual(len(bridge.api_clients_info), 4)
+        self.assertEqual(bridge._get_requests_percentiles(), (2, 3, 3))
+        self.assertEqual(
+            sorted(info['p50'] for info in bridge.api_clients_info.values()),
+            [1, 2, 3])
 
-        res, res_list = bridge._get_average_requests_duration()
-        grown = 0
-        for k in bridge.api_clients_info:
-            if bridge.api_clients_info[k].get('grown', False):
-                grown += 1
-        self.assertEqual(res, 1.75)
-        self.assertEqual(len(res_list), 4)
-        self.assertEqual(grown, 1)
+        # Samples older than perfomance_window are dropped
+        sleep(0.2)
+        self.assertEqual(bridge._get_requests_percentiles(), (0, 0, 0))
+        for info in bridge.api_clients_info.values():
+            self.assertEqual(len(info['latency']), 0)
+            self.assertTrue(info['latency'].grown)
 
-    def test__calculate_st_dev(self):
+    def test__slow_threshold(self):
         bridge = EdgeDataBridge(self.config)
-        values = [1.1, 1.11, 1.12, 1.13, 1.14]
-        stdev = bridge._calculate_st_dev(values)
-        self.assertEqual(stdev, 0.014)
-        stdev = bridge._calculate_st_dev([])
-        self.assertEqual(stdev, 0)
+        self.assertEqual(bridge._slow_threshold(), 0)
+        for _ in xrange(3):
+            bridge.create_api_client()
+        for info, p95 in zip(bridge.api_clients_info.values(), (0.2, 0.3, 5)):
+            info['latency'].add(p95)
+            info['p95'] = p95
+        self.assertEqual(bridge._slow_threshold(), 0.3)
 
     def test__mark_bad_clients(self):
         bridge = EdgeDataBridge(self.config)
@@ -559,16 +811,16 @@ class TestEdgeDataBridge(TenderBaseWebTest):
         bridge.create_api_client()
         bridge.create_api_client()
         self.assertEqual(len(bridge.api_clients_info), 3)
-        avg_duration = 1
+        p50 = 1
         req_intervals = [0, 2, 0, 0]
+        sleep(0.2)
         for cid in bridge.api_clients_info:
             self.assertEqual(bridge.api_clients_info[cid]['drop_cookies'], False)
-            bridge.api_clients_info[cid]['avg_duration'] = avg_duration
-            bridge.api_clients_info[cid]['grown'] = True
-            bridge.api_clients_info[cid]['request_interval'] = req_intervals[avg_duration]
-            avg_duration += 1
-        avg = 1.5
-        bridge._mark_bad_clients(avg)
+            self.assertTrue(bridge.api_clients_info[cid]['latency'].grown)
+            bridge.api_clients_info[cid]['p50'] = p50
+            bridge.api_clients_info[cid]['request_interval'] = req_intervals[p50]
+            p50 += 1
+        bridge._mark_bad_clients(1.5)
         self.assertEqual(len(bridge.api_clients_info), 3)
         self.assertEqual(bridge.api_clients_queue.qsize(), 3)
         to_destroy = 0
@@ -579,31 +831,32 @@ class TestEdgeDataBridge(TenderBaseWebTest):
 
     def test_perfomance_watcher(self):
         bridge = EdgeDataBridge(self.config)
+        bridge.perfomance_window = 1
         for i in xrange(0, 3):
             bridge.create_api_client()
-        req_duration = 1
-        for _, info in bridge.api_clients_info.items():
-            info['request_durations'][datetime.datetime.now()] = req_duration
-            req_duration += 1
-            self.assertEqual(info.get('grown', False), False)
-            self.assertEqual(len(info['request_durations']), 1)
+        for info, req_duration in zip(bridge.api_clients_info.values(),
+                                      (0.1, 0.2, 3)):
+            for _ in xrange(10):
+                info['latency'].add(req_duration)
+            self.assertEqual(info['latency'].grown, False)
         self.assertEqual(len(bridge.api_clients_info), 3)
         self.assertEqual(bridge.api_clients_queue.qsize(), 3)
-        sleep(1)
 
+        # Clients aren't observed for whole window yet
+        bridge.perfomance_watcher()
+        for info in bridge.api_clients_info.values():
+            self.assertFalse(info['drop_cookies'])
+            self.assertEqual(len(info['latency']), 10)
+
+        for info in bridge.api_clients_info.values():
+            info['latency'].started -= 1
         bridge.perfomance_watcher()
-        grown = 0
-        with_new_cookies = 0
-        for cid, info in bridge.api_clients_info.items():
-            if info.get('grown', False):
-                grown += 1
-            if info['drop_cookies']:
-                with_new_cookies += 1
-            self.assertEqual(len(info['request_durations']), 0)
+        with_new_cookies = [info['p50'] for info in
+                            bridge.api_clients_info.values()
+                            if info['drop_cookies']]
         self.assertEqual(len(bridge.api_clients_info), 3)
         self.assertEqual(bridge.api_clients_queue.qsize(), 3)
-        self.assertEqual(grown, 3)
-        self.assertEqual(with_new_cookies, 1)
+        self.assertEqual(with_new_cookies, [3])
 
     @patch('openprocurement.edge.databridge.EdgeDataBridge.fill_input_queue')
     @patch('openprocurement.edge.databridge.EdgeDataBridge.fill_resource_items_queue')
@@ -613,18 +866,366 @@ class TestEdgeDataBridge(TenderBaseWebTest):
     def test_run(self, mock_gevent, mock_perfomance, mock_controller,
                  mock_fill, mock_fill_input_queue):
         bridge = EdgeDataBridge(self.config)
+        doc = {'_id': uuid.uuid4().hex, 'doc_type': 'Tender',
+               'dateModified': datetime.datetime.utcnow().isoformat()}
+        bridge.db.save(doc)
         self.assertEqual(len(bridge.filter_workers_pool), 0)
         with patch('__builtin__.True', AlmostAlwaysTrue(4)):
             bridge.run()
+        self.assertEqual(bridge.index.get(doc['_id']),
+                         (doc['dateModified'], doc['_rev']))
+        self.assertFalse(bridge.bulk_writer.ready())
+        bridge.bulk_writer.kill()
         self.assertEqual(mock_fill.call_count, 1)
         self.assertEqual(mock_controller.call_count, 1)
         self.assertEqual(mock_gevent.call_count, 1)
         self.assertEqual(mock_fill_input_queue.call_count, 1)
 
+    def test_drain(self):
+        journal_dir = tempfile.mkdtemp()
+        self.config['main']['journal_dir'] = journal_dir
+        try:
+            bridge = EdgeDataBridge(self.config)
+            items = [{'id': uuid.uuid4().hex, 'dateModified': str(i)}
+                     for i in xrange(4)]
+            bridge.feeder = MagicMock()
+            bridge.feeder.stop.return_value = items[:1]
+            bridge.input_queue.put(items[1])
+            bridge.resource_items_queue.put(items[2])
+            bridge.retry_scheduler.schedule(items[3], 60)
+            # Historical item waiting for replan
+            replanned = {'id': uuid.uuid4().hex, 'dateModified': '4'}
+            replan = spawn_later(60, bridge._replan, replanned)
+            bridge.replanning[replanned['id']] = replan
+            # Worker removed by autoscaler, still busy with its item
+            stopped = Event()
+            worker = spawn(stopped.wait)
+            worker.shutdown = stopped.set
+            bridge.stopping_workers.add(worker)
+            bridge.bulk_writer.start()
+            bridge.drain()
+            self.assertTrue(bridge.stopping.is_set())
+            self.assertTrue(worker.successful())
+            self.assertEqual(len(bridge.stopping_workers), 0)
+            bridge.feeder.save_checkpoint.assert_called_once_with(
+                bridge.journal)
+            self.assertTrue(bridge.bulk_writer.ready())
+            self.assertTrue(replan.dead)
+
+            # Next start continues with items left in pipeline
+            bridge = EdgeDataBridge(self.config)
+            self.assertEqual(bridge.journal.recover(),
+                             items[:1] + [replanned] + items[1:])
+        finally:
+            del self.config['main']['journal_dir']
+            shutil.rmtree(journal_dir)
+
+    def test_drain_spill(self):
+        journal_dir = tempfile.mkdtemp()
+        self.config['main']['journal_dir'] = journal_dir
+        self.config['main']['queue_spill_dir'] = journal_dir
+        self.config['main']['queue_spill_hot_size'] = 2
+        try:
+            bridge = EdgeDataBridge(self.config)
+            items = [{'id': uuid.uuid4().hex, 'dateModified': str(i)}
+                     for i in xrange(5)]
+            for item in items[:4]:
+                bridge.resource_items_queue.put(item)
+            taken = [bridge.resource_items_queue.get() for _ in xrange(3)]
+            # Taken from spill queue memory and retried, it's lost on close
+            bridge.retry_scheduler.schedule(taken[1], 60)
+            # Taken from spill queue file and retried, it's in file still
+            bridge.retry_scheduler.schedule(taken[2], 60)
+            bridge.feeder = MagicMock()
+            bridge.feeder.stop.return_value = []
+            bridge.held_item = items[4]
+            bridge.bulk_writer.start()
+            bridge.drain()
+
+            # Items in spill file aren't journaled, item held by filler and
+            # retried one taken from memory are
+            bridge = EdgeDataBridge(self.config)
+            self.assertEqual(bridge.journal.recover(),
+                             [items[4], items[1]])
+            self.assertEqual([bridge.resource_items_queue.get()
+                              for _ in xrange(2)], items[2:4])
+        finally:
+            for key in ('journal_dir', 'queue_spill_dir',
+                        'queue_spill_hot_size'):
+                del self.config['main'][key]
+            shutil.rmtree(journal_dir)
+
+    def test_save_checkpoint(self):
+        journal_dir = tempfile.mkdtemp()
+        self.config['main']['journal_dir'] = journal_dir
+        self.config['main']['feeder_checkpoint'] = True
+        try:
+            bridge = EdgeDataBridge(self.config)
+            bridge.feeder.forward_params = {'offset': 'forward'}
+            bridge.feeder.backward_params = {}
+            bridge.feeder.cookies = RequestsCookieJar()
+            bridge.feeder.handle_response_data([
+                {'id': 'a', 'dateModified': '2017-01-01'},
+                {'id': 'b', 'dateModified': '2017-01-01'}])
+            bridge.index.update('a', '2017-01-01', '1-a')
+            bridge.save_checkpoint()
+            self.assertEqual(bridge.db.get(bridge.feeder.checkpoint_id)[
+                'forward_offset'], 'forward')
+            # Item fetched before saved offset isn't lost after crash
+            bridge.journal.close()
+            self.assertEqual(Journal(bridge.journal.path).recover(),
+                             [{'id': 'b', 'dateModified': '2017-01-01'}])
+        finally:
+            del self.config['main']['journal_dir']
+            del self.config['main']['feeder_checkpoint']
+            shutil.rmtree(journal_dir)
+
+    @patch('openprocurement.edge.databridge.EdgeDataBridge.gevent_watcher')
+    def test_run_shutdown(self, mock_gevent):
+        bridge = EdgeDataBridge(self.config)
+        bridge.start = MagicMock()
+        bridge.drain = MagicMock()
+        bridge.shutdown()
+        bridge.run()
+        self.assertEqual(bridge.drain.call_count, 1)
+
+        # Shard drains when coordinator closes its stream
+        mock_gevent.side_effect = SystemExit
+        with self.assertRaises(SystemExit):
+            bridge.run()
+        self.assertEqual(bridge.drain.call_count, 2)
+
+    def test_metrics(self):
+        bridge = EdgeDataBridge(self.config)
+        bridge.input_queue.put({'id': uuid.uuid4().hex})
+        bridge.api_clients_info['c1'] = {
+            'drop_cookies': False, 'latency': LatencyStats(),
+            'request_interval': 0.5, 'p50': 0, 'p95': 0, 'p99': 0
+        }
+        bridge.metrics.created.inc()
+        body = bridge.registry.render()
+        self.assertIn('edge_queue_size{resource="tenders",queue="input"} 1',
+                      body)
+        self.assertIn('edge_api_client_request_interval_seconds'
+                      '{resource="tenders",client="c1"} 0.5', body)
+        self.assertIn('edge_documents_saved_total{resource="tenders",'
+                      'result="created"} 1', body)
+
+        # Replaced client is not reported
+        del bridge.api_clients_info['c1']
+        self.assertNotIn('client="c1"', bridge.registry.render())
+
+        self.assertIsNone(bridge.metrics_server)
+        bridge.metrics_port = 0
+        bridge.serve_metrics()
+        response = urllib2.urlopen('http://127.0.0.1:{}/metrics'.format(
+            bridge.metrics_server.server_port))
+        self.assertEqual(response.getcode(), 200)
+        self.assertIn('edge_queue_size', response.read())
+        bridge.metrics_server.stop()
+
+    @patch('openprocurement.edge.databridge.logger')
+    def test_documents_summary(self, mock_logger):
+        bridge = EdgeDataBridge(self.config)
+        bridge.metrics.created.inc(3)
+        bridge.metrics.skip('bulk')
+        self.assertEqual(bridge.documents_summary(),
+                         {'created': 3, 'updated': 0, 'skipped': 1,
+                          'retried': 0, 'dropped': 0})
+        self.assertEqual(mock_logger.info.call_args[0][0],
+                         'Documents tenders: 3 created, 0 updated, '
+                         '1 skipped, 0 retried, 0 dropped')
+        self.assertEqual(
+            mock_logger.info.call_args[1]['extra']['CREATED_DOCUMENTS'], 3)
+
+        # Only documents since previous summary are counted
+        bridge.metrics.updated.inc()
+        self.assertEqual(bridge.documents_summary(),
+                         {'created': 0, 'updated': 1, 'skipped': 0,
+                          'retried': 0, 'dropped': 0})
+
+    def test_event_sampler(self):
+        bridge = EdgeDataBridge(self.config)
+        self.assertIsNone(bridge.event_sampler)
+        config = deepcopy(self.config)
+        config['main']['log_sample_rate'] = 0.1
+        bridge = EdgeDataBridge(config)
+        self.assertEqual(bridge.event_sampler.sample_rate, 0.1)
+        self.assertIs(bridge.events.sampler, bridge.event_sampler)
+
+
+class TestMultiResourceEdgeDataBridge(TenderBaseWebTest):
+    config = {
+        'main': {
+            'resources_api_server': 'https://lb.api-sandbox.openprocurement.org',
+            'resources_api_version': "0",
+            'couch_url': 'http://localhost:5984',
+            'db_name': 'test_db',
+            'workers_min': 0,
+            'watch_interval': 0.1,
+            'api_clients_max': 5,
+            'retrievers_params': {
+                'down_requests_sleep': 5,
+                'up_requests_sleep': 1,
+                'up_wait_sleep': 30,
+                'queue_size': 101
+            }
+        },
+        'version': 1
+    }
+
+    def tearDown(self):
+        try:
+            server = Server(self.config['main']['couch_url'])
+            del server[self.config['main']['db_name']]
+        except:
+            pass
+
+    def test_init(self):
+        config = deepcopy(self.config)
+        with self.assertRaises(DataBridgeConfigError):
+            MultiResourceEdgeDataBridge(config)
+
+        config['main']['resources'] = 'tenders, plans'
+        bridge = MultiResourceEdgeDataBridge(config)
+        self.assertEqual(bridge.resources, ['tenders', 'plans'])
+        self.assertEqual(bridge.api_clients_budget.limit, 5)
+        tenders, plans = bridge.bridges
+        self.assertEqual(tenders.workers_config['resource'], 'tenders')
+        self.assertEqual(plans.workers_config['resource'], 'plans')
+        self.assertEqual(plans.feeder.resource, 'plans')
+        for b in bridge.bridges:
+            self.assertIs(b.server, bridge.server)
+            self.assertIs(b.db, bridge.db)
+            self.assertIs(b.process, bridge.process)
+            self.assertIs(b.api_clients_budget, bridge.api_clients_budget)
+        self.assertIsNot(tenders.resource_items_queue,
+                         plans.resource_items_queue)
+        self.assertIsNot(tenders.workers_pool, plans.workers_pool)
+        self.assertIsNot(tenders.index, plans.index)
+
+        config['main']['resources'] = {'tenders': None,
+                                       'plans': {'workers_max': 7}}
+        bridge = MultiResourceEdgeDataBridge(config)
+        self.assertEqual(bridge.resources, ['plans', 'tenders'])
+        self.assertEqual(bridge.bridges[0].workers_max, 7)
+        self.assertEqual(bridge.bridges[1].workers_max,
+                         config['main'].get('workers_max') or 3)
+
+    @patch('openprocurement.edge.databridge.EdgeDataBridge.start')
+    @patch('openprocurement.edge.databridge.EdgeDataBridge.gevent_watcher')
+    def test_run(self, mock_gevent, mock_start):
+        config = deepcopy(self.config)
+        config['main']['resources'] = ['tenders', 'plans', 'contracts']
+        bridge = MultiResourceEdgeDataBridge(config)
+        with patch('__builtin__.True', AlmostAlwaysTrue(1)):
+            bridge.run()
+        self.assertEqual(mock_start.call_count, 3)
+        self.assertEqual(mock_gevent.call_count, 3)
+
+
+class TestShardedEdgeDataBridge(TenderBaseWebTest):
+    config = TestMultiResourceEdgeDataBridge.config
+
+    def tearDown(self):
+        try:
+            server = Server(self.config['main']['couch_url'])
+            del server[self.config['main']['db_name']]
+        except:
+            pass
+
+    def test_shard_init(self):
+        config = deepcopy(self.config)
+        config['main']['shards'] = 4
+        bridge = EdgeDataBridge(config, shard=2)
+        self.assertIsInstance(bridge.feeder, ShardFeeder)
+        ids = [uuid.uuid4().hex for _ in xrange(100)]
+        self.assertEqual([i for i in ids if bridge.in_shard(i)],
+                         [i for i in ids if shard_for(i, 4) == 2])
+        # Shard checkpoints through the same path as gevent_watcher
+        bridge.save_checkpoint()
+
+    @patch('openprocurement.edge.databridge.Popen')
+    def test_send_to_shard(self, mock_popen):
+        mock_popen.side_effect = lambda *args, **kwargs: MagicMock()
+        config = deepcopy(self.config)
+        config['main']['shards'] = 2
+        bridge = ShardedEdgeDataBridge(config, '/tmp/edge.yaml')
+        for shard in xrange(2):
+            bridge.spawn_shard(shard)
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertEqual(mock_popen.call_args[0][0][-3:],
+                         ['/tmp/edge.yaml', '--shard', '1'])
+
+        item = {'id': uuid.uuid4().hex, 'dateModified': '2017-01-01'}
+        shard = shard_for(item['id'], 2)
+        process = bridge.shard_processes[shard]
+        bridge.send_to_shard(item)
+        process.stdin.write.assert_called_once_with(dumps(item) + '\n')
+
+        # Broken pipe restarts shard and resends item
+        process.stdin.write.side_effect = IOError('Broken pipe')
+        process.poll.return_value = 1
+        bridge.send_to_shard(item)
+        self.assertEqual(mock_popen.call_count, 3)
+        self.assertEqual(process.stdin.write.call_count, 2)
+        self.assertIsNot(bridge.shard_processes[shard], process)
+        bridge.shard_processes[shard].stdin.write.assert_called_once_with(
+            dumps(item) + '\n')
+
+    @patch('openprocurement.edge.databridge.Popen')
+    @patch('openprocurement.edge.databridge.spawn')
+    def test_gevent_watcher(self, mock_spawn, mock_popen):
+        mock_popen.side_effect = lambda *args, **kwargs: MagicMock(
+            **{'poll.return_value': None})
+        mock_spawn.return_value = MagicMock(exception=None)
+        config = deepcopy(self.config)
+        config['main']['shards'] = 2
+        bridge = ShardedEdgeDataBridge(config, '/tmp/edge.yaml')
+        bridge.feeder.save_checkpoint = MagicMock()
+        # Stop after first watcher tick
+        bridge.stopping = MagicMock(**{'wait.return_value': True})
+        bridge.drain = MagicMock()
+        bridge.run()
+        self.assertEqual(mock_popen.call_count, 2)
+        self.assertEqual(mock_spawn.call_count, 1)
+        self.assertEqual(mock_spawn.call_args[0][0], bridge.fill_input_queue)
+        self.assertEqual(bridge.feeder.save_checkpoint.call_count, 1)
+        self.assertEqual(bridge.drain.call_count, 1)
+
+        # Dead shard and failed filler are restarted
+        bridge.shard_processes[1].poll.return_value = -9
+        bridge.input_queue_filler = MagicMock(exception=Exception('test'))
+        bridge.gevent_watcher()
+        self.assertEqual(mock_popen.call_count, 3)
+        self.assertEqual(mock_spawn.call_count, 2)
+        self.assertEqual(bridge.feeder.save_checkpoint.call_count, 3)
+
+
+class TestAPIClientsBudget(unittest.TestCase):
+
+    def test_acquire(self):
+        budget = APIClientsBudget(2)
+        self.assertTrue(budget.acquire())
+        self.assertTrue(budget.acquire(1))
+        self.assertFalse(budget.acquire(2))
+        # First client of pipeline is always allowed
+        self.assertTrue(budget.acquire(0))
+        self.assertEqual(budget.used, 3)
+        budget.release()
+        budget.release()
+        self.assertTrue(budget.acquire(1))
+        for _ in xrange(5):
+            budget.release()
+        self.assertEqual(budget.used, 0)
+
 
 def suite():
     suite = unittest.TestSuite()
     suite.addTest(unittest.makeSuite(TestEdgeDataBridge))
+    suite.addTest(unittest.makeSuite(TestMultiResourceEdgeDataBridge))
+    suite.addTest(unittest.makeSuite(TestShardedEdgeDataBridge))
+    suite.addTest(unittest.makeSuite(TestAPIClientsBudget))
     return suite
 
 
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import logging
+import unittest
+from mock import MagicMock, patch
+from openprocurement.edge.events import EventLog, EventSampler
+
+
+class TestEventLog(unittest.TestCase):
+
+    def setUp(self):
+        self.logger = MagicMock()
+        self.logger.isEnabledFor.side_effect = lambda level: (
+            level >= self.level)
+        self.level = logging.DEBUG
+
+    def test_debug(self):
+        events = EventLog(self.logger)
+        events.debug('put_client', 'PUT API CLIENT: {}', 'a',
+                     CLIENT_ID='a')
+        self.logger.debug.assert_called_once_with(
+            'PUT API CLIENT: a',
+            extra={'MESSAGE_ID': 'put_client', 'CLIENT_ID': 'a'})
+
+        events.debug(None, 'Get {} {} from main queue.', 'tender', 'b')
+        self.logger.debug.assert_called_with('Get tender b from main queue.')
+
+        events.info('add_to_retry', 'Put to retry queue {}', 'c')
+        self.logger.info.assert_called_once_with(
+            'Put to retry queue c', extra={'MESSAGE_ID': 'add_to_retry'})
+
+    def test_disabled(self):
+        self.level = logging.INFO
+        events = EventLog(self.logger)
+        template = MagicMock()
+        events.debug('put_client', template, 'a')
+        self.assertEqual(template.format.call_count, 0)
+        self.assertEqual(self.logger.debug.call_count, 0)
+        self.assertFalse(events.enabled())
+        self.assertTrue(events.enabled(logging.INFO))
+
+    @patch('openprocurement.edge.events.random')
+    def test_sampling(self, mock_random):
+        mock_random.side_effect = [0.5, 0.05, 0.5, 0.5, 0.01]
+        events = EventLog(self.logger, EventSampler(0.1))
+        for i in range(5):
+            events.debug('get_client', 'GET API CLIENT: {}', i)
+        self.assertEqual(self.logger.debug.call_args_list[0][0][0],
+                         'GET API CLIENT: 1')
+        self.assertEqual(self.logger.debug.call_args_list[0][1]['extra'],
+                         {'MESSAGE_ID': 'get_client',
+                          'SUPPRESSED_EVENTS': 1})
+        self.assertEqual(self.logger.debug.call_args_list[1][1]['extra'],
+                         {'MESSAGE_ID': 'get_client',
+                          'SUPPRESSED_EVENTS': 2})
+
+        # Info events are not sampled
+        events.info('add_to_retry', 'Put to retry queue {}', 'c')
+        self.assertEqual(self.logger.info.call_count, 1)
+
+    @patch('openprocurement.edge.events.monotonic')
+    def test_rate(self, mock_monotonic):
+        mock_monotonic.side_effect = [0, 0, 0, 0.25, 1]
+        events = EventLog(self.logger, EventSampler(rate=2))
+        for i in range(4):
+            events.info('add_to_retry', 'Put to retry queue {}', i)
+        self.assertEqual(self.logger.info.call_count, 2)
+        # Other events have own bucket
+        events.info(None, 'Save bulk {} docs to db.', 1)
+        self.assertEqual(self.logger.info.call_count, 3)
+        self.assertEqual(events.sampler.suppressed, {'add_to_retry': 2})
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestEventLog))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
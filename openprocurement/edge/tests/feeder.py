@@ -0,0 +1,316 @@
+# -*- coding: utf-8 -*-
+import unittest
+import logging
+import uuid
+from couchdb import ResourceConflict
+from json import dumps
+from mock import MagicMock, patch
+from munch import munchify
+from openprocurement_client.exceptions import RequestFailed
+from requests.cookies import RequestsCookieJar
+from StringIO import StringIO
+from openprocurement.edge.feeder import (
+    ResourceFeeder,
+    ShardFeeder,
+    shard_for,
+    CHECKPOINT_ID
+)
+from openprocurement.edge.journal import UnsavedItems
+
+logger = logging.getLogger()
+logger.level = logging.DEBUG
+
+
+class TestResourceFeeder(unittest.TestCase):
+
+    retrievers_params = {
+        'down_requests_sleep': 5,
+        'up_requests_sleep': 1,
+        'up_wait_sleep': 30,
+        'queue_size': 101
+    }
+
+    def setUp(self):
+        self.db = MagicMock()
+        self.feeder = ResourceFeeder(
+            db=self.db, host='http://localhost', version='2.3',
+            resource='tenders', retrievers_params=self.retrievers_params)
+        self.feeder.forward_params = {'feed': 'changes'}
+        self.feeder.backward_params = {'feed': 'changes',
+                                       'descending': True}
+        self.feeder.cookies = RequestsCookieJar()
+
+    def test_init(self):
+        self.assertEqual(self.feeder.db, self.db)
+        self.assertEqual(self.feeder.checkpoint_id,
+                         CHECKPOINT_ID.format('tenders'))
+        self.assertEqual(self.feeder.backward_done, False)
+        self.assertEqual(self.feeder.unsaved, None)
+
+    def test_restore_checkpoint(self):
+        self.db.get.return_value = {
+            '_id': CHECKPOINT_ID.format('tenders'),
+            '_rev': '0-1',
+            'forward_offset': 'forward',
+            'backward_offset': 'backward',
+            'backward_done': False,
+            'cookies': {'SERVER_ID': 'server'}
+        }
+        self.feeder.restore_checkpoint()
+        self.db.get.assert_called_once_with(CHECKPOINT_ID.format('tenders'))
+        self.assertEqual(self.feeder.forward_params['offset'], 'forward')
+        self.assertEqual(self.feeder.backward_params['offset'], 'backward')
+        self.assertEqual(self.feeder.cookies['SERVER_ID'], 'server')
+        self.assertEqual(self.feeder.backward_done, False)
+
+        # Checkpoint is loaded once and kept in memory
+        self.feeder.forward_params = {'feed': 'changes'}
+        self.feeder.restore_checkpoint()
+        self.assertEqual(self.db.get.call_count, 1)
+        self.assertEqual(self.feeder.forward_params['offset'], 'forward')
+
+        # Without checkpoint
+        self.feeder.forward_params = {'feed': 'changes'}
+        self.feeder.checkpoint = None
+        self.db.get.return_value = None
+        self.feeder.restore_checkpoint()
+        self.assertNotIn('offset', self.feeder.forward_params)
+
+        # Error while loading checkpoint
+        self.db.get.side_effect = Exception('test')
+        self.feeder.restore_checkpoint()
+        self.assertNotIn('offset', self.feeder.forward_params)
+        self.assertEqual(self.feeder.checkpoint, None)
+
+    def test_save_checkpoint(self):
+        # Nothing to save before first response
+        self.feeder.save_checkpoint()
+        self.assertEqual(self.db.save.call_count, 0)
+
+        self.feeder.forward_params['offset'] = 'forward'
+        self.feeder.backward_params['offset'] = 'backward'
+        self.feeder.cookies.set('SERVER_ID', 'server')
+        self.feeder.save_checkpoint()
+        self.db.save.assert_called_once_with({
+            '_id': CHECKPOINT_ID.format('tenders'),
+            'forward_offset': 'forward',
+            'backward_offset': 'backward',
+            'backward_done': False,
+            'cookies': {'SERVER_ID': 'server'}
+        })
+        self.assertEqual(self.feeder.checkpoint['forward_offset'], 'forward')
+
+        # Failed save doesn't change checkpoint kept in memory
+        self.db.save.side_effect = Exception('test')
+        self.feeder.forward_params['offset'] = 'next'
+        self.feeder.save_checkpoint()
+        self.assertEqual(self.feeder.checkpoint['forward_offset'], 'forward')
+
+        # Conflict reloads checkpoint
+        self.db.save.side_effect = ResourceConflict()
+        self.db.get.return_value = {'_id': CHECKPOINT_ID.format('tenders'),
+                                    '_rev': '0-2'}
+        self.feeder.save_checkpoint()
+        self.assertEqual(self.feeder.checkpoint['_rev'], '0-2')
+
+        # Other errors are logged
+        self.db.save.side_effect = Exception('test')
+        self.feeder.save_checkpoint()
+        self.assertEqual(self.db.save.call_count, 4)
+
+        # Without db
+        feeder = ResourceFeeder(retrievers_params=self.retrievers_params)
+        feeder.save_checkpoint()
+
+    def test_save_checkpoint_journal(self):
+        journal = MagicMock()
+        self.feeder.unsaved = UnsavedItems()
+        self.feeder.handle_response_data([
+            {'id': 'a', 'dateModified': '2017-01-01'},
+            {'id': 'b', 'dateModified': '2017-01-02'}])
+        self.assertEqual(self.feeder.queue.qsize(), 2)
+        self.feeder.unsaved.settle('a')
+        self.feeder.forward_params['offset'] = 'forward'
+        self.feeder.save_checkpoint(journal)
+        journal.checkpoint.assert_called_once_with(
+            [{'id': 'b', 'dateModified': '2017-01-02'}])
+        self.assertEqual(self.db.save.call_count, 1)
+
+        # Offsets aren't saved without journal of items fetched before them
+        journal.checkpoint.side_effect = IOError('test')
+        self.feeder.save_checkpoint(journal)
+        self.assertEqual(self.db.save.call_count, 1)
+
+    @patch('openprocurement.edge.feeder.spawn')
+    def test_start_sync(self, mocked_spawn):
+        self.feeder.backward_client = MagicMock()
+        self.feeder.forward_params['offset'] = 'forward'
+        self.feeder.backward_params['offset'] = 'backward'
+        self.feeder.start_sync()
+        self.assertEqual(self.feeder.backward_client.sync_tenders.call_count,
+                         0)
+        self.assertEqual(mocked_spawn.call_args_list[0][0][0],
+                         self.feeder.retriever_backward)
+        self.assertEqual(mocked_spawn.call_args_list[1][0][0],
+                         self.feeder.retriever_forward)
+
+        # Backward retriever already finished
+        self.feeder.backward_done = True
+        self.feeder.start_sync()
+        self.assertEqual(mocked_spawn.call_count, 4)
+        self.assertEqual(mocked_spawn.call_args_list[2][0][0](), 0)
+
+        # Without checkpoint offsets sync started from scratch
+        del self.feeder.forward_params['offset']
+        response = MagicMock()
+        response.data = []
+        self.feeder.backward_client.sync_tenders.return_value = response
+        self.feeder.start_sync()
+        self.assertEqual(self.feeder.backward_client.sync_tenders.call_count,
+                         1)
+        self.assertEqual(self.feeder.backward_done, False)
+
+    @patch('openprocurement.edge.feeder.BaseResourceFeeder.retriever_backward')
+    def test_retriever_backward(self, mocked_retriever):
+        mocked_retriever.return_value = 0
+        self.assertEqual(self.feeder.retriever_backward(), 0)
+        self.assertEqual(self.feeder.backward_done, True)
+
+    @patch('openprocurement.edge.feeder.BaseResourceFeeder.init_api_clients')
+    def test_init_api_clients(self, mocked_init):
+        self.feeder.restore_checkpoint = MagicMock()
+        self.feeder.init_api_clients()
+        self.assertEqual(self.feeder.restore_checkpoint.call_count, 1)
+        self.feeder.forward_worker = MagicMock()
+        self.feeder.backward_worker = MagicMock()
+        self.feeder.get_resource_items()
+        self.assertEqual(self.feeder.forward_worker.kill.call_count, 1)
+        self.assertEqual(self.feeder.backward_worker.kill.call_count, 1)
+
+        # Feeder without db doesn't restore checkpoint
+        feeder = ResourceFeeder(retrievers_params=self.retrievers_params)
+        feeder.restore_checkpoint = MagicMock()
+        feeder.init_api_clients()
+        self.assertEqual(feeder.restore_checkpoint.call_count, 0)
+
+    @patch('openprocurement.edge.feeder.BaseResourceFeeder.init_api_clients')
+    def test_limit_requests(self, mocked_init):
+        def init_api_clients():
+            self.feeder.forward_client = MagicMock()
+            self.feeder.backward_client = MagicMock()
+        mocked_init.side_effect = init_api_clients
+        rate_limiter = MagicMock()
+        self.feeder.rate_limiter = rate_limiter
+        self.feeder.restore_checkpoint = MagicMock()
+        self.feeder.init_api_clients()
+
+        # Feed requests are limited with workers ones
+        self.feeder.forward_client.sync_tenders({'feed': 'changes'})
+        self.feeder.backward_client.sync_tenders({'feed': 'changes'})
+        self.assertEqual(rate_limiter.acquire.call_count, 2)
+        self.assertEqual(rate_limiter.on_success.call_count, 2)
+
+        # 429 slows down limiter, retriever handles error itself
+        throttled = RequestFailed(munchify({'status_code': 429,
+                                            'headers': {}}))
+        mocked_init.side_effect = None
+        self.feeder.forward_client = MagicMock()
+        self.feeder.forward_client.sync_tenders.side_effect = throttled
+        self.feeder.limit_requests(self.feeder.forward_client)
+        with self.assertRaises(RequestFailed):
+            self.feeder.forward_client.sync_tenders({'feed': 'changes'})
+        rate_limiter.on_throttle.assert_called_once_with(None)
+        self.assertEqual(rate_limiter.on_success.call_count, 2)
+
+        # Other errors aren't throttling
+        self.feeder.backward_client = MagicMock()
+        self.feeder.backward_client.sync_tenders.side_effect = RequestFailed(
+            munchify({'status_code': 500}))
+        self.feeder.limit_requests(self.feeder.backward_client)
+        with self.assertRaises(RequestFailed):
+            self.feeder.backward_client.sync_tenders({'feed': 'changes'})
+        self.assertEqual(rate_limiter.on_throttle.call_count, 1)
+        self.assertEqual(rate_limiter.acquire.call_count, 4)
+
+    @patch('openprocurement.edge.feeder.spawn')
+    @patch('openprocurement.edge.feeder.BaseResourceFeeder.init_api_clients')
+    def test_restart_sync(self, mocked_init, mocked_spawn):
+        def init_api_clients():
+            # Retrievers get fresh params without offsets
+            self.feeder.forward_params = {'feed': 'changes'}
+            self.feeder.backward_params = {'feed': 'changes',
+                                           'descending': True}
+            self.feeder.backward_client = MagicMock()
+            self.feeder.cookies = RequestsCookieJar()
+        mocked_init.side_effect = init_api_clients
+        self.db.get.return_value = {
+            '_id': CHECKPOINT_ID.format('tenders'),
+            'forward_offset': 'forward',
+            'backward_offset': 'backward',
+            'backward_done': True,
+            'cookies': {'SERVER_ID': 'server'}
+        }
+        self.feeder.forward_worker = MagicMock()
+        self.feeder.backward_worker = MagicMock()
+        self.feeder.restart_sync()
+        self.feeder.forward_params['offset'] = 'forward_next'
+        self.db.save.return_value = None
+        self.feeder.save_checkpoint()
+
+        # Restarted after LB mismatch continues from saved checkpoint
+        self.feeder.restart_sync()
+        self.assertEqual(self.db.get.call_count, 1)
+        self.assertEqual(self.feeder.forward_params['offset'],
+                         'forward_next')
+        self.assertEqual(self.feeder.backward_params['offset'], 'backward')
+        self.assertEqual(self.feeder.cookies['SERVER_ID'], 'server')
+        self.assertEqual(self.feeder.backward_client.sync_tenders.call_count,
+                         0)
+        self.assertEqual(mocked_spawn.call_args[0][0],
+                         self.feeder.retriever_forward)
+
+    def test_stop(self):
+        self.feeder.forward_worker = MagicMock()
+        self.feeder.backward_worker = None
+        self.feeder.queue.put({'id': 'a'})
+        self.feeder.queue.put({'id': 'b'})
+        self.assertEqual(self.feeder.stop(), [{'id': 'a'}, {'id': 'b'}])
+        self.assertEqual(self.feeder.forward_worker.kill.call_count, 1)
+        self.assertEqual(self.feeder.queue.qsize(), 0)
+
+class TestShardFeeder(unittest.TestCase):
+
+    def test_shard_for(self):
+        ids = [uuid.uuid4().hex for _ in xrange(1000)]
+        shards = [shard_for(item_id, 4) for item_id in ids]
+        self.assertEqual(set(shards), set([0, 1, 2, 3]))
+        # Routing is stable
+        self.assertEqual(shards, [shard_for(item_id, 4) for item_id in ids])
+        self.assertEqual(set(shard_for(item_id, 1) for item_id in ids),
+                         set([0]))
+
+    def test_get_resource_items(self):
+        items = [{'id': uuid.uuid4().hex, 'dateModified': '2017-01-01'},
+                 {'id': uuid.uuid4().hex, 'dateModified': '2017-01-02'}]
+        feeder = ShardFeeder(StringIO(
+            ''.join(dumps(item) + '\n' for item in items)))
+        result = feeder.get_resource_items()
+        self.assertEqual(next(result), items[0])
+        self.assertEqual(next(result), items[1])
+        # Closed stream stops shard
+        with self.assertRaises(SystemExit):
+            next(result)
+        feeder.save_checkpoint()
+        feeder.save_checkpoint(None)
+        self.assertEqual(feeder.stop(), [])
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestResourceFeeder))
+    suite.addTest(unittest.makeSuite(TestShardFeeder))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from mock import MagicMock
+from openprocurement.edge.history import (
+    RevisionsCache,
+    is_snapshot_rev,
+    make_delta,
+    rebuild_revision
+)
+
+
+class TestRevisionsCache(unittest.TestCase):
+
+    def test_put_get(self):
+        cache = RevisionsCache(size=2)
+        cache.put('a', '1', {'rev': '1'})
+        cache.put('a', 2, {'rev': '2'})
+        self.assertEqual(cache.get('a', 1), {'rev': '1'})
+        # Least recently used revision is evicted
+        cache.put('b', 1, {'rev': '1'})
+        self.assertEqual(len(cache), 2)
+        self.assertIsNone(cache.get('a', 2))
+        self.assertEqual(cache.get('a', '1'), {'rev': '1'})
+        self.assertEqual(cache.get('b', 1), {'rev': '1'})
+
+
+class TestHistory(unittest.TestCase):
+
+    def setUp(self):
+        self.item_id = uuid.uuid4().hex
+        self.revisions = [
+            {'id': self.item_id, 'rev': '1', 'status': 'draft',
+             'items': [{'quantity': 1}]},
+            {'id': self.item_id, 'rev': '2', 'status': 'active',
+             'items': [{'quantity': 1}]},
+            {'id': self.item_id, 'rev': '3', 'status': 'active',
+             'items': [{'quantity': 1}, {'quantity': 5}]}
+        ]
+        self.stored = {
+            self.item_id + '-1': dict(self.revisions[0],
+                                      _id=self.item_id + '-1',
+                                      doc_type='Tender'),
+            self.item_id + '-2': make_delta(self.revisions[0],
+                                            self.revisions[1]),
+            self.item_id + '-3': make_delta(self.revisions[1],
+                                            self.revisions[2])
+        }
+        self.db = MagicMock()
+        self.db.view.side_effect = lambda name, include_docs, keys: [
+            {'key': key, 'doc': self.stored[key]} if key in self.stored
+            else {'key': key, 'error': 'not_found'} for key in keys]
+
+    def test_is_snapshot_rev(self):
+        self.assertEqual([rev for rev in xrange(1, 12)
+                          if is_snapshot_rev(rev, 5)], [1, 6, 11])
+        self.assertTrue(is_snapshot_rev('1', 1))
+        self.assertTrue(is_snapshot_rev('2', 1))
+
+    def test_make_delta(self):
+        delta = make_delta(self.revisions[0], self.revisions[1])
+        self.assertEqual(delta['id'], self.item_id)
+        self.assertEqual(delta['rev'], '2')
+        self.assertIn({'op': 'replace', 'path': '/status',
+                       'value': 'active'}, delta['patch'])
+        self.assertNotIn('status', delta)
+
+    def test_rebuild_revision(self):
+        for revision in self.revisions:
+            self.assertEqual(
+                rebuild_revision(self.db, self.item_id, revision['rev'], 5),
+                revision)
+        self.db.view.assert_called_with(
+            '_all_docs', include_docs=True,
+            keys=[self.item_id + '-1', self.item_id + '-2',
+                  self.item_id + '-3'])
+
+        # Patch chain is broken
+        del self.stored[self.item_id + '-2']
+        self.assertIsNone(rebuild_revision(self.db, self.item_id, 3, 5))
+
+        # No snapshot within interval
+        self.assertIsNone(rebuild_revision(self.db, self.item_id, 3, 1))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRevisionsCache))
+    suite.addTest(unittest.makeSuite(TestHistory))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,92 @@
+# -*- coding: utf-8 -*-
+import unittest
+import datetime
+import uuid
+from mock import MagicMock, call
+from munch import munchify
+from openprocurement.edge.index import ResourceItemsIndex
+
+
+class TestResourceItemsIndex(unittest.TestCase):
+
+    def test_update(self):
+        index = ResourceItemsIndex()
+        doc_id = uuid.uuid4().hex
+        date_modified = datetime.datetime.utcnow().isoformat()
+        rev = '1-' + uuid.uuid4().hex
+        self.assertEqual(len(index), 0)
+        self.assertNotIn(doc_id, index)
+        self.assertEqual(index.get(doc_id), None)
+        self.assertEqual(index.date_modified(doc_id), None)
+
+        index.update(doc_id, rev=rev)
+        self.assertIn(doc_id, index)
+        self.assertEqual(index.get(doc_id), (None, rev))
+        index.update(doc_id, date_modified=date_modified)
+        self.assertEqual(index.get(doc_id), (date_modified, rev))
+        self.assertEqual(index.date_modified(doc_id), date_modified)
+
+        new_rev = '2-' + uuid.uuid4().hex
+        new_date_modified = datetime.datetime.utcnow().isoformat()
+        index.update(doc_id, new_date_modified, new_rev)
+        self.assertEqual(index.get(doc_id), (new_date_modified, new_rev))
+        self.assertEqual(len(index), 1)
+        self.assertEqual(len(index.dates), 1)
+        self.assertEqual(len(index.revs), 1)
+
+    def test_refresh(self):
+        index = ResourceItemsIndex()
+        db = MagicMock()
+        doc = {'_id': uuid.uuid4().hex, '_rev': '3-' + uuid.uuid4().hex,
+               'dateModified': datetime.datetime.utcnow().isoformat()}
+        db.get.return_value = doc
+        index.refresh(db, doc['_id'])
+        self.assertEqual(index.get(doc['_id']),
+                         (doc['dateModified'], doc['_rev']))
+        db.get.return_value = None
+        index.refresh(db, uuid.uuid4().hex)
+        self.assertEqual(len(index), 1)
+
+    def test_bootstrap(self):
+        index = ResourceItemsIndex()
+        db = MagicMock()
+        doc_id_1 = uuid.uuid4().hex
+        doc_id_2 = uuid.uuid4().hex
+        doc_id_3 = uuid.uuid4().hex
+        date_modified = datetime.datetime.utcnow().isoformat()
+        view_rows = [munchify({'id': doc_id, 'key': date_modified})
+                     for doc_id in (doc_id_1, doc_id_2, doc_id_3)]
+        revs = {doc_id_1: '1-b', doc_id_2: '2-c', doc_id_3: '3-d'}
+        db.iterview.return_value = view_rows
+        db.view.side_effect = lambda path, keys: [
+            {'id': key, 'key': key, 'value': {'rev': revs[key]}}
+            for key in keys]
+        index.bootstrap(db, '_design/tenders/_view/by_dateModified', 2)
+        db.iterview.assert_called_once_with(
+            '_design/tenders/_view/by_dateModified', 2)
+        # Revisions of view documents only, batch by batch
+        self.assertEqual(db.view.call_args_list, [
+            call('_all_docs', keys=[doc_id_1, doc_id_2]),
+            call('_all_docs', keys=[doc_id_3])])
+        self.assertEqual(len(index), 3)
+        self.assertEqual(index.get(doc_id_1), (date_modified, '1-b'))
+        self.assertEqual(index.get(doc_id_3), (date_modified, '3-d'))
+
+        # Document deleted meanwhile
+        index = ResourceItemsIndex()
+        db.view.side_effect = None
+        db.view.return_value = [{'key': doc_id_1, 'error': 'not_found'}]
+        index.bootstrap(db, '_design/tenders/_view/by_dateModified', 10,
+                        lambda item_id: item_id == doc_id_1)
+        self.assertEqual(len(index), 1)
+        self.assertEqual(index.get(doc_id_1), (date_modified, None))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestResourceItemsIndex))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from openprocurement.edge.items import QueueItem, compact_str
+from openprocurement.edge.queues import CoalescingQueue
+from openprocurement.edge.retry import retry_delay
+
+
+class TestQueueItem(unittest.TestCase):
+
+    def test_compact_str(self):
+        item_id = uuid.uuid4().hex
+        self.assertIsInstance(compact_str(unicode(item_id)), str)
+        self.assertIs(compact_str(unicode(item_id), intern_value=True),
+                      compact_str(unicode(item_id), intern_value=True))
+        self.assertEqual(compact_str(u'дата'), u'дата')
+        self.assertEqual(compact_str(None), None)
+        self.assertEqual(compact_str(5), 5)
+
+    def test_item(self):
+        item_id = uuid.uuid4().hex
+        item = QueueItem(unicode(item_id), u'2017-01-01')
+        self.assertFalse(hasattr(item, '__dict__'))
+        self.assertIs(item.id, QueueItem(unicode(item_id)).id)
+        self.assertEqual(item['id'], item_id)
+        self.assertEqual(item['dateModified'], '2017-01-01')
+        self.assertIsNone(item['rev'])
+        with self.assertRaises(KeyError):
+            item['status']
+        with self.assertRaises(KeyError):
+            item['status'] = 'active'
+
+        # Fields set to None are absent
+        self.assertIn('dateModified', item)
+        self.assertNotIn('rev', item)
+        self.assertEqual(item.get('doc', {}), {})
+        self.assertEqual(item.keys(), ['id', 'dateModified'])
+        self.assertEqual(len(item), 2)
+        self.assertEqual(dict(item), {'id': item_id,
+                                      'dateModified': '2017-01-01'})
+        self.assertEqual(item, {'id': item_id, 'dateModified': '2017-01-01',
+                                'rev': None})
+        self.assertNotEqual(item, {'id': item_id})
+        self.assertNotEqual(item, QueueItem(item_id, '2017-01-02'))
+        self.assertNotEqual(item, None)
+
+    def test_from_item(self):
+        resource_item = {'id': 'a', 'rev': 3, 'timeout': 2,
+                         'retries_count': 1}
+        item = QueueItem.from_item(resource_item)
+        self.assertEqual(item, resource_item)
+
+        # Retry starts over, document isn't kept
+        item.doc = {'id': 'a'}
+        self.assertEqual(QueueItem.for_retry(item), {'id': 'a', 'rev': 3})
+
+    def test_pipeline(self):
+        config = {'retry_default_timeout': 1, 'retry_max_timeout': 5,
+                  'retry_jitter': 0}
+        item = QueueItem('a', '2017-01-01')
+        self.assertEqual(retry_delay(item, config), 1)
+        self.assertEqual(item['timeout'], 2)
+        self.assertEqual(item['retries_count'], 1)
+
+        queue = CoalescingQueue()
+        queue.put(item)
+        queue.put(QueueItem('a', '2017-01-02'))
+        queue.put(QueueItem('a', rev=1))
+        self.assertEqual(queue.get()['dateModified'], '2017-01-02')
+        self.assertEqual(queue.get()['rev'], 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestQueueItem))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
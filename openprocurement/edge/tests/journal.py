@@ -0,0 +1,117 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from openprocurement.edge.index import ResourceItemsIndex
+from openprocurement.edge.journal import Journal, UnsavedItems
+
+
+class TestJournal(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'tenders_journal.jsonl')
+        self.items = [
+            {'id': 'a', 'dateModified': '2017-01-01', 'data': 'x'},
+            {'id': 'b', 'dateModified': '2017-01-02'},
+            {'id': 'c', 'rev': '1-c'}
+        ]
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_recover(self):
+        journal = Journal(self.path)
+        self.assertEqual(journal.recover(), [])
+        journal.begin(self.items[:2])
+        journal.begin(self.items[2:])
+        journal.begin([])
+        journal.done(self.items[:1])
+        # Other version of saved item is still pending
+        journal.begin([dict(self.items[1], dateModified='2017-01-03')])
+        journal.close()
+
+        journal = Journal(self.path)
+        self.assertEqual(journal.recover(), [
+            {'id': 'b', 'dateModified': '2017-01-02'},
+            {'id': 'c', 'rev': '1-c'},
+            {'id': 'b', 'dateModified': '2017-01-03'}
+        ])
+        # Recovered items are removed from journal
+        self.assertEqual(journal.recover(), [])
+
+    def test_partial_record(self):
+        journal = Journal(self.path)
+        journal.begin(self.items[:1])
+        journal.close()
+        with open(self.path, 'ab') as journal_file:
+            journal_file.write('["+", [{"id": "b"')
+        self.assertEqual(Journal(self.path).recover(),
+                         [{'id': 'a', 'dateModified': '2017-01-01'}])
+
+    def test_compact(self):
+        journal = Journal(self.path, compact_records=3)
+        journal.begin(self.items[:1])
+        journal.begin(self.items[1:2])
+        journal.done(self.items[:1])
+        self.assertEqual(journal.records, 0)
+        with open(self.path, 'rb') as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 1)
+        journal.begin(self.items[2:])
+        journal.close()
+        self.assertEqual([item['id'] for item in Journal(self.path).recover()],
+                         ['b', 'c'])
+
+    def test_checkpoint(self):
+        journal = Journal(self.path)
+        journal.begin(self.items[:1])
+        journal.checkpoint(self.items[:2])
+        # Later checkpoint replaces items of previous one
+        journal.checkpoint(self.items[1:2])
+        journal.begin(self.items[2:])
+        journal.close()
+        with open(self.path, 'rb') as journal_file:
+            self.assertEqual(len(journal_file.readlines()), 3)
+        self.assertEqual([item['id'] for item in Journal(self.path).recover()],
+                         ['a', 'c', 'b'])
+
+
+class TestUnsavedItems(unittest.TestCase):
+
+    def test_unsaved(self):
+        unsaved = UnsavedItems()
+        unsaved.add('a', '2017-01-01')
+        unsaved.add('b', '2017-01-01')
+        unsaved.add('c', '2017-01-01')
+        unsaved.add('a', '2017-01-02')
+        self.assertEqual(len(unsaved), 3)
+
+        index = ResourceItemsIndex()
+        index.update('a', '2017-01-01', '1-a')
+        index.update('b', '2017-01-01', '1-b')
+        unsaved.prune(index)
+        # Only older version of 'a' is saved
+        self.assertEqual(unsaved.refs(), [
+            {'id': 'a', 'dateModified': '2017-01-02'},
+            {'id': 'c', 'dateModified': '2017-01-01'}])
+
+        # Newer version isn't settled with older one
+        unsaved.settle('a', '2017-01-01')
+        unsaved.settle('c', '2017-01-01')
+        unsaved.settle('d')
+        self.assertEqual(unsaved.refs(),
+                         [{'id': 'a', 'dateModified': '2017-01-02'}])
+        unsaved.settle('a')
+        self.assertEqual(len(unsaved), 0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestJournal))
+    suite.addTest(unittest.makeSuite(TestUnsavedItems))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
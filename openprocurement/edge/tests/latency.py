@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+import unittest
+from time import sleep
+from openprocurement.edge.latency import LatencyStats, percentile
+
+
+class TestLatencyStats(unittest.TestCase):
+
+    def test_percentile(self):
+        self.assertEqual(percentile([], 50), 0)
+        values = range(1, 101)
+        self.assertEqual(percentile(values, 50), 50)
+        self.assertEqual(percentile(values, 95), 95)
+        self.assertEqual(percentile(values, 99), 99)
+        self.assertEqual(percentile(values, 100), 100)
+        self.assertEqual(percentile([7], 0), 7)
+
+    def test_add(self):
+        stats = LatencyStats(size=3, window=0.1)
+        for duration in (4, 1, 3, 2):
+            stats.add(duration)
+        # Ring buffer keeps last samples only
+        self.assertEqual(len(stats), 3)
+        self.assertEqual(stats.durations(), [1, 2, 3])
+        self.assertEqual(stats.percentiles(50, 99), (2, 3))
+        self.assertFalse(stats.grown)
+
+        sleep(0.2)
+        self.assertTrue(stats.grown)
+        self.assertEqual(stats.durations(), [])
+        self.assertEqual(len(stats), 0)
+
+        stats.add(1)
+        stats.reset()
+        self.assertEqual(len(stats), 0)
+        self.assertFalse(stats.grown)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestLatencyStats))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
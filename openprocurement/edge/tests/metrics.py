@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+import unittest
+from openprocurement.edge.metrics import (
+    CONTENT_TYPE,
+    MetricsRegistry,
+    PipelineMetrics,
+    format_labels
+)
+
+
+class TestMetricsRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+
+    def start_response(self, status, headers):
+        self.status = status
+        self.headers = dict(headers)
+
+    def test_counter(self):
+        counter = self.registry.counter('edge_saved_total', 'Saved',
+                                        ('resource',))
+        self.assertIs(self.registry.counter('edge_saved_total', 'Saved'),
+                      counter)
+        counter.labels('tenders').inc()
+        counter.labels('tenders').inc(2)
+        counter.labels('plans').set(1.5)
+        self.assertEqual(self.registry.render(), '\n'.join([
+            '# HELP edge_saved_total Saved',
+            '# TYPE edge_saved_total counter',
+            'edge_saved_total{resource="tenders"} 3',
+            'edge_saved_total{resource="plans"} 1.5',
+        ]) + '\n')
+
+        counter.clear('tenders')
+        self.assertNotIn('tenders', self.registry.render())
+
+    def test_histogram(self):
+        histogram = self.registry.histogram('edge_request_seconds', 'Request',
+                                            buckets=(0.1, 1))
+        value = histogram.labels()
+        for duration in (0.05, 0.1, 0.5, 2):
+            value.observe(duration)
+        lines = self.registry.render().splitlines()
+        self.assertEqual(lines[2:], [
+            'edge_request_seconds_bucket{le="0.1"} 2',
+            'edge_request_seconds_bucket{le="1"} 3',
+            'edge_request_seconds_bucket{le="+Inf"} 4',
+            'edge_request_seconds_sum 2.65',
+            'edge_request_seconds_count 4',
+        ])
+
+    def test_labels_escaped(self):
+        self.assertEqual(format_labels(('client', 'reason'),
+                                       (u'a"b', u'лінія\n')),
+                         '{client="a\\"b",reason="лінія\\n"}')
+
+    def test_collectors(self):
+        gauge = self.registry.gauge('edge_queue_size', 'Queue size')
+
+        def collect():
+            gauge.labels().set(7)
+
+        def broken():
+            raise ValueError('Broken collector')
+
+        self.registry.add_collector(broken)
+        self.registry.add_collector(collect)
+        self.assertIn('edge_queue_size 7', self.registry.render())
+
+    def test_wsgi(self):
+        self.registry.gauge('edge_workers', 'Workers').labels().set(2)
+        body = ''.join(self.registry({'PATH_INFO': '/metrics'},
+                                     self.start_response))
+        self.assertEqual(self.status, '200 OK')
+        self.assertEqual(self.headers['Content-Type'], CONTENT_TYPE)
+        self.assertIn('edge_workers 2', body)
+
+        self.registry({'PATH_INFO': '/health'}, self.start_response)
+        self.assertEqual(self.status, '404 Not Found')
+
+    def test_pipeline_metrics(self):
+        tenders = PipelineMetrics(self.registry, 'tenders')
+        plans = PipelineMetrics(self.registry, 'plans')
+        tenders.created.inc()
+        tenders.skip('bulk')
+        tenders.retry('conflict')
+        plans.dropped.inc()
+        plans.upstream_request.observe(0.2)
+        body = self.registry.render()
+        self.assertIn('edge_documents_saved_total{resource="tenders",'
+                      'result="created"} 1', body)
+        self.assertIn('edge_documents_skipped_total{resource="tenders",'
+                      'stage="bulk"} 1', body)
+        self.assertIn('edge_documents_retried_total{resource="tenders",'
+                      'reason="conflict"} 1', body)
+        self.assertIn('edge_documents_dropped_total{resource="plans"} 1',
+                      body)
+        self.assertIn('edge_upstream_request_seconds_count{resource="plans"} '
+                      '1', body)
+        # Families are shared by pipelines
+        self.assertEqual(body.count('# TYPE edge_documents_saved_total'), 1)
+
+        # Metrics without registry are kept aside
+        metrics = PipelineMetrics()
+        metrics.created.inc()
+        self.assertEqual(metrics.created.value, 1)
+
+    def test_pipeline_totals(self):
+        tenders = PipelineMetrics(self.registry, 'tenders')
+        plans = PipelineMetrics(self.registry, 'plans')
+        tenders.updated.inc(2)
+        tenders.skip('bulk')
+        tenders.skip('check')
+        tenders.retry('conflict')
+        plans.skip('bulk')
+        self.assertEqual(tenders.totals(), {'created': 0, 'updated': 2,
+                                            'skipped': 2, 'retried': 1,
+                                            'dropped': 0})
+        self.assertEqual(plans.totals()['skipped'], 1)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestMetricsRegistry))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
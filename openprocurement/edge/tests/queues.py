@@ -0,0 +1,84 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from gevent import sleep, spawn
+from gevent.queue import Empty, Full
+from openprocurement.edge.queues import CoalescingQueue
+
+
+class TestCoalescingQueue(unittest.TestCase):
+
+    def test_coalesce(self):
+        queue = CoalescingQueue()
+        first = {'id': uuid.uuid4().hex, 'dateModified': '2017-01-01'}
+        second = {'id': uuid.uuid4().hex, 'dateModified': '2017-01-01'}
+        queue.put(first)
+        queue.put(second)
+        # Newer version replaces pending item in place
+        newer = {'id': first['id'], 'dateModified': '2017-01-02'}
+        queue.put(newer)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.coalesced, 1)
+        # Older version and version without dateModified are dropped
+        queue.put(first)
+        queue.put({'id': first['id'], 'dateModified': None})
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.coalesced, 3)
+        self.assertEqual(queue.get(), newer)
+        self.assertEqual(queue.get(), second)
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.got, 2)
+
+        # Pending item without dateModified is replaced by dated one
+        queue.put({'id': first['id'], 'dateModified': None})
+        queue.put(first)
+        self.assertEqual(queue.get(), first)
+
+        # Historical revisions are not coalesced with each other
+        queue.put({'id': first['id'], 'rev': 1})
+        queue.put({'id': first['id'], 'rev': 2})
+        queue.put({'id': first['id'], 'rev': 2})
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(queue.coalesced, 5)
+
+    def test_maxsize(self):
+        queue = CoalescingQueue(-1)
+        self.assertEqual(queue.maxsize, None)
+        self.assertFalse(queue.full())
+
+        queue = CoalescingQueue(1)
+        item = {'id': uuid.uuid4().hex, 'dateModified': '2017-01-01'}
+        queue.put(item)
+        self.assertTrue(queue.full())
+        # Coalesced put doesn't need free place
+        queue.put_nowait({'id': item['id'], 'dateModified': '2017-01-02'})
+        with self.assertRaises(Full):
+            queue.put_nowait({'id': uuid.uuid4().hex})
+        with self.assertRaises(Full):
+            queue.put({'id': uuid.uuid4().hex}, timeout=0.05)
+        other = {'id': uuid.uuid4().hex}
+        spawn(queue.put, other)
+        sleep(0)
+        self.assertEqual(queue.get()['dateModified'], '2017-01-02')
+        sleep(0)
+        self.assertEqual(queue.get_nowait(), other)
+
+    def test_get(self):
+        queue = CoalescingQueue()
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.05)
+        item = {'id': uuid.uuid4().hex}
+        spawn(lambda: sleep(0.05) or queue.put(item))
+        self.assertEqual(queue.get(), item)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestCoalescingQueue))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,88 @@
+# -*- coding: utf-8 -*-
+import unittest
+from email.utils import formatdate
+from mock import MagicMock
+from time import time
+from openprocurement.edge.latency import monotonic
+from openprocurement.edge.ratelimit import RateLimiter, retry_after
+
+
+class TestRateLimiter(unittest.TestCase):
+
+    def test_retry_after(self):
+        exc = MagicMock()
+        exc.response.headers = {}
+        self.assertEqual(retry_after(exc), None)
+        self.assertEqual(retry_after(Exception()), None)
+
+        exc.response.headers = {'Retry-After': '3'}
+        self.assertEqual(retry_after(exc), 3)
+        exc.response.headers = {'Retry-After': '-3'}
+        self.assertEqual(retry_after(exc), 0)
+
+        exc.response.headers = {'Retry-After': formatdate(time() + 60,
+                                                          usegmt=True)}
+        self.assertTrue(55 < retry_after(exc) <= 60)
+        exc.response.headers = {'Retry-After': 'later'}
+        self.assertEqual(retry_after(exc), None)
+
+    def test_on_success(self):
+        limiter = RateLimiter(rate=2, rate_max=3)
+        limiter.on_success()
+        self.assertEqual(limiter.rate, 2.5)
+        for _ in xrange(10):
+            limiter.on_success()
+        self.assertEqual(limiter.rate, 3)
+
+    def test_on_throttle(self):
+        limiter = RateLimiter(rate=8, rate_min=3)
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 4)
+        self.assertEqual(limiter.blocked_until, 0)
+        # Burst of 429 is counted once
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 4)
+
+        limiter.decreased -= 1
+        limiter.on_throttle()
+        self.assertEqual(limiter.rate, 3)
+
+        limiter.on_throttle(retry_after=10)
+        self.assertEqual(limiter.tokens, 0)
+        self.assertTrue(limiter.blocked_until > monotonic() + 9)
+
+    def test_acquire(self):
+        limiter = RateLimiter(rate=20)
+        start = monotonic()
+        for _ in xrange(3):
+            limiter.acquire()
+        # First request goes at once, next ones are paced
+        self.assertTrue(monotonic() - start >= 0.09)
+
+        limiter.on_throttle(retry_after=0.2)
+        start = monotonic()
+        limiter.acquire()
+        self.assertTrue(monotonic() - start >= 0.19)
+
+    def test_acquire_high_rate(self):
+        # Above 100 requests/sec pacing relies on sub-10 ms clock, requests
+        # are spread evenly instead of bursts at clock ticks
+        limiter = RateLimiter(rate=400, rate_max=400)
+        sent = []
+        for _ in xrange(41):
+            limiter.acquire()
+            sent.append(monotonic())
+        gaps = [b - a for a, b in zip(sent, sent[1:])]
+        self.assertTrue(sent[-1] - sent[0] >= 0.095)
+        self.assertTrue(max(gaps) < 0.008)
+        self.assertTrue(sum(1 for gap in gaps if gap < 0.0005) < 5)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRateLimiter))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -0,0 +1,67 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+from gevent.pywsgi import WSGIServer
+from requests import Session
+from openprocurement.edge.benchmark import FakeUpstream
+from openprocurement.edge.recorder import TrafficRecorder, read_records
+
+
+class TestTrafficRecorder(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.upstream = FakeUpstream(docs=3, doc_size=512, latency=0)
+        self.server = WSGIServer(('127.0.0.1', 0), self.upstream, log=None)
+        self.server.start()
+        self.url = 'http://127.0.0.1:{}/api/2.3/tenders'.format(
+            self.server.server_port)
+        self.session = Session()
+
+    def tearDown(self):
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_record(self):
+        recorder = TrafficRecorder(self.directory, 'tenders')
+        recorder.attach(self.session)
+        self.session.get(self.url, params={'feed': 'changes'})
+        item_id = self.upstream.item_ids[0]
+        self.session.get('{}/{}'.format(self.url, item_id))
+        self.assertEqual(recorder.records, 2)
+        recorder.close()
+
+        feed, document = read_records(self.directory)
+        self.assertEqual(feed['path'], '/api/2.3/tenders?feed=changes')
+        self.assertEqual(feed['status'], 200)
+        self.assertEqual(document['method'], 'GET')
+        self.assertIn(item_id, document['body'])
+        self.assertIn('ETag', document['headers'])
+        self.assertLessEqual(feed['time'], document['time'])
+        self.assertGreaterEqual(document['elapsed'], 0)
+
+    def test_segments(self):
+        recorder = TrafficRecorder(self.directory, 'tenders',
+                                   segment_bytes=1, flush_interval=0)
+        recorder.attach(self.session)
+        for item_id in self.upstream.item_ids:
+            self.session.get('{}/{}'.format(self.url, item_id))
+        self.assertEqual(len(os.listdir(self.directory)), 3)
+
+        # Last segment isn't closed, but its records were flushed
+        records = list(read_records(self.directory))
+        self.assertEqual([record['path'].rsplit('/', 1)[1]
+                          for record in records], self.upstream.item_ids)
+        recorder.close()
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestTrafficRecorder))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
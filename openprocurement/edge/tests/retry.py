@@ -0,0 +1,116 @@
+# -*- coding: utf-8 -*-
+import unittest
+import uuid
+from gevent import sleep
+from gevent.queue import Queue
+from openprocurement.edge.retry import (
+    RetryScheduler,
+    retry_delay,
+    RETRY_POLICIES
+)
+
+
+class TestRetryDelay(unittest.TestCase):
+
+    config = {
+        'retry_default_timeout': 1,
+        'retry_max_timeout': 10,
+        'retry_jitter': 0.2
+    }
+
+    def test_retry_delay(self):
+        item = {'id': uuid.uuid4().hex}
+        delay = retry_delay(item, self.config)
+        self.assertTrue(0.8 <= delay <= 1.2)
+        self.assertEqual(item['timeout'], 2)
+        self.assertEqual(item['retries_count'], 1)
+
+        delay = retry_delay(item, self.config)
+        self.assertTrue(1.6 <= delay <= 2.4)
+        self.assertEqual(item['timeout'], 4)
+        self.assertEqual(item['retries_count'], 2)
+
+        # Timeout is limited by retry_max_timeout
+        for _ in xrange(3):
+            retry_delay(item, self.config)
+        self.assertEqual(item['timeout'], 10)
+        self.assertEqual(item['retries_count'], 5)
+
+    def test_retry_delay_policies(self):
+        # 429 doesn't increase timeout, but counts retries
+        item = {'id': uuid.uuid4().hex}
+        retry_delay(item, self.config, 'too_many_requests')
+        retry_delay(item, self.config, 'too_many_requests')
+        self.assertEqual(item['timeout'], 1)
+        self.assertEqual(item['retries_count'], 2)
+
+        # Save conflicts are retried soon
+        item = {'id': uuid.uuid4().hex}
+        delay = retry_delay(item, self.config, 'conflict')
+        self.assertLess(delay, 0.2)
+        self.assertEqual(item['retries_count'], 1)
+
+        # Unknown reason uses default policy
+        item = {'id': uuid.uuid4().hex}
+        retry_delay(item, self.config, 'unknown')
+        self.assertEqual(item['timeout'],
+                         RETRY_POLICIES['default']['factor'])
+
+
+class TestRetryScheduler(unittest.TestCase):
+
+    def test_schedule(self):
+        queue = Queue()
+        scheduler = RetryScheduler(queue)
+        first = {'id': uuid.uuid4().hex}
+        second = {'id': uuid.uuid4().hex}
+        third = {'id': uuid.uuid4().hex}
+        scheduler.schedule(second, 0.2)
+        self.assertTrue(scheduler.wakeup.is_set())
+        scheduler.wakeup.clear()
+        # Later item doesn't wake up scheduler
+        scheduler.schedule(third, 1)
+        self.assertFalse(scheduler.wakeup.is_set())
+        scheduler.schedule(first, 0.1)
+        self.assertTrue(scheduler.wakeup.is_set())
+        self.assertEqual(len(scheduler), 3)
+        self.assertEqual(scheduler.release_due(), 0)
+        sleep(0.25)
+        self.assertEqual(scheduler.release_due(), 2)
+        self.assertEqual(queue.get(), first)
+        self.assertEqual(queue.get(), second)
+        self.assertEqual(len(scheduler), 1)
+
+    def test_run(self):
+        queue = Queue()
+        scheduler = RetryScheduler(queue)
+        scheduler.start()
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(3)]
+        scheduler.schedule(items[0], 0.3)
+        scheduler.schedule(items[1], 0.05)
+        scheduler.schedule(items[2], 0)
+        sleep(0.1)
+        self.assertEqual(queue.qsize(), 2)
+        self.assertEqual(len(scheduler), 1)
+        self.assertEqual(queue.get(), items[2])
+        self.assertEqual(queue.get(), items[1])
+        sleep(0.3)
+        self.assertEqual(queue.get(), items[0])
+        scheduler.shutdown()
+        sleep(0)
+        self.assertTrue(scheduler.ready())
+
+        # Restarted scheduler keeps heap of previous one
+        scheduler = RetryScheduler(queue, scheduler.heap)
+        self.assertEqual(len(scheduler), 0)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestRetryDelay))
+    suite.addTest(unittest.makeSuite(TestRetryScheduler))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
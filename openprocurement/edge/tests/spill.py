@@ -0,0 +1,174 @@
+# -*- coding: utf-8 -*-
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from gevent import sleep, spawn
+from gevent.monkey import get_original
+from gevent.queue import Empty, Full
+from openprocurement.edge.items import QueueItem
+from openprocurement.edge.spill import SpillQueue
+
+
+class TestSpillQueue(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, 'queue.sqlite')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp_dir)
+
+    def test_put_get(self):
+        queue = SpillQueue(self.path, hot_size=2)
+        self.assertTrue(queue.empty())
+        self.assertFalse(queue.full())
+        items = [{'id': uuid.uuid4().hex, 'dateModified': str(i)}
+                 for i in xrange(5)]
+        for item in items:
+            queue.put(item)
+        self.assertEqual(queue.qsize(), 5)
+        # Only backlog beyond hot size is spilled
+        self.assertEqual(len(queue.memory), 2)
+        self.assertEqual(queue.spilled, 3)
+        self.assertEqual(queue.get(), items[0])
+        queue.put_nowait({'id': 'last'})
+        self.assertEqual(queue.get(), items[1])
+        # Only one batch is read to memory
+        self.assertEqual(queue.get(), items[2])
+        self.assertEqual(len(queue.hot), 1)
+        self.assertEqual([queue.get() for _ in xrange(3)],
+                         items[3:] + [{'id': 'last'}])
+        self.assertTrue(queue.empty())
+        self.assertEqual(queue.got, 6)
+
+        # Queue reused after it was drained
+        queue.put(QueueItem('next', rev=1))
+        self.assertEqual(queue.get_nowait(), {'id': 'next', 'rev': 1})
+
+    def test_get_timeout(self):
+        queue = SpillQueue(self.path)
+        with self.assertRaises(Empty):
+            queue.get(timeout=0.05)
+        with self.assertRaises(Empty):
+            queue.get_nowait()
+        item = {'id': uuid.uuid4().hex}
+        spawn(lambda: sleep(0.05) or queue.put(item))
+        self.assertEqual(queue.get(timeout=1), item)
+        spawn(lambda: sleep(0.05) or queue.put(item))
+        self.assertEqual(queue.get(), item)
+
+    def test_restore(self):
+        queue = SpillQueue(self.path, hot_size=2)
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(5)]
+        for item in items:
+            queue.put(item)
+        queue.get()
+        queue.get()
+        queue.get()
+        queue.close()
+
+        # Items of last read batch are delivered again
+        queue = SpillQueue(self.path, hot_size=2)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([queue.get() for _ in xrange(3)], items[2:])
+        queue.close()
+
+        queue = SpillQueue(self.path, hot_size=2)
+        self.assertEqual(queue.qsize(), 1)
+        queue.close()
+
+    def test_close(self):
+        queue = SpillQueue(self.path, hot_size=2)
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(7)]
+        for item in items[:4]:
+            queue.put(item)
+        self.assertEqual(queue.get(), items[0])
+        queue.close()
+
+        # Items kept in memory are written on close before spilled ones
+        queue = SpillQueue(self.path, hot_size=2)
+        self.assertEqual(queue.qsize(), 3)
+        self.assertEqual([queue.get() for _ in xrange(3)], items[1:4])
+        self.assertEqual(queue.spilled, 0)
+        for item in items[4:]:
+            queue.put(item)
+        self.assertEqual(len(queue.memory), 2)
+        queue.close()
+
+        # Item of last read batch is delivered again
+        queue = SpillQueue(self.path, hot_size=2)
+        self.assertEqual([queue.get() for _ in xrange(queue.qsize())],
+                         items[3:])
+        queue.close()
+
+    def test_read_items(self):
+        queue = SpillQueue(self.path, hot_size=2)
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(3)]
+        for item in items:
+            queue.put(item)
+        self.assertEqual(queue.read_items(), [])
+        # Items which were kept in memory aren't in file
+        queue.get()
+        queue.get()
+        self.assertEqual(queue.read_items(), [])
+        queue.get()
+        self.assertEqual(queue.read_items(), items[2:])
+
+    def test_max_size(self):
+        queue = SpillQueue(self.path, hot_size=2, max_size=2)
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(3)]
+        queue.put(items[0])
+        queue.put(items[1])
+        self.assertTrue(queue.full())
+        with self.assertRaises(Full):
+            queue.put_nowait(items[2])
+        with self.assertRaises(Full):
+            queue.put(items[2], timeout=0.05)
+        # Blocked put continues when item is taken
+        putter = spawn(queue.put, items[2])
+        sleep(0.05)
+        self.assertFalse(putter.ready())
+        self.assertEqual(queue.get(), items[0])
+        putter.join(timeout=1)
+        self.assertTrue(putter.successful())
+        self.assertEqual([queue.get() for _ in xrange(2)], items[1:])
+
+    def test_thread_pool(self):
+        get_ident = get_original('thread', 'get_ident')
+        main = get_ident()
+        queue = SpillQueue(self.path, hot_size=1)
+        queue.put({'id': uuid.uuid4().hex})
+        threads = []
+        insert = queue._insert
+        queue._insert = lambda item: threads.append(get_ident()) or \
+            insert(item)
+        # Other greenlets run while item is written
+        ticker = spawn(lambda: threads.append(None))
+        queue.put({'id': uuid.uuid4().hex})
+        self.assertTrue(ticker.ready())
+        self.assertNotIn(main, threads)
+        self.assertEqual(len(threads), 2)
+
+    def test_concurrent_get(self):
+        queue = SpillQueue(self.path, hot_size=2)
+        items = [{'id': uuid.uuid4().hex} for _ in xrange(5)]
+        for item in items:
+            queue.put(item)
+        getters = [spawn(queue.get) for _ in xrange(5)]
+        for getter in getters:
+            getter.join(timeout=1)
+        self.assertEqual(sorted(getter.value['id'] for getter in getters),
+                         sorted(item['id'] for item in items))
+        self.assertTrue(queue.empty())
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestSpillQueue))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
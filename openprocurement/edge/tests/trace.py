@@ -0,0 +1,103 @@
+# -*- coding: utf-8 -*-
+import unittest
+from mock import patch
+from time import time
+from openprocurement.edge.metrics import MetricsRegistry
+from openprocurement.edge.trace import PipelineTracer, format_trace
+
+
+class TestPipelineTracer(unittest.TestCase):
+
+    def setUp(self):
+        self.registry = MetricsRegistry()
+        self.tracer = PipelineTracer(1, slow_threshold=5, max_traces=2,
+                                     registry=self.registry,
+                                     resource='tenders')
+
+    @patch('openprocurement.edge.trace.monotonic')
+    @patch('openprocurement.edge.trace.logger')
+    def test_trace(self, mock_logger, mock_monotonic):
+        mock_monotonic.side_effect = [10, 10.5, 12, 12.25]
+        self.tracer.start('a')
+        self.tracer.mark('a', 'input_queue')
+        self.tracer.mark('a', 'batch')
+        self.tracer.finish('a', 'skipped')
+        self.assertEqual(len(self.tracer), 0)
+        stage = self.tracer.stage_seconds['batch']
+        self.assertEqual((stage.count, stage.sum), (1, 1.5))
+        total = self.tracer.total_seconds['skipped']
+        self.assertEqual((total.count, total.sum), (1, 2.25))
+        self.assertEqual(mock_logger.warning.call_count, 0)
+
+        # Untraced items are ignored
+        self.tracer.mark('b', 'batch')
+        self.tracer.finish('b', 'saved')
+        self.assertEqual(self.tracer.total_seconds['saved'].count, 0)
+
+    @patch('openprocurement.edge.trace.monotonic')
+    @patch('openprocurement.edge.trace.logger')
+    def test_slow_trace(self, mock_logger, mock_monotonic):
+        mock_monotonic.side_effect = [0, 1, 7, 7]
+        self.tracer.start('a')
+        self.tracer.mark('a', 'main_queue')
+        self.tracer.mark('a', 'upstream')
+        self.tracer.finish('a', 'saved')
+        self.assertEqual(mock_logger.warning.call_count, 1)
+        self.assertIn('main_queue 1.000, upstream 6.000',
+                      mock_logger.warning.call_args[0][0])
+        self.assertEqual(
+            mock_logger.warning.call_args[1]['extra']['TRACE_DURATION'], 7)
+
+    def test_short_stages(self):
+        # Stage spans shorter than 10 ms are measured, not rounded to 0
+        for _ in xrange(20):
+            self.tracer.start('a')
+            start = time()
+            while time() - start < 0.002:
+                pass
+            self.tracer.mark('a', 'check')
+            trace = self.tracer.traces['a']
+            self.assertTrue(0.002 <= trace[1][1] - trace[0][1] < 0.01)
+            self.tracer.finish('a', 'skipped')
+        self.assertEqual(self.tracer.stage_seconds['check'].count, 20)
+
+    def test_sampling(self):
+        self.tracer.start('a')
+        trace = self.tracer.traces['a']
+        # Newer version of traced item continues its trace
+        self.tracer.start('a')
+        self.assertIs(self.tracer.traces['a'], trace)
+        # Oldest unfinished trace is forgotten
+        self.tracer.start('b')
+        self.tracer.start('c')
+        self.assertEqual(self.tracer.traces.keys(), ['b', 'c'])
+
+        tracer = PipelineTracer(0, registry=self.registry,
+                                resource='tenders')
+        tracer.start('a')
+        self.assertEqual(len(tracer), 0)
+
+    def test_metrics(self):
+        self.tracer.start('a')
+        self.tracer.mark('a', 'bulk_docs')
+        body = self.registry.render()
+        self.assertIn('edge_trace_stage_seconds_count{resource="tenders",'
+                      'stage="bulk_docs",kind="service"} 1', body)
+        self.assertIn('edge_trace_stage_seconds_bucket{resource="tenders",'
+                      'stage="main_queue",kind="wait",le="900"} 0', body)
+
+    def test_format_trace(self):
+        self.assertEqual(format_trace([('feed', 1), ('input_queue', 1.5),
+                                       ('batch', 3)]),
+                         'input_queue 0.500, batch 1.500')
+        self.assertEqual(format_trace([('feed', 1)]), '')
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestPipelineTracer))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
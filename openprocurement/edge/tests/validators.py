@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+import unittest
+from openprocurement.edge.validators import Validators
+
+
+class TestValidators(unittest.TestCase):
+
+    def test_update(self):
+        validators = Validators(size=2)
+        self.assertEqual(validators.headers('a'), {})
+        self.assertIsNone(validators.date_modified('a'))
+
+        validators.update('a', {'ETag': 'W/"1"',
+                                'Last-Modified': 'Wed, 10 May 2017'}, '1')
+        self.assertEqual(validators.headers('a'), {'If-None-Match': 'W/"1"'})
+        self.assertEqual(validators.date_modified('a'), '1')
+        validators.update('b', {'Last-Modified': 'Wed, 10 May 2017'}, '2')
+        self.assertEqual(validators.headers('b'),
+                         {'If-Modified-Since': 'Wed, 10 May 2017'})
+
+        # Response without validators forgets previous one
+        validators.update('b', {}, '3')
+        self.assertEqual(validators.headers('b'), {})
+        self.assertEqual(len(validators), 1)
+
+        # Least recently used entry is evicted
+        validators.update('b', {'ETag': '"2"'}, '3')
+        validators.headers('a')
+        validators.update('c', {'ETag': '"3"'}, '4')
+        self.assertEqual(len(validators), 2)
+        self.assertIsNone(validators.get('b'))
+        self.assertIsNotNone(validators.get('a'))
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestValidators))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
@@ -3,7 +3,6 @@ import datetime
 import unittest
 import uuid
 import logging
-from copy import deepcopy
 from gevent import sleep, idle
 from gevent.queue import Queue, Empty
 from mock import MagicMock, patch, call
@@ -15,9 +14,16 @@ from openprocurement_client.exceptions import (
     ResourceNotFound as RNF,
     ResourceGone
 )
+from openprocurement.edge.clients import APIClientsPool
+from openprocurement.edge.history import RevisionsCache
+from openprocurement.edge.index import ResourceItemsIndex
+from openprocurement.edge.journal import UnsavedItems
+from openprocurement.edge.latency import LatencyStats
+from openprocurement.edge.retry import RetryScheduler
+from openprocurement.edge.trace import PipelineTracer
+from openprocurement.edge.validators import Validators
 from openprocurement.edge.workers import ResourceItemWorker
 from openprocurement.edge.workers import logger
-from openprocurement.edge.utils import TZ
 
 logger.setLevel(logging.DEBUG)
 
@@ -29,22 +35,35 @@ class TestResourceItemWorker(unittest.TestCase):
         'client_inc_step_timeout': 0.1,
         'client_dec_step_timeout': 0.02,
         'drop_threshold_client_cookies': 1.5,
-        'worker_sleep': 0.1,
         'retry_default_timeout': 0.5,
         'retries_count': 2,
+        'retry_max_timeout': 5,
+        'retry_jitter': 0.1,
         'queue_timeout': 0.3,
         'bulk_save_limit': 1,
         'bulk_save_interval': 0.1,
         'historical': False,
+        'historical_delta': False,
+        'historical_snapshot_interval': 3,
         'token': '',
     }
 
+    def setUp(self):
+        self.schedulers = []
+
+    def retry_scheduler(self, retry_queue):
+        scheduler = RetryScheduler(retry_queue)
+        scheduler.start()
+        self.schedulers.append(scheduler)
+        return scheduler
+
     def tearDown(self):
+        for scheduler in self.schedulers:
+            scheduler.shutdown()
         self.worker_config['resource'] = 'tenders'
         self.worker_config['client_inc_step_timeout'] = 0.1
         self.worker_config['client_dec_step_timeout'] = 0.02
         self.worker_config['drop_threshold_client_cookies'] = 1.5
-        self.worker_config['worker_sleep'] = 0.03
         self.worker_config['retry_default_timeout'] = 0.05
         self.worker_config['retries_count'] = 2
         self.worker_config['queue_timeout'] = 0.03
@@ -68,7 +87,8 @@ class TestResourceItemWorker(unittest.TestCase):
         retry_items_queue = Queue()
         worker = ResourceItemWorker(
             config_dict=self.worker_config,
-            retry_resource_items_queue=retry_items_queue)
+            retry_resource_items_queue=retry_items_queue,
+            retry_scheduler=self.retry_scheduler(retry_items_queue))
         retry_item = {
             'id': uuid.uuid4().hex,
             'dateModified': datetime.datetime.utcnow().isoformat(),
@@ -84,17 +104,28 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(retry_item_from_queue['timeout'],
                          worker.config['retry_default_timeout'] * 2)
 
-        # Add to retry_resource_items_queue with status_code '429'
+        # Add to retry_resource_items_queue with status_code '429', pace
+        # is kept, attempt is counted
         worker.add_to_retry_queue(retry_item, status_code=429)
         retry_item_from_queue = retry_items_queue.get()
-        self.assertEqual(retry_item_from_queue['retries_count'], 1)
+        self.assertEqual(retry_item_from_queue['retries_count'], 2)
         self.assertEqual(retry_item_from_queue['timeout'],
                          worker.config['retry_default_timeout'] * 2)
 
+        # Item throttled every time is dropped too
+        worker.add_to_retry_queue(retry_item, status_code=429)
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_items_queue.qsize(), 0)
+        self.assertEqual(worker.metrics.dropped.value, 1)
+
         # Drop from retry_resource_items_queue
+        worker.unsaved = UnsavedItems()
+        worker.unsaved.add(retry_item['id'], retry_item['dateModified'])
         retry_item['retries_count'] = 3
         worker.add_to_retry_queue(retry_item)
         self.assertEqual(retry_items_queue.qsize(), 0)
+        # Dropped item doesn't hold feed checkpoint
+        self.assertEqual(len(worker.unsaved), 0)
 
         del worker
 
@@ -117,12 +148,14 @@ class TestResourceItemWorker(unittest.TestCase):
             client_dict['id']: {
                 'drop_cookies': False,
                 'not_actual_count': 5,
-                'request_interval': 3
+                'request_interval': 3,
+                'latency': LatencyStats()
             },
             client_dict2['id']: {
                 'drop_cookies': True,
                 'not_actual_count': 3,
-                'request_interval': 2
+                'request_interval': 2,
+                'latency': LatencyStats()
             }
         }
 
@@ -135,9 +168,12 @@ class TestResourceItemWorker(unittest.TestCase):
         self.assertEqual(api_client, client_dict)
 
         # Get lazy client
+        api_clients_info[client_dict2['id']]['latency'].add(1)
         api_client = worker._get_api_client_dict()
         self.assertEqual(api_client['not_actual_count'], 0)
         self.assertEqual(api_client['request_interval'], 0)
+        self.assertEqual(len(api_clients_info[client_dict2['id']]['latency']),
+                         0)
 
         # Empty queue test
         api_client = worker._get_api_client_dict()
@@ -195,7 +231,7 @@ class TestResourceItemWorker(unittest.TestCase):
         }
         api_clients_queue.put(client_dict)
         api_clients_info = \
-            {client_dict['id']: {'drop_cookies': False, 'request_durations': {}}}
+            {client_dict['id']: {'drop_cookies': False, 'latency': LatencyStats()}}
         retry_queue = Queue()
         return_dict = {
             'data': {
@@ -207,6 +243,7 @@ class TestResourceItemWorker(unittest.TestCase):
         worker = ResourceItemWorker(api_clients_queue=api_clients_queue,
                                     config_dict=self.worker_config,
                                     retry_resource_items_queue=retry_queue,
+                                    retry_scheduler=self.retry_scheduler(retry_queue),
                                     api_clients_info=api_clients_info)
 
         # Success test
@@ -308,7 +345,7 @@ class TestResourceItemWorker(unittest.TestCase):
             'id': uuid.uuid4().hex,
             'dateModified': datetime.datetime.utcnow().isoformat()
         }
-        api_clients_queue = Queue()
+        api_clients_queue = APIClientsPool()
         client_dict = {
             'id': uuid.uuid4().hex,
             'request_interval': 0.02,
@@ -316,7 +353,7 @@ class TestResourceItemWorker(unittest.TestCase):
         }
         api_clients_queue.put(client_dict)
         api_clients_info =\
-            {client_dict['id']: {'drop_cookies': False, 'request_durations': {}}}
+            {client_dict['id']: {'drop_cookies': False, 'latency': LatencyStats()}}
         retry_queue = Queue()
         return_dict = {
             'data': {
@@ -328,6 +365,7 @@ class TestResourceItemWorker(unittest.TestCase):
         worker = ResourceItemWorker(api_clients_queue=api_clients_queue,
                                     config_dict=self.worker_config,
                                     retry_resource_items_queue=retry_queue,
+                                    retry_scheduler=self.retry_scheduler(retry_queue),
                                     api_clients_info=api_clients_info)
 
         # Success test
@@ -416,10 +454,13 @@ class TestResourceItemWorker(unittest.TestCase):
         mock_api_client.get_resource_item.side_effect = ResourceGone(munchify(
             {'status_code': 410}
         ))
+        worker.unsaved = UnsavedItems()
+        worker.unsaved.add(item['id'], item['dateModified'])
         api_client = worker._get_api_client_dict()
         self.assertEqual(worker.api_clients_queue.qsize(), 0)
         public_item = worker._get_resource_item_from_public(api_client, item)
         self.assertEqual(public_item, None)
+        self.assertEqual(len(worker.unsaved), 0)
         self.assertEqual(worker.api_clients_queue.qsize(), 1)
         self.assertEqual(api_client['request_interval'], 0)
         sleep(worker.config['retry_default_timeout'] * 2)
@@ -437,133 +478,313 @@ class TestResourceItemWorker(unittest.TestCase):
 
         del worker
 
-    def test__add_to_bulk(self):
-        self.worker_config['historical'] = True
-        retry_queue = Queue()
-        queue_resource_item = {
-            'doc_type': 'Tender',
+    @patch('openprocurement_client.client.TendersClient')
+    def test__get_resource_item_from_public_rate_limiter(self,
+                                                         mock_api_client):
+        item = {
             'id': uuid.uuid4().hex,
-            'rev': str(randint(10, 99))
+            'dateModified': datetime.datetime.utcnow().isoformat()
         }
-        resource_item_dict = {
-            'doc_type': 'Tender',
-            'id': queue_resource_item['id'],
-            'rev': queue_resource_item['rev']
+        api_clients_queue = APIClientsPool()
+        client_dict = {
+            'id': uuid.uuid4().hex,
+            'request_interval': 0,
+            'client': mock_api_client
         }
-        worker = ResourceItemWorker(config_dict=self.worker_config,
-                                    retry_resource_items_queue=retry_queue)
-        worker.db = MagicMock()
+        api_clients_info =\
+            {client_dict['id']: {'drop_cookies': False, 'latency': LatencyStats()}}
+        retry_queue = Queue()
+        rate_limiter = MagicMock()
+        mock_api_client.get_resource_item.return_value = {'data': item}
+        worker = ResourceItemWorker(api_clients_queue=api_clients_queue,
+                                    config_dict=self.worker_config,
+                                    retry_resource_items_queue=retry_queue,
+                                    retry_scheduler=self.retry_scheduler(retry_queue),
+                                    api_clients_info=api_clients_info,
+                                    rate_limiter=rate_limiter)
 
-        # Successful adding to bulk
-        start_length = len(worker.bulk)
-        worker._add_to_bulk(resource_item_dict)
-        end_length = len(worker.bulk)
-        self.assertGreater(end_length, start_length)
+        public_item = worker._get_resource_item_from_public(client_dict, item)
+        self.assertEqual(public_item, item)
+        self.assertEqual(rate_limiter.acquire.call_count, 1)
+        self.assertEqual(rate_limiter.on_success.call_count, 1)
 
-        self.worker_config['historical'] = False
-        retry_queue = Queue()
-        old_date_modified = datetime.datetime.utcnow().isoformat()
-        queue_resource_item = {
-            'doc_type': 'Tender',
+        # RequestFailed status_code=429 slows down whole bridge
+        api_clients_queue.get()
+        mock_api_client.get_resource_item.side_effect = RequestFailed(
+            munchify({'status_code': 429}))
+        public_item = worker._get_resource_item_from_public(client_dict, item)
+        self.assertEqual(public_item, None)
+        self.assertEqual(rate_limiter.acquire.call_count, 2)
+        self.assertEqual(rate_limiter.on_success.call_count, 1)
+        rate_limiter.on_throttle.assert_called_once_with(None)
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_queue.get()['retries_count'], 1)
+
+        # Throttled attempts of retried item add up to its retries count
+        api_clients_queue.get()
+        retried_item = dict(item, retries_count=2,
+                            timeout=worker.config['retry_default_timeout'])
+        worker._get_resource_item_from_public(client_dict, retried_item)
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_queue.qsize(), 0)
+        self.assertEqual(worker.metrics.dropped.value, 1)
+
+        del worker
+
+    def test__get_resource_item_from_public_fresher_backend(self):
+        item = {
             'id': uuid.uuid4().hex,
             'dateModified': datetime.datetime.utcnow().isoformat()
         }
-        resource_item_doc_dict = {
-            'doc_type': 'Tender',
-            '_rev': '1-' + uuid.uuid4().hex,
-            'id': queue_resource_item['id'],
-            'dateModified': queue_resource_item['dateModified']
-        }
-        resource_item_dict = {
-            'doc_type': 'Tender',
-            'id': queue_resource_item['id'],
-            'dateModified': queue_resource_item['dateModified']
-        }
-        worker = ResourceItemWorker(config_dict=self.worker_config,
-                                    retry_resource_items_queue=retry_queue)
-        worker.db = MagicMock()
-
-        # Successful adding to bulk
-        start_length = len(worker.bulk)
-        worker._add_to_bulk(resource_item_dict, resource_item_doc_dict)
-        end_length = len(worker.bulk)
-        self.assertGreater(end_length, start_length)
-
-        # Update exist doc in bulk
-        start_length = len(worker.bulk)
-        new_resource_item_dict = deepcopy(resource_item_dict)
-        new_resource_item_dict['dateModified'] =\
-            datetime.datetime.utcnow().isoformat()
-        worker._add_to_bulk(new_resource_item_dict, resource_item_doc_dict)
-        end_length = len(worker.bulk)
-        self.assertEqual(start_length, end_length)
-
-        # Ignored duplicate in bulk
-        start_length = end_length
-        worker._add_to_bulk({
-            'doc_type': 'Tender',
-            'id': queue_resource_item['id'],
-            '_id': queue_resource_item['id'],
-            'dateModified': old_date_modified
-        }, resource_item_dict)
-        end_length = len(worker.bulk)
-        self.assertEqual(start_length, end_length)
+        old_doc = {'id': item['id'], 'dateModified': '2017-01-01T00:00:00'}
+        actual_doc = {'id': item['id'], 'dateModified': item['dateModified']}
+        api_clients_queue = APIClientsPool()
+        clients = {}
+        for backend, doc in (('a', old_doc), ('b', actual_doc),
+                             ('c', old_doc)):
+            client = MagicMock()
+            client.session.cookies = {'SERVER_ID': backend}
+            client.get_resource_item.return_value = {'data': doc}
+            clients[backend] = {
+                'id': uuid.uuid4().hex,
+                'request_interval': 0,
+                'client': client
+            }
+            api_clients_queue.put(clients[backend])
+        api_clients_info = dict(
+            (client_dict['id'], {'drop_cookies': False,
+                                 'latency': LatencyStats()})
+            for client_dict in clients.values())
+        retry_queue = Queue()
+        worker = ResourceItemWorker(api_clients_queue=api_clients_queue,
+                                    config_dict=self.worker_config,
+                                    retry_resource_items_queue=retry_queue,
+                                    retry_scheduler=self.retry_scheduler(retry_queue),
+                                    api_clients_info=api_clients_info)
+
+        # Nothing is known about backends freshness
+        api_clients_queue.idle['a'].popleft()
+        public_item = worker._get_resource_item_from_public(clients['a'],
+                                                            item)
+        self.assertEqual(public_item, None)
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_queue.qsize(), 1)
+        self.assertEqual(api_clients_queue.qsize(), 3)
+        retry_queue.get()
+
+        # Backend 'b' served newer document, so it already has this one
+        api_clients_queue.seen(clients['b'], '9999-01-01T00:00:00')
+        clients['a']['client'].get_resource_item.reset_mock()
+        api_clients_queue.idle['a'].popleft()
+        public_item = worker._get_resource_item_from_public(clients['a'],
+                                                            item)
+        self.assertEqual(public_item, actual_doc)
+        self.assertEqual(clients['c']['client'].get_resource_item.call_count,
+                         0)
+        self.assertEqual(api_clients_queue.qsize(), 3)
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_queue.qsize(), 0)
 
         del worker
 
-    def test__save_bulk_docs(self):
-        self.worker_config['bulk_save_limit'] = 3
+    def test__get_resource_item_from_public_reroute_pool_size(self):
+        item = {
+            'id': uuid.uuid4().hex,
+            'dateModified': datetime.datetime.utcnow().isoformat()
+        }
+        old_doc = {'id': item['id'], 'dateModified': '2017-01-01T00:00:00'}
+        api_clients_queue = APIClientsPool()
+        clients = {}
+        for backend in ('a', 'b', 'c'):
+            client = MagicMock()
+            client.session.cookies = {'SERVER_ID': backend}
+            client.get_resource_item.return_value = {'data': old_doc}
+            clients[backend] = {
+                'id': uuid.uuid4().hex,
+                'request_interval': 0,
+                'client': client
+            }
+            api_clients_queue.put(clients[backend])
+        api_clients_info = dict(
+            (client_dict['id'], {'drop_cookies': False,
+                                 'latency': LatencyStats()})
+            for client_dict in clients.values())
+        # Client of fresher backend is marked by perfomance watcher
+        api_clients_info[clients['b']['id']]['drop_cookies'] = True
+        api_clients_queue.seen(clients['b'], '9999-01-01T00:00:00')
+        api_clients_queue.seen(clients['c'], '9999-01-01T00:00:00')
         retry_queue = Queue()
-        worker = ResourceItemWorker(config_dict=self.worker_config,
-                                    retry_resource_items_queue=retry_queue)
-        doc_id_1 = uuid.uuid4().hex
-        doc_id_2 = uuid.uuid4().hex
-        doc_id_3 = uuid.uuid4().hex
-        doc_id_4 = uuid.uuid4().hex
+        worker = ResourceItemWorker(api_clients_queue=api_clients_queue,
+                                    config_dict=self.worker_config,
+                                    retry_resource_items_queue=retry_queue,
+                                    retry_scheduler=self.retry_scheduler(retry_queue),
+                                    api_clients_info=api_clients_info)
+
+        # Every backend returns not actual document
+        api_clients_queue.idle['a'].popleft()
+        public_item = worker._get_resource_item_from_public(clients['a'],
+                                                            item)
+        self.assertEqual(public_item, None)
+        # Rerouted client had its cookies dropped before request
+        clients['b']['client'].renew_cookies.assert_called_once_with()
+        self.assertFalse(api_clients_info[clients['b']['id']]['drop_cookies'])
+        for client_dict in clients.values():
+            self.assertEqual(
+                client_dict['client'].get_resource_item.call_count, 1)
+        # Each client is put back once
+        self.assertEqual(api_clients_queue.qsize(), 3)
+        idle = [client_dict['id'] for clients_deque in
+                api_clients_queue.idle.values()
+                for client_dict in clients_deque]
+        self.assertEqual(sorted(idle),
+                         sorted(c['id'] for c in clients.values()))
+        sleep(worker.config['retry_default_timeout'] * 2)
+        self.assertEqual(retry_queue.qsize(), 1)
+
+        del worker
+
+    def test__request_resource_item(self):
+        item_id = uuid.uuid4().hex
+        old_date_modified = datetime.datetime.utcnow().isoformat()
         date_modified = datetime.datetime.utcnow().isoformat()
-        worker.bulk = {
-            doc_id_1: {'id': doc_id_1, 'dateModified': date_modified},
-            doc_id_2: {'id': doc_id_2, 'dateModified': date_modified},
-            doc_id_3: {'id': doc_id_3, 'dateModified': date_modified},
-            doc_id_4: {'id': doc_id_4, 'dateModified': date_modified}
-        }
-        update_return_value = [
-            (True, doc_id_1, '1-' + uuid.uuid4().hex),
-            (True, doc_id_2, '2-' + uuid.uuid4().hex),
-            (False, doc_id_3, Exception(u'New doc with oldest dateModified.')),
-            (False, doc_id_4, Exception(u'Document update conflict.'))
-        ]
-        worker.db = MagicMock()
-        worker.db.update.return_value = update_return_value
-
-        # Test success response from couchdb
-        worker._save_bulk_docs()
-        sleep(0.1)
-        self.assertEqual(len(worker.bulk), 0)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 1)
+        client = MagicMock(prefix_path='https://lb/api/2.3/tenders')
+        client.request.return_value = munchify({
+            'status_code': 200,
+            'headers': {'ETag': 'W/"1"'},
+            'content': '{{"data": {{"id": "{}", "dateModified": "{}"}}}}'
+                       .format(item_id, old_date_modified)
+        })
+        index = ResourceItemsIndex()
+        worker = ResourceItemWorker(config_dict=self.worker_config,
+                                    index=index, validators=Validators())
+        queue_item = {'id': item_id, 'dateModified': date_modified}
+        self.assertEqual(worker._request_resource_item(client, queue_item),
+                         {'id': item_id, 'dateModified': old_date_modified})
+        client.request.assert_called_once_with(
+            'GET', 'https://lb/api/2.3/tenders/' + item_id, headers={})
+
+        # Replica isn't actual yet, stub with known dateModified is returned
+        client.request.return_value = munchify({'status_code': 304,
+                                                'headers': {},
+                                                'content': ''})
+        self.assertEqual(worker._request_resource_item(client, queue_item),
+                         {'id': item_id, 'dateModified': old_date_modified})
+        client.request.assert_called_with(
+            'GET', 'https://lb/api/2.3/tenders/' + item_id,
+            headers={'If-None-Match': 'W/"1"'})
+
+        # Known body is already saved
+        index.update(item_id, old_date_modified)
+        queue_item['dateModified'] = old_date_modified
+        self.assertIsNone(worker._request_resource_item(client, queue_item))
+
+        # Known body isn't saved, it is requested again unconditionally
+        index.update(item_id, '2000-01-01T00:00:00')
+        client.request.side_effect = [
+            munchify({'status_code': 304, 'headers': {}, 'content': ''}),
+            munchify({'status_code': 200, 'headers': {},
+                      'content': '{{"data": {{"id": "{}", "dateModified": '
+                                 '"{}"}}}}'.format(item_id,
+                                                   old_date_modified)})]
+        self.assertEqual(worker._request_resource_item(client, queue_item),
+                         {'id': item_id, 'dateModified': old_date_modified})
+        client.request.assert_called_with(
+            'GET', 'https://lb/api/2.3/tenders/' + item_id)
+
+        # Retry without known dateModified isn't conditional
+        client.request.side_effect = None
+        client.request.return_value = munchify({
+            'status_code': 200, 'headers': {},
+            'content': '{{"data": {{"id": "{}", "dateModified": "{}"}}}}'
+                       .format(item_id, date_modified)})
+        worker._request_resource_item(client, {'id': item_id,
+                                               'dateModified': None})
+        client.request.assert_called_with(
+            'GET', 'https://lb/api/2.3/tenders/' + item_id, headers={})
+
+        client.request.return_value = munchify({'status_code': 204,
+                                                'headers': {},
+                                                'content': ''})
+        with self.assertRaises(InvalidResponse):
+            worker._request_resource_item(client, queue_item)
 
-        # Test failed response from couchdb
-        worker.db.update.side_effect = Exception('Some exceptions')
-        worker.bulk = {
-            doc_id_1: {'id': doc_id_1, 'dateModified': date_modified},
-            doc_id_2: {'id': doc_id_2, 'dateModified': date_modified},
-            doc_id_3: {'id': doc_id_3, 'dateModified': date_modified},
-            doc_id_4: {'id': doc_id_4, 'dateModified': date_modified}
+    def test__add_to_bulk(self):
+        self.worker_config['historical'] = True
+        bulk_writer = MagicMock()
+        resource_item_dict = {
+            'id': uuid.uuid4().hex,
+            'rev': str(randint(10, 99))
         }
-        worker._save_bulk_docs()
-        sleep(0.2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 5)
-        self.assertEqual(len(worker.bulk), 0)
+        worker = ResourceItemWorker(config_dict=self.worker_config,
+                                    bulk_writer=bulk_writer)
+
+        # Historical revision saved as separate document
+        worker._add_to_bulk(resource_item_dict)
+        bulk_writer.add.assert_called_once_with(resource_item_dict)
+        self.assertEqual(resource_item_dict['_id'], '{}-{}'.format(
+            resource_item_dict['id'], resource_item_dict['rev']))
+        self.assertEqual(resource_item_dict['doc_type'], 'Tender')
+        self.assertNotIn('_rev', resource_item_dict)
 
-        worker.config['historical'] = True
-        worker.bulk = {
-            doc_id_1: {'id': doc_id_1, 'rev': randint(10, 99)}
+        self.worker_config['historical'] = False
+        bulk_writer = MagicMock()
+        local_rev = '1-' + uuid.uuid4().hex
+        resource_item_dict = {
+            'id': uuid.uuid4().hex,
+            'dateModified': datetime.datetime.utcnow().isoformat()
         }
-        worker._save_bulk_docs()
-        sleep(0.2)
-        self.assertEqual(worker.retry_resource_items_queue.qsize(), 6)
-        self.assertEqual(len(worker.bulk), 0)
-        worker.config['historical'] = False
+        worker = ResourceItemWorker(config_dict=self.worker_config,
+                                    bulk_writer=bulk_writer)
+        worker._add_to_bulk(resource_item_dict, local_rev)
+        bulk_writer.add.assert_called_once_with(resource_item_dict)
+        self.assertEqual(resource_item_dict['_id'], resource_item_dict['id'])
+        self.assertEqual(resource_item_dict['_rev'], local_rev)
+        self.assertEqual(resource_item_dict['doc_type'], 'Tender')
+
+        del worker
+
+    def test__add_to_bulk_delta(self):
+        self.worker_config['historical'] = True
+        self.worker_config['historical_delta'] = True
+        bulk_writer = MagicMock()
+        db = MagicMock()
+        db.view.side_effect = lambda name, include_docs, keys: [
+            {'key': key, 'error': 'not_found'} for key in keys]
+        item_id = uuid.uuid4().hex
+        worker = ResourceItemWorker(db=db, config_dict=self.worker_config,
+                                    bulk_writer=bulk_writer,
+                                    revisions_cache=RevisionsCache(10))
+
+        # First revision is snapshot
+        worker._add_to_bulk({'id': item_id, 'rev': '1', 'status': 'draft'})
+        saved = bulk_writer.add.call_args[0][0]
+        self.assertEqual(saved['status'], 'draft')
+        self.assertNotIn('patch', saved)
+
+        # Next revision is patch against previous from cache
+        worker._add_to_bulk({'id': item_id, 'rev': '2', 'status': 'active'})
+        saved = bulk_writer.add.call_args[0][0]
+        self.assertEqual(saved['_id'], item_id + '-2')
+        self.assertEqual(saved['doc_type'], 'TenderDelta')
+        self.assertIn({'op': 'replace', 'path': '/status',
+                       'value': 'active'}, saved['patch'])
+        self.assertNotIn('status', saved)
+        self.assertEqual(db.view.call_count, 0)
+
+        # Every historical_snapshot_interval revisions are stored full
+        worker._add_to_bulk({'id': item_id, 'rev': '4', 'status': 'active'})
+        saved = bulk_writer.add.call_args[0][0]
+        self.assertNotIn('patch', saved)
+        self.assertEqual(saved['doc_type'], 'Tender')
+
+        # Previous revision is neither cached nor saved, store full
+        worker._add_to_bulk({'id': item_id, 'rev': '6', 'status': 'active'})
+        saved = bulk_writer.add.call_args[0][0]
+        self.assertNotIn('patch', saved)
+        self.assertEqual(db.view.call_count, 1)
+
+        self.worker_config['historical_delta'] = False
+        self.worker_config['historical'] = False
 
     def test_shutdown(self):
         worker = ResourceItemWorker(
@@ -578,6 +799,7 @@ class TestResourceItemWorker(unittest.TestCase):
         worker_thread = ResourceItemWorker.spawn(
             resource_items_queue=self.queue,
             retry_resource_items_queue=self.retry_queue,
+            retry_scheduler=self.retry_scheduler(self.retry_queue),
             api_clients_info=self.api_clients_info,
             api_clients_queue=self.api_clients_queue,
             config_dict=self.worker_config, db=self.db)
@@ -585,12 +807,10 @@ class TestResourceItemWorker(unittest.TestCase):
         worker_thread.shutdown()
         sleep(3)
 
-    @patch('openprocurement.edge.workers.ResourceItemWorker.'
-           '_save_bulk_docs')
     @patch('openprocurement.edge.workers.ResourceItemWorker.'
            '_get_resource_item_from_public')
     @patch('openprocurement.edge.workers.logger')
-    def test__run(self, mocked_logger, mock_get_from_public, mocked_save_bulk):
+    def test__run(self, mocked_logger, mock_get_from_public):
         self.queue = Queue()
         self.retry_queue = Queue()
         self.api_clients_queue = Queue()
@@ -613,45 +833,36 @@ class TestResourceItemWorker(unittest.TestCase):
         client.session.headers = {'User-Agent': 'Test-Agent'}
         self.api_clients_info = {
             api_client_dict['id']: {
-                'drop_cookies': False, 'request_durations': []
+                'drop_cookies': False, 'latency': LatencyStats()
             }
         }
         self.db = MagicMock()
+        self.index = ResourceItemsIndex()
         worker = ResourceItemWorker(
             api_clients_queue=self.api_clients_queue,
             resource_items_queue=self.queue,
             retry_resource_items_queue=self.retry_queue,
+            retry_scheduler=self.retry_scheduler(self.retry_queue),
             db=self.db, api_clients_info=self.api_clients_info,
-            config_dict=self.worker_config
+            config_dict=self.worker_config, index=self.index,
+            bulk_writer=MagicMock()
         )
         worker.exit = MagicMock()
         worker.exit.__nonzero__.side_effect = [False, True]
 
-        # Try get api client from clients queue
+        # Wait for item in resource items queue
         self.assertEqual(self.queue.qsize(), 0)
         worker._run()
-        self.assertEqual(self.queue.qsize(), 0)
         mocked_logger.debug.assert_called_once_with(
-            'API clients queue is empty.')
+            'Resource items queue is empty.')
 
-        # Try get item from resource items queue
+        # Idle worker doesn't take client from clients queue
         self.api_clients_queue.put(api_client_dict)
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
-        self.assertEqual(
-            mocked_logger.debug.call_args_list[1:],
-            [
-                call('GET API CLIENT: {}'.format(api_client_dict['id']),
-                     extra={'MESSAGE_ID': 'get_client'}),
-                call('SLEEP before return client: 0'),
-                call('Got api_client ID: {} {}'.format(
-                    api_client_dict['id'], client.session.headers['User-Agent']
-                )),
-                call('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                     extra={'MESSAGE_ID': 'put_client'}),
-                call('Resource items queue is empty.')
-            ]
-        )
+        self.assertEqual(self.api_clients_queue.qsize(), 1)
+        self.assertEqual(mocked_logger.debug.call_args_list[1:],
+                         [call('Resource items queue is empty.')])
 
         # Try get resource item from local storage
         self.queue.put(queue_item)
@@ -659,16 +870,16 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[6:],
+            mocked_logger.debug.call_args_list[2:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id'])),
                 call('Put in bulk tender {} {}'.format(doc['id'],
                                                        doc['dateModified']),
                      extra={'MESSAGE_ID': 'add_to_save_bulk'})
@@ -682,16 +893,16 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[11:],
+            mocked_logger.debug.call_args_list[7:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
-                    client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id']))
+                    client.session.headers['User-Agent']))
             ]
         )
 
@@ -703,53 +914,51 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[15:],
+            mocked_logger.debug.call_args_list[11:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Ignored duplicate tender {} in bulk: previous {}, '
-                     'current {}'.format(
-                    doc['id'], doc['dateModified'], doc['dateModified']),
-                    extra={'MESSAGE_ID': 'skipped'})
+                call('Put in bulk tender {} {}'.format(doc['id'],
+                                                       doc['dateModified']),
+                     extra={'MESSAGE_ID': 'add_to_save_bulk'})
             ]
         )
 
-        # Add to retry queue
+        # Worker shut down waiting for second client returns item to queue
         self.api_clients_queue.put(api_client_dict)
         self.queue.put({'id': doc['id'], 'dateModified': None})
         mock_get_from_public.return_value = doc
         self.db.get_doc.return_value = doc
-        worker.exit.__nonzero__.side_effect = [False, True]
+        worker.exit.__nonzero__.side_effect = [False, True, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[23:],
+            mocked_logger.debug.call_args_list[19:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
-                    client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id']))
+                    client.session.headers['User-Agent']))
             ]
         )
-        mocked_logger.info.assert_called_once_with(
-            'Put tender {} to \'retries_queue\''.format(doc['id']),
-            extra={'MESSAGE_ID': 'add_to_retry'}
-        )
+        self.assertEqual(self.queue.get_nowait(),
+                         {'id': doc['id'], 'dateModified': doc['dateModified']})
+        self.assertEqual(mocked_logger.info.call_count, 0)
 
         # Skip doc
         self.api_clients_queue.put(api_client_dict)
@@ -760,29 +969,28 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[27:],
+            mocked_logger.debug.call_args_list[23:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Ignored duplicate tender {} in bulk: previous {}, '
-                     'current {}'.format(
-                    doc['id'], doc['dateModified'], doc['dateModified']),
-                    extra={'MESSAGE_ID': 'skipped'})
+                call('Put in bulk tender {} {}'.format(doc['id'],
+                                                       doc['dateModified']),
+                     extra={'MESSAGE_ID': 'add_to_save_bulk'})
             ]
         )
-        self.assertEqual(mocked_logger.info.call_count, 1)
+        self.assertEqual(mocked_logger.info.call_count, 0)
 
         # Skip doc with raise exception
         self.api_clients_queue.put(api_client_dict)
@@ -792,16 +1000,16 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[35:],
+            mocked_logger.debug.call_args_list[31:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id'])),
                 call('PUT API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'put_client'})
             ]
@@ -812,7 +1020,7 @@ class TestResourceItemWorker(unittest.TestCase):
             extra={'MESSAGE_ID': 'exceptions'}
         )
         self.assertEqual(
-            mocked_logger.info.call_args_list[1],
+            mocked_logger.info.call_args_list[0],
             call('Put tender {} to \'retries_queue\''.format(doc['id']),
                  extra={'MESSAGE_ID': 'add_to_retry'})
         )
@@ -825,19 +1033,19 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[40:],
+            mocked_logger.debug.call_args_list[36:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
-                    client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id']))
+                    client.session.headers['User-Agent']))
             ]
         )
-        self.assertEqual(mocked_logger.info.call_count, 2)
+        self.assertEqual(mocked_logger.info.call_count, 1)
         self.assertEqual(mocked_logger.error.call_count, 1)
 
         # Try get resource item from public server
@@ -848,25 +1056,176 @@ class TestResourceItemWorker(unittest.TestCase):
         worker.exit.__nonzero__.side_effect = [False, True]
         worker._run()
         self.assertEqual(
-            mocked_logger.debug.call_args_list[44:],
+            mocked_logger.debug.call_args_list[40:],
             [
+                call('Get tender {} from main queue.'.format(
+                    doc['id'])),
                 call('GET API CLIENT: {}'.format(api_client_dict['id']),
                      extra={'MESSAGE_ID': 'get_client'}),
                 call('SLEEP before return client: 0'),
                 call('Got api_client ID: {} {}'.format(
                     api_client_dict['id'],
                     client.session.headers['User-Agent'])),
-                call('Get tender {} from main queue.'.format(
-                    doc['id'])),
-                call('Ignored duplicate tender {} in bulk: previous {}, '
-                     'current {}'.format(
-                    doc['id'], doc['dateModified'], doc['dateModified']),
-                    extra={'MESSAGE_ID': 'skipped'})
+                call('Put in bulk tender {} {}'.format(doc['id'],
+                                                       doc['dateModified']),
+                     extra={'MESSAGE_ID': 'add_to_save_bulk'})
             ]
         )
-        self.assertEqual(mocked_logger.info.call_count, 2)
+        self.assertEqual(mocked_logger.info.call_count, 1)
         self.assertEqual(mocked_logger.error.call_count, 1)
 
+        # Skip doc which is up to date in local index
+        self.index.update(doc['id'], new_date_modified, doc['_rev'])
+        self.api_clients_queue.put(api_client_dict)
+        self.queue.put({'id': doc['id'], 'dateModified': new_date_modified})
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(
+            mocked_logger.debug.call_args_list[-2:],
+            [
+                call('Ignored tender {} QUEUE - {}, EDGE - {}'.format(
+                    doc['id'], new_date_modified, new_date_modified),
+                    extra={'MESSAGE_ID': 'skiped'}),
+                call('PUT API CLIENT: {}'.format(api_client_dict['id']),
+                     extra={'MESSAGE_ID': 'put_client'})
+            ]
+        )
+
+        # Document received from feed is saved without public API request
+        mock_get_from_public.reset_mock()
+        feed_doc = {'id': uuid.uuid4().hex, 'status': 'active',
+                    'dateModified': datetime.datetime.utcnow().isoformat()}
+        clients_count = self.api_clients_queue.qsize()
+        self.api_clients_queue.put(api_client_dict)
+        self.queue.put({'id': feed_doc['id'],
+                        'dateModified': feed_doc['dateModified'],
+                        'doc': feed_doc})
+        worker.exit.__nonzero__.side_effect = [False, True]
+        worker._run()
+        self.assertEqual(mock_get_from_public.call_count, 0)
+        worker.bulk_writer.add.assert_called_with(feed_doc)
+        # Client is returned to queue
+        self.assertEqual(self.api_clients_queue.qsize(), clients_count + 1)
+        self.assertEqual(
+            mocked_logger.debug.call_args_list[-3:],
+            [
+                call('PUT API CLIENT: {}'.format(api_client_dict['id']),
+                     extra={'MESSAGE_ID': 'put_client'}),
+                call('Received from feed tender: {} {}'.format(
+                    feed_doc['id'], feed_doc['dateModified']),
+                    extra={'MESSAGE_ID': 'received_from_feed'}),
+                call('Put in bulk tender {} {}'.format(
+                    feed_doc['id'], feed_doc['dateModified']),
+                    extra={'MESSAGE_ID': 'add_to_save_bulk'})
+            ]
+        )
+
+    @patch('openprocurement.edge.workers.ResourceItemWorker.'
+           '_get_resource_item_from_public')
+    def test__run_wakeup(self, mock_get_from_public):
+        mock_get_from_public.return_value = None
+        queue = Queue()
+        api_clients_queue = APIClientsPool()
+        client = MagicMock()
+        client.session.headers = {'User-Agent': 'Test-Agent'}
+        client.session.cookies = {}
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': client,
+                           'request_interval': 0}
+        retry_scheduler = MagicMock()
+        # Long timeout, worker must be woken up by queues
+        config = dict(self.worker_config, queue_timeout=10)
+        worker = ResourceItemWorker.spawn(
+            api_clients_queue=api_clients_queue, resource_items_queue=queue,
+            config_dict=config, index=ResourceItemsIndex(),
+            api_clients_info={api_client_dict['id']: {'drop_cookies': False}},
+            retry_scheduler=retry_scheduler, bulk_writer=MagicMock())
+        sleep(0.01)
+
+        # Idle worker doesn't hold client
+        api_clients_queue.put(api_client_dict)
+        sleep(0.01)
+        self.assertEqual(api_clients_queue.qsize(), 1)
+
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat()}
+        queue.put(item)
+        sleep(0.01)
+        mock_get_from_public.assert_called_once_with(api_client_dict, item)
+
+        # Item waits for client, public mock doesn't return it
+        queue.put(dict(item))
+        sleep(0.01)
+        self.assertEqual(mock_get_from_public.call_count, 1)
+        api_clients_queue.put(api_client_dict)
+        sleep(0.01)
+        self.assertEqual(mock_get_from_public.call_count, 2)
+
+        # Item is returned to queue when worker is shut down waiting for
+        # client, no attempt is counted
+        config['queue_timeout'] = 0.01
+        queue.put(dict(item))
+        sleep(0.01)
+        worker.shutdown()
+        worker.join(timeout=1)
+        self.assertTrue(worker.dead)
+        self.assertEqual(retry_scheduler.schedule.call_count, 0)
+        self.assertEqual(queue.get_nowait(), item)
+        self.assertEqual(mock_get_from_public.call_count, 2)
+
+        # Full queue leaves item to scheduler, due at once
+        queue = Queue(1)
+        queue.put({'id': uuid.uuid4().hex})
+        worker = ResourceItemWorker(
+            api_clients_queue=api_clients_queue, resource_items_queue=queue,
+            config_dict=config, retry_scheduler=retry_scheduler)
+        worker._requeue(item)
+        retry_scheduler.schedule.assert_called_once_with(item, 0)
+        self.assertNotIn('retries_count', item)
+
+
+    @patch('openprocurement.edge.workers.ResourceItemWorker.'
+           '_get_resource_item_from_public')
+    def test__run_tracer(self, mock_get_from_public):
+        queue = Queue()
+        api_clients_queue = APIClientsPool()
+        api_client_dict = {'id': uuid.uuid4().hex, 'client': MagicMock(),
+                           'request_interval': 0}
+        api_clients_queue.put(api_client_dict)
+        tracer = PipelineTracer(1)
+        bulk_writer = MagicMock()
+        worker = ResourceItemWorker.spawn(
+            api_clients_queue=api_clients_queue, resource_items_queue=queue,
+            config_dict=self.worker_config, index=ResourceItemsIndex(),
+            api_clients_info={api_client_dict['id']: {'drop_cookies': False}},
+            retry_scheduler=MagicMock(), bulk_writer=bulk_writer,
+            tracer=tracer)
+        item = {'id': uuid.uuid4().hex,
+                'dateModified': datetime.datetime.utcnow().isoformat()}
+
+        def get_from_public(api_client_dict, queue_resource_item):
+            api_clients_queue.put(api_client_dict)
+            return dict(queue_resource_item)
+        mock_get_from_public.side_effect = get_from_public
+        tracer.start(item['id'])
+        queue.put(item)
+        sleep(0.01)
+        self.assertEqual(bulk_writer.add.call_count, 1)
+        for stage in ('main_queue', 'api_client', 'upstream'):
+            self.assertEqual(tracer.stage_seconds[stage].count, 1)
+        # Writer finishes trace of saved item
+        self.assertEqual(len(tracer), 1)
+
+        # Item not received from public is skipped
+        mock_get_from_public.side_effect = None
+        mock_get_from_public.return_value = None
+        api_clients_queue.put(api_client_dict)
+        queue.put(dict(item))
+        sleep(0.01)
+        self.assertEqual(len(tracer), 0)
+        self.assertEqual(tracer.total_seconds['skipped'].count, 1)
+        worker.shutdown()
+        worker.join(timeout=1)
+
 
 def suite():
     suite = unittest.TestSuite()
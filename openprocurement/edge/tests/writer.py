@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import datetime
+import os
+import shutil
+import tempfile
+import unittest
+import uuid
+from copy import deepcopy
+from gevent import sleep
+from gevent.queue import Queue
+from json import loads
+from mock import MagicMock
+from random import randint
+from openprocurement.edge.index import ResourceItemsIndex
+from openprocurement.edge.journal import Journal, UnsavedItems
+from openprocurement.edge.retry import RetryScheduler
+from openprocurement.edge.trace import PipelineTracer
+from openprocurement.edge.writer import BulkWriter
+
+
+class TestBulkWriter(unittest.TestCase):
+
+    config = {
+        'resource': 'tenders',
+        'retry_default_timeout': 0.05,
+        'retries_count': 2,
+        'retry_max_timeout': 5,
+        'retry_jitter': 0.1,
+        'bulk_save_limit': 3,
+        'bulk_save_bytes': 4096,
+        'bulk_save_interval': 0.1,
+        'bulk_save_concurrency': 2,
+        'historical': False
+    }
+
+    def setUp(self):
+        self.retry_queue = Queue()
+        self.retry_scheduler = RetryScheduler(self.retry_queue)
+        self.retry_scheduler.start()
+        self.index = ResourceItemsIndex()
+        self.db = MagicMock()
+        self.db.resource.post_json.side_effect = self.post_bulk_docs
+        self.config = deepcopy(self.config)
+        self.writer = BulkWriter(self.db, self.config, self.index,
+                                 self.retry_scheduler)
+        self.posted = []
+        self.directory = tempfile.mkdtemp()
+        self.journal_path = os.path.join(self.directory, 'journal.jsonl')
+
+    def tearDown(self):
+        self.retry_scheduler.shutdown()
+        self.writer.kill()
+        shutil.rmtree(self.directory)
+
+    def post_bulk_docs(self, path, body, headers):
+        docs = loads(body)['docs']
+        self.posted.append(docs)
+        return 201, {}, [{'id': doc['_id'], 'rev': '1-' + uuid.uuid4().hex}
+                         for doc in docs]
+
+    def doc(self, date_modified=None):
+        doc_id = uuid.uuid4().hex
+        return {'id': doc_id, '_id': doc_id, 'doc_type': 'Tender',
+                'dateModified': date_modified or
+                datetime.datetime.utcnow().isoformat()}
+
+    def test_add(self):
+        doc = self.doc()
+        self.writer.add(doc)
+        self.assertEqual(len(self.writer.bulk), 1)
+        self.assertGreater(self.writer.bulk_bytes, 0)
+        self.assertIsNotNone(self.writer.start_time)
+
+        # Newer version replaces document in bulk
+        bulk_bytes = self.writer.bulk_bytes
+        new_doc = deepcopy(doc)
+        new_doc['dateModified'] = datetime.datetime.utcnow().isoformat()
+        new_doc['status'] = 'active.tendering'
+        self.writer.add(new_doc)
+        self.assertEqual(len(self.writer.bulk), 1)
+        self.assertEqual(self.writer.bulk[doc['id']][0], new_doc)
+        self.assertGreater(self.writer.bulk_bytes, bulk_bytes)
+
+        # Older version is ignored
+        self.writer.add(doc)
+        self.assertEqual(self.writer.bulk[doc['id']][0], new_doc)
+
+        # Historical revisions are different documents
+        self.config['historical'] = True
+        rev_doc = {'id': doc['id'], 'rev': '2', '_id': doc['id'] + '-2'}
+        self.writer.add(rev_doc)
+        self.writer.add(deepcopy(rev_doc))
+        self.assertEqual(len(self.writer.bulk), 2)
+
+    def test_flush_by_count(self):
+        for _ in xrange(3):
+            self.writer.add(self.doc())
+        self.assertEqual(len(self.writer.bulk), 0)
+        self.assertIsNone(self.writer.start_time)
+        self.writer.pool.join()
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(len(self.posted[0]), 3)
+        self.assertEqual(len(self.index), 3)
+        self.assertEqual(self.db.resource.post_json.call_args[1]['headers'],
+                         {'Content-Type': 'application/json'})
+
+    def test_flush_by_bytes(self):
+        self.config['bulk_save_limit'] = 1000
+        self.writer = BulkWriter(self.db, self.config, self.index,
+                                 self.retry_scheduler)
+        doc = self.doc()
+        doc['description'] = 'x' * 5000
+        self.writer.add(self.doc())
+        self.assertEqual(len(self.writer.bulk), 1)
+        self.writer.add(doc)
+        self.assertEqual(len(self.writer.bulk), 0)
+        self.writer.pool.join()
+        self.assertEqual(len(self.posted[0]), 2)
+
+    def test_flush_by_timer(self):
+        self.writer.start()
+        doc = self.doc()
+        self.writer.add(doc)
+        sleep(0.05)
+        self.assertEqual(len(self.posted), 0)
+        sleep(0.1)
+        self.assertEqual(len(self.posted), 1)
+        self.assertEqual(self.posted[0][0]['_id'], doc['_id'])
+
+        # Pending documents are flushed on shutdown
+        self.writer.add(self.doc())
+        self.writer.shutdown()
+        self.writer.join()
+        self.assertEqual(len(self.posted), 2)
+
+    def test_journal(self):
+        journal = Journal(self.journal_path)
+        self.writer = BulkWriter(self.db, self.config, self.index,
+                                 self.retry_scheduler, journal)
+        self.db.resource.post_json.side_effect = [
+            Exception('Some exceptions'), (201, {}, [])]
+        docs = [self.doc() for _ in xrange(2)]
+        self.writer.add(docs[0])
+        self.writer.flush()
+        # Items of bulk in flight are pending in journal
+        self.assertEqual(journal.pending.keys(),
+                         [(docs[0]['id'], docs[0]['dateModified'])])
+        self.writer.pool.join()
+        self.assertEqual(len(journal.pending), 0)
+        self.writer.add(docs[1])
+        self.writer.flush()
+        self.writer.pool.join()
+        self.assertEqual(len(journal.pending), 0)
+        journal.close()
+        self.assertEqual(Journal(self.journal_path).recover(), [])
+
+    def test_unsaved(self):
+        unsaved = UnsavedItems()
+        self.writer = BulkWriter(self.db, self.config, self.index,
+                                 self.retry_scheduler, unsaved=unsaved)
+        doc = self.doc()
+        unsaved.add(doc['id'], doc['dateModified'])
+        self.writer.add_to_retry_queue(
+            {'id': doc['id'], 'dateModified': doc['dateModified'],
+             'retries_count': 1})
+        self.assertEqual(len(unsaved), 1)
+        # Dropped item is settled
+        self.writer.add_to_retry_queue(
+            {'id': doc['id'], 'dateModified': doc['dateModified'],
+             'retries_count': 2})
+        self.assertEqual(len(unsaved), 0)
+
+    def test_tracer(self):
+        tracer = PipelineTracer(1)
+        self.writer = BulkWriter(self.db, self.config, self.index,
+                                 self.retry_scheduler, tracer=tracer)
+        docs = [self.doc() for _ in xrange(3)]
+        for doc in docs:
+            tracer.start(doc['id'])
+            self.writer.add(doc)
+        self.writer.pool.join()
+        self.assertEqual(len(tracer), 0)
+        self.assertEqual(tracer.stage_seconds['bulk'].count, 3)
+        self.assertEqual(tracer.stage_seconds['bulk_docs'].count, 3)
+        self.assertEqual(tracer.total_seconds['saved'].count, 3)
+
+        # Failed bulk items end their traces in retry
+        self.db.resource.post_json.side_effect = Exception('Save error')
+        doc = self.doc()
+        tracer.start(doc['id'])
+        self.writer.add(doc)
+        self.writer.flush()
+        self.writer.pool.join()
+        self.assertEqual(tracer.total_seconds['retried'].count, 1)
+
+    def test__save_bulk_docs(self):
+        doc_ids = [uuid.uuid4().hex for _ in xrange(4)]
+        date_modified = datetime.datetime.utcnow().isoformat()
+        bulk = dict((doc_id, ({'id': doc_id, 'dateModified': date_modified},
+                              '{}'))
+                    for doc_id in doc_ids)
+        self.db.resource.post_json.side_effect = None
+        self.db.resource.post_json.return_value = (201, {}, [
+            {'id': doc_ids[0], 'rev': '1-' + uuid.uuid4().hex},
+            {'id': doc_ids[1], 'rev': '2-' + uuid.uuid4().hex},
+            {'id': doc_ids[2], 'error': 'forbidden',
+             'reason': u'New doc with oldest dateModified.'},
+            {'id': doc_ids[3], 'error': 'conflict',
+             'reason': u'Document update conflict.'}
+        ])
+        self.db.get.side_effect = [
+            {'_rev': '3-' + uuid.uuid4().hex, 'dateModified': date_modified},
+            Exception('Refresh exception')
+        ]
+
+        # Test success response from couchdb
+        self.writer._save_bulk_docs(bulk)
+        sleep(0.1)
+        self.assertEqual(self.retry_queue.qsize(), 1)
+        self.assertEqual(self.retry_queue.get()['id'], doc_ids[3])
+        # Index updated from _bulk_docs results
+        self.assertEqual(self.index.get(doc_ids[0])[0], date_modified)
+        self.assertTrue(self.index.get(doc_ids[1])[1].startswith('2-'))
+        self.assertTrue(self.index.get(doc_ids[2])[1].startswith('3-'))
+        self.assertEqual(self.index.get(doc_ids[3]), None)
+        self.assertEqual(self.writer.metrics.created.value, 1)
+        self.assertEqual(self.writer.metrics.updated.value, 1)
+        self.assertEqual(self.writer.metrics.bulk_docs_size.sum, 4)
+        self.assertEqual(self.writer.metrics.skipped.labels(
+            '', 'save').value, 1)
+
+        # Test failed response from couchdb
+        self.db.resource.post_json.side_effect = Exception('Some exceptions')
+        self.writer._save_bulk_docs(bulk)
+        sleep(0.2)
+        self.assertEqual(self.retry_queue.qsize(), 4)
+
+        self.config['historical'] = True
+        self.writer._save_bulk_docs({doc_ids[0] + '-1': (
+            {'id': doc_ids[0], 'rev': randint(10, 99)}, '{}')})
+        sleep(0.2)
+        self.assertEqual(self.retry_queue.qsize(), 5)
+
+
+def suite():
+    suite = unittest.TestSuite()
+    suite.addTest(unittest.makeSuite(TestBulkWriter))
+    return suite
+
+
+if __name__ == '__main__':
+    unittest.main(defaultTest='suite')
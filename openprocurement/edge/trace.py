@@ -0,0 +1,95 @@
+# -*- coding: utf-8 -*-
+import logging
+from collections import OrderedDict
+from random import random
+from openprocurement.edge.latency import monotonic
+from openprocurement.edge.metrics import LATENCY_BUCKETS, MetricsRegistry
+
+logger = logging.getLogger(__name__)
+
+# Stages in pipeline order, named by boundary that ends them
+STAGES = (
+    ('input_queue', 'wait'),  # feed item taken from input_queue
+    ('batch', 'wait'),  # send_bulk started checking its batch
+    ('check', 'service'),  # checked against index
+    ('main_queue', 'wait'),  # taken by worker
+    ('api_client', 'wait'),  # worker got API client
+    ('upstream', 'service'),  # document received from public API
+    ('bulk', 'wait'),  # _bulk_docs request of its bulk started
+    ('bulk_docs', 'service'),  # _bulk_docs answered
+)
+OUTCOMES = ('saved', 'skipped', 'retried', 'dropped')
+# Items may wait for bulk interval or behind long queues
+STAGE_BUCKETS = LATENCY_BUCKETS + (60, 300, 900)
+
+
+class PipelineTracer(object):
+
+    """Stage timestamps of sampled resource items, from feed to save
+
+    ``sample_rate`` of feed items get trace of monotonic timestamps kept by
+    item id, untraced items cost one dict lookup per stage boundary. Time
+    since previous boundary is observed in histogram of stage, so wait and
+    service time of every stage is known without DEBUG logging. Traces
+    longer than ``slow_threshold`` are logged with their stages.
+    """
+
+    def __init__(self, sample_rate, slow_threshold=10, max_traces=1000,
+                 registry=None, resource=''):
+        self.sample_rate = sample_rate
+        self.slow_threshold = slow_threshold
+        self.max_traces = max_traces
+        self.resource = resource
+        self.traces = OrderedDict()
+        registry = registry or MetricsRegistry()
+        stage_seconds = registry.histogram(
+            'edge_trace_stage_seconds',
+            'Time sampled resource items spent in pipeline stage',
+            ('resource', 'stage', 'kind'), STAGE_BUCKETS)
+        self.stage_seconds = dict(
+            (stage, stage_seconds.labels(resource, stage, kind))
+            for stage, kind in STAGES)
+        total_seconds = registry.histogram(
+            'edge_trace_seconds',
+            'Time from feed to end of trace of sampled resource items',
+            ('resource', 'outcome'), STAGE_BUCKETS)
+        self.total_seconds = dict(
+            (outcome, total_seconds.labels(resource, outcome))
+            for outcome in OUTCOMES)
+
+    def start(self, item_id):
+        if random() >= self.sample_rate or item_id in self.traces:
+            return
+        if len(self.traces) >= self.max_traces:
+            # Items coalesced or lost on error never finish their traces
+            self.traces.popitem(last=False)
+        self.traces[item_id] = [('feed', monotonic())]
+
+    def mark(self, item_id, stage):
+        trace = self.traces.get(item_id)
+        if trace is None:
+            return
+        now = monotonic()
+        self.stage_seconds[stage].observe(now - trace[-1][1])
+        trace.append((stage, now))
+
+    def finish(self, item_id, outcome):
+        trace = self.traces.pop(item_id, None)
+        if trace is None:
+            return
+        duration = monotonic() - trace[0][1]
+        self.total_seconds[outcome].observe(duration)
+        if duration >= self.slow_threshold:
+            logger.warning('Slow {} {} {} after {:.3f} sec.: {}'.format(
+                self.resource[:-1], item_id, outcome, duration,
+                format_trace(trace)),
+                extra={'MESSAGE_ID': 'slow_trace',
+                       'TRACE_DURATION': duration})
+
+    def __len__(self):
+        return len(self.traces)
+
+
+def format_trace(trace):
+    return ', '.join('{} {:.3f}'.format(stage, end - start) for
+                     (_, start), (stage, end) in zip(trace, trace[1:]))
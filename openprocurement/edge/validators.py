@@ -0,0 +1,53 @@
+# -*- coding: utf-8 -*-
+from collections import OrderedDict
+
+# Response validator header -> conditional request header
+VALIDATOR_HEADERS = (
+    ('ETag', 'If-None-Match'),
+    ('Last-Modified', 'If-Modified-Since')
+)
+
+
+class Validators(object):
+
+    """Bounded LRU store of HTTP validators of fetched documents
+
+    Entry is id -> (conditional header, value, dateModified of fetched
+    body). When upstream answers 304 to conditional request the body is the
+    same as fetched before, so its dateModified tells whether replica is
+    not actual yet or local document is already up to date.
+    """
+
+    def __init__(self, size=100000):
+        self.size = size
+        self.items = OrderedDict()
+
+    def __len__(self):
+        return len(self.items)
+
+    def get(self, item_id):
+        entry = self.items.pop(item_id, None)
+        if entry is not None:
+            self.items[item_id] = entry
+        return entry
+
+    def headers(self, item_id):
+        entry = self.get(item_id)
+        if entry is None:
+            return {}
+        return {entry[0]: entry[1]}
+
+    def date_modified(self, item_id):
+        entry = self.items.get(item_id)
+        return entry[2] if entry is not None else None
+
+    def update(self, item_id, response_headers, date_modified):
+        self.items.pop(item_id, None)
+        for header, conditional_header in VALIDATOR_HEADERS:
+            value = response_headers.get(header)
+            if value:
+                self.items[item_id] = (conditional_header, value,
+                                       date_modified)
+                break
+        while len(self.items) > self.size:
+            self.items.popitem(last=False)
@@ -2,34 +2,44 @@
 from gevent import monkey
 monkey.patch_all()
 
-import os
-from datetime import datetime
 from gevent import Greenlet
-from gevent import spawn, sleep
-from gevent.queue import Empty
-from iso8601 import parse_date
-from pytz import timezone
+from gevent.queue import Empty, Full
 from requests.exceptions import ConnectionError
 import logging
 import logging.config
 import time
+from json import loads
 from openprocurement_client.exceptions import (
     InvalidResponse,
     RequestFailed,
     ResourceNotFound,
     ResourceGone
 )
+from openprocurement.edge.events import EventLog
+from openprocurement.edge.history import (
+    is_snapshot_rev,
+    make_delta,
+    rebuild_revision
+)
+from openprocurement.edge.items import QueueItem
+from openprocurement.edge.metrics import PipelineMetrics
+from openprocurement.edge.ratelimit import retry_after
+from openprocurement.edge.retry import retry_delay, STATUS_CODE_REASONS
 
 logger = logging.getLogger(__name__)
 
-TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
+# Returned by public request when backend of client isn't actual yet
+NOT_ACTUAL = object()
 
 
 class ResourceItemWorker(Greenlet):
 
     def __init__(self, api_clients_queue=None, resource_items_queue=None,
                  db=None, config_dict=None, retry_resource_items_queue=None,
-                 api_clients_info=None):
+                 api_clients_info=None, index=None, retry_scheduler=None,
+                 bulk_writer=None, revisions_cache=None, codec=None,
+                 validators=None, rate_limiter=None, metrics=None,
+                 tracer=None, event_sampler=None, unsaved=None):
         Greenlet.__init__(self)
         self.exit = False
         self.update_doc = False
@@ -38,23 +48,30 @@ class ResourceItemWorker(Greenlet):
         self.api_clients_queue = api_clients_queue
         self.resource_items_queue = resource_items_queue
         self.retry_resource_items_queue = retry_resource_items_queue
-        self.bulk = {}
-        self.bulk_save_limit = self.config['bulk_save_limit']
-        self.bulk_save_interval = self.config['bulk_save_interval']
-        self.start_time = datetime.now()
         self.api_clients_info = api_clients_info
+        self.index = index
+        self.retry_scheduler = retry_scheduler
+        self.bulk_writer = bulk_writer
+        self.revisions_cache = revisions_cache
+        self.codec = codec
+        self.validators = validators
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics or PipelineMetrics()
+        self.tracer = tracer
+        self.events = EventLog(logger, event_sampler)
+        self.unsaved = unsaved
 
-    def add_to_retry_queue(self, resource_item, status_code=0):
-        timeout = resource_item.get('timeout') or\
-            self.config['retry_default_timeout']
-        retries_count = resource_item.get('retries_count') or 0
-        if status_code != 429:
-            resource_item['timeout'] = timeout * 2
-            resource_item['retries_count'] = retries_count + 1
-        else:
-            resource_item['timeout'] = timeout
-            resource_item['retries_count'] = retries_count
+    def add_to_retry_queue(self, resource_item, status_code=0, reason=None):
+        if reason is None:
+            reason = STATUS_CODE_REASONS.get(status_code, 'default')
+        timeout = retry_delay(resource_item, self.config, reason)
         if resource_item['retries_count'] > self.config['retries_count']:
+            self.metrics.dropped.inc()
+            if self.tracer is not None:
+                self.tracer.finish(resource_item['id'], 'dropped')
+            if self.unsaved is not None:
+                self.unsaved.settle(resource_item['id'],
+                                    resource_item.get('dateModified'))
             logger.critical(
                 '{} {} reached limit retries count {} and dropped from '
                 'retry_queue.'.format(
@@ -62,88 +79,185 @@ class ResourceItemWorker(Greenlet):
                     resource_item['id'], self.config['retries_count']),
                 extra={'MESSAGE_ID': 'dropped_documents'})
         else:
-            self.retry_resource_items_queue.put(resource_item)
-            sleep(timeout)
-            logger.info('Put {} {} to \'retries_queue\''.format(
-                self.config['resource'][:-1], resource_item['id']),
-                extra={'MESSAGE_ID': 'add_to_retry'})
+            self.metrics.retry(reason)
+            if self.tracer is not None:
+                self.tracer.finish(resource_item['id'], 'retried')
+            self.retry_scheduler.schedule(resource_item, timeout)
+            self.events.info('add_to_retry', 'Put {} {} to \'retries_queue\'',
+                             self.config['resource'][:-1], resource_item['id'])
+
+    def _request_done(self, api_client_dict, start):
+        duration = time.time() - start
+        self.api_clients_info[api_client_dict['id']]['latency'].add(duration)
+        self.api_clients_info[api_client_dict['id']]['request_interval'] =\
+            api_client_dict['request_interval']
+        self.metrics.upstream_request.observe(duration)
+
+    def _put_api_client(self, api_client_dict):
+        self.api_clients_queue.put(api_client_dict)
+        self.events.debug('put_client', 'PUT API CLIENT: {}',
+                          api_client_dict['id'])
+
+    def _trace_skipped(self, queue_resource_item):
+        if self.tracer is not None:
+            self.tracer.finish(queue_resource_item['id'], 'skipped')
 
     def _get_api_client_dict(self):
-        if not self.api_clients_queue.empty():
-            try:
-                api_client_dict = self.api_clients_queue.get(
-                    timeout=self.config['queue_timeout'])
-                logger.debug('GET API CLIENT: {}'.format(api_client_dict['id']),
-                             extra={'MESSAGE_ID': 'get_client'})
-                logger.debug('SLEEP before return client: {}'.format(api_client_dict['request_interval']))
-            except Empty:
-                return None
-            if self.api_clients_info[api_client_dict['id']]['drop_cookies']:
-                try:
-                    api_client_dict['client'].renew_cookies()
-                    self.api_clients_info[api_client_dict['id']] = {
-                        'drop_cookies': False,
-                        'request_durations': {},
-                        'request_interval': 0,
-                        'avg_duration': 0
-                    }
-                    api_client_dict['request_interval'] = 0
-                    api_client_dict['not_actual_count'] = 0
-                    logger.info('Drop lazy api_client {} cookies'.format(
-                        api_client_dict['id']))
-                except (Exception, ConnectionError) as e:
-                    self.api_clients_queue.put(api_client_dict)
-                    logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                                 extra={'MESSAGE_ID': 'put_client'})
-                    logger.error('While renewing cookies catch exception: '
-                                 '{}'.format(e.message))
-                    return None
+        # Wait at most 'queue_timeout', so worker notices shutdown
+        try:
+            api_client_dict = self.api_clients_queue.get(
+                timeout=self.config['queue_timeout'])
+            self.events.debug('get_client', 'GET API CLIENT: {}',
+                              api_client_dict['id'])
+            self.events.debug(None, 'SLEEP before return client: {}',
+                              api_client_dict['request_interval'])
+        except Empty:
+            return None
+        api_client_dict = self._renew_api_client(api_client_dict)
+        if api_client_dict is None:
+            return None
+        self.events.debug(
+            None, 'Got api_client ID: {} {}', api_client_dict['id'],
+            api_client_dict['client'].session.headers['User-Agent'])
+        return api_client_dict
+
+    def _renew_api_client(self, api_client_dict):
+        """Drop cookies of client marked by perfomance watcher
 
-            logger.debug('Got api_client ID: {} {}'.format(
-                api_client_dict['id'],
-                api_client_dict['client'].session.headers['User-Agent']))
+        Client is put back and None is returned when renewal fails.
+        """
+        if not self.api_clients_info[api_client_dict['id']]['drop_cookies']:
             return api_client_dict
-        else:
+        try:
+            api_client_dict['client'].renew_cookies()
+            client_info = self.api_clients_info[api_client_dict['id']]
+            client_info['latency'].reset()
+            client_info.update({
+                'drop_cookies': False,
+                'request_interval': 0,
+                'p50': 0,
+                'p95': 0,
+                'p99': 0
+            })
+            api_client_dict['request_interval'] = 0
+            api_client_dict['not_actual_count'] = 0
+            logger.info('Drop lazy api_client {} cookies'.format(
+                api_client_dict['id']))
+        except (Exception, ConnectionError) as e:
+            self._put_api_client(api_client_dict)
+            logger.error('While renewing cookies catch exception: '
+                         '{}'.format(e.message))
             return None
+        return api_client_dict
+
+    def _get_fresher_api_client(self, date_modified, exclude):
+        """Idle client of backend that served ``date_modified`` already"""
+        api_client_dict = self.api_clients_queue.get_fresher(date_modified,
+                                                             exclude)
+        if api_client_dict is None:
+            return None
+        # Backend is tried once, even if client is pinned anew on renewal
+        exclude.append(self.api_clients_queue.backend(api_client_dict))
+        return self._renew_api_client(api_client_dict)
+
+    def _wait_api_client_dict(self):
+        """Block until API client is available or worker is shut down"""
+        api_client_dict = self._get_api_client_dict()
+        while api_client_dict is None and not self.exit:
+            self.events.debug(None, 'API clients queue is empty.')
+            api_client_dict = self._get_api_client_dict()
+        return api_client_dict
+
+    def _requeue(self, queue_resource_item):
+        """Return item of shut down worker to queue, it isn't an attempt"""
+        if self.tracer is not None:
+            self.tracer.finish(queue_resource_item['id'], 'retried')
+        try:
+            self.resource_items_queue.put_nowait(queue_resource_item)
+        except Full:
+            # Scheduler heap is journaled on drain
+            self.retry_scheduler.schedule(queue_resource_item, 0)
 
     def _get_resource_item_from_queue(self):
-        if not self.resource_items_queue.empty():
+        try:
             queue_resource_item = self.resource_items_queue.get(
                 timeout=self.config['queue_timeout'])
-            logger.debug('Get {} {} from main queue.'.format(
-                self.config['resource'][:-1], queue_resource_item['id']))
-            return queue_resource_item
-        else:
+        except Empty:
             return None
+        self.events.debug(None, 'Get {} {} from main queue.',
+                          self.config['resource'][:-1],
+                          queue_resource_item['id'])
+        return queue_resource_item
 
     def _get_resource_item_from_public(self, api_client_dict,
                                        queue_resource_item):
-        retry_key = 'rev' if self.config['historical'] else 'dateModified'
+        exclude = []
+        while True:
+            resource_item = self._request_public_resource_item(
+                api_client_dict, queue_resource_item, exclude)
+            if resource_item is not NOT_ACTUAL:
+                return resource_item
+            # Backend that already served newer documents has this one
+            api_client_dict = self._get_fresher_api_client(
+                queue_resource_item['dateModified'], exclude)
+            if api_client_dict is None:
+                self.add_to_retry_queue(
+                    QueueItem.for_retry(queue_resource_item),
+                    reason='not_actual')
+                return None  # Not actual
+            logger.info('Route {} {} to client {} of fresher backend'.format(
+                self.config['resource'][:-1], queue_resource_item['id'],
+                api_client_dict['id']),
+                extra={'MESSAGE_ID': 'rerouted_docs'})
+
+    def _request_public_resource_item(self, api_client_dict,
+                                      queue_resource_item, exclude):
+        """Request item with client and put client back exactly once
+
+        Backend of client that returned not actual document is added to
+        ``exclude`` and NOT_ACTUAL is returned.
+        """
         try:
-            logger.debug('Request interval {} sec. for client {}'.format(
+            self.events.debug(
+                None, 'Request interval {} sec. for client {}',
                 api_client_dict['request_interval'],
-                api_client_dict['client'].session.headers['User-Agent']))
+                api_client_dict['client'].session.headers['User-Agent'])
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
             start = time.time()
             if self.config['historical']:
                 resource_item = api_client_dict['client'].get_resource_item_historical(
                     queue_resource_item['id'], queue_resource_item['rev']
                 ).get('data')
                 resource_item['rev'] = str(queue_resource_item['rev'])
+            elif self.codec is not None or self.validators is not None:
+                resource_item = self._request_resource_item(
+                    api_client_dict['client'], queue_resource_item)
             else:
                 resource_item = api_client_dict['client'].get_resource_item(
                     queue_resource_item['id']
                 ).get('data')
-            self.api_clients_info[api_client_dict['id']][
-                'request_durations'][datetime.now()] = time.time() - start
-            self.api_clients_info[api_client_dict['id']]['request_interval'] =\
-                api_client_dict['request_interval']
+            self._request_done(api_client_dict, start)
+            if self.rate_limiter is not None:
+                self.rate_limiter.on_success()
+            if resource_item is None:
+                self.metrics.skip('not_modified')
+                self._put_api_client(api_client_dict)
+                self.events.debug('not_modified_docs',
+                                  'Not modified {} {} already saved',
+                                  self.config['resource'][:-1],
+                                  queue_resource_item['id'])
+                return None  # Not modified
             log_value = resource_item['rev'] if self.config['historical'] else resource_item['dateModified']
-            logger.debug('Received from API {}: {}-{}'.format(
-                self.config['resource'][:-1], resource_item['id'],
-                log_value))
+            self.events.debug(None, 'Received from API {}: {}-{}',
+                              self.config['resource'][:-1],
+                              resource_item['id'], log_value)
             if api_client_dict['request_interval'] > 0:
                 api_client_dict['request_interval'] -=\
                     self.config['client_dec_step_timeout']
+            if not self.config['historical']:
+                self.api_clients_queue.seen(api_client_dict,
+                                            resource_item['dateModified'])
             if not self.config['historical'] and resource_item['dateModified'] <\
                     queue_resource_item['dateModified']:
                 logger.info(
@@ -153,51 +267,40 @@ class ResourceItemWorker(Greenlet):
                             'User-Agent'], self.config['resource'][:-1],
                         queue_resource_item['id']),
                     extra={'MESSAGE_ID': 'not_actual_docs'})
-                self.add_to_retry_queue({
-                    'id': queue_resource_item['id'],
-                    'dateModified': queue_resource_item['dateModified']
-                })
-                self.api_clients_queue.put(api_client_dict)
-                logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                             extra={'MESSAGE_ID': 'put_client'})
-                return None  # Not actual
-            self.api_clients_queue.put(api_client_dict)
-            logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                         extra={'MESSAGE_ID': 'put_client'})
+                exclude.append(self.api_clients_queue.backend(api_client_dict))
+                self._put_api_client(api_client_dict)
+                return NOT_ACTUAL
+            self._put_api_client(api_client_dict)
             return resource_item
         except ResourceGone:
-            self.api_clients_queue.put(api_client_dict)
-            logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                         extra={'MESSAGE_ID': 'put_client'})
+            self._put_api_client(api_client_dict)
+            if self.unsaved is not None:
+                self.unsaved.settle(queue_resource_item['id'],
+                                    queue_resource_item['dateModified'])
             logger.info(
                 '{} {} archived.'.format(self.config['resource'][:-1].title(),
                                          queue_resource_item['id'])
             )
             return None  # Archived
         except InvalidResponse as e:
-            self.api_clients_info[api_client_dict['id']][
-                'request_durations'][datetime.now()] = time.time() - start
-            self.api_clients_info[api_client_dict['id']]['request_interval'] =\
-                api_client_dict['request_interval']
-            self.api_clients_queue.put(api_client_dict)
-            logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                         extra={'MESSAGE_ID': 'put_client'})
+            self._request_done(api_client_dict, start)
+            self._put_api_client(api_client_dict)
             logger.error(
                 'Error while getting {} {} from public with status code: '
                 '{}'.format(
                     self.config['resource'][:-1], queue_resource_item['id'],
                     e.status_code), extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue({
-                'id': queue_resource_item['id'],
-                retry_key: queue_resource_item[retry_key]
-            })
+            self.add_to_retry_queue(
+                QueueItem.for_retry(queue_resource_item), reason='invalid_response')
             return None
         except RequestFailed as e:
-            self.api_clients_info[api_client_dict['id']][
-                'request_durations'][datetime.now()] = time.time() - start
-            self.api_clients_info[api_client_dict['id']]['request_interval'] =\
-                api_client_dict['request_interval']
+            self._request_done(api_client_dict, start)
             if e.status_code == 429:
+                self.api_clients_info[api_client_dict['id']][
+                    'latency'].throttle()
+                self.metrics.upstream_throttled.inc()
+                if self.rate_limiter is not None:
+                    self.rate_limiter.on_throttle(retry_after(e))
                 if (api_client_dict['request_interval'] >
                         self.config['drop_threshold_client_cookies']):
                     api_client_dict['client'].session.cookies.clear()
@@ -212,24 +315,22 @@ class ResourceItemWorker(Greenlet):
                         api_client_dict['request_interval']),
                     extra={'MESSAGE_ID': 'put_client'})
             else:
-                self.api_clients_queue.put(api_client_dict)
-                logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                             extra={'MESSAGE_ID': 'put_client'})
+                self._put_api_client(api_client_dict)
             logger.error(
                 'Request failed while getting {} {} from public with status '
                 'code {}: '.format(
                     self.config['resource'][:-1], queue_resource_item['id'],
                     e.status_code), extra={'MESSAGE_ID': 'exceptions'})
-            self.add_to_retry_queue({
-                'id': queue_resource_item['id'],
-                retry_key: queue_resource_item[retry_key]
-            }, status_code=e.status_code)
+            retry_item = QueueItem.for_retry(queue_resource_item)
+            if e.status_code == 429:
+                # Throttled item keeps retry state, so its attempts add up
+                retry_item.timeout = queue_resource_item.get('timeout')
+                retry_item.retries_count = queue_resource_item.get(
+                    'retries_count')
+            self.add_to_retry_queue(retry_item, status_code=e.status_code)
             return None  # request failed
         except ResourceNotFound as e:
-            self.api_clients_info[api_client_dict['id']][
-                'request_durations'][datetime.now()] = time.time() - start
-            self.api_clients_info[api_client_dict['id']]['request_interval'] =\
-                api_client_dict['request_interval']
+            self._request_done(api_client_dict, start)
             log_value = queue_resource_item['rev'] if self.config['historical'] else queue_resource_item['dateModified']
             logger.error('Resource not found {} at public: {}-{}. {}'.format(
                 self.config['resource'][:-1], queue_resource_item['id'],
@@ -238,22 +339,13 @@ class ResourceItemWorker(Greenlet):
 
             api_client_dict['client'].session.cookies.clear()
             logger.info('Clear client cookies')
-            self.add_to_retry_queue({
-                'id': queue_resource_item['id'],
-                retry_key: queue_resource_item[retry_key]
-            })
-            self.api_clients_queue.put(api_client_dict)
-            logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                         extra={'MESSAGE_ID': 'put_client'})
+            self.add_to_retry_queue(
+                QueueItem.for_retry(queue_resource_item), reason='not_found')
+            self._put_api_client(api_client_dict)
             return None  # not found
         except Exception as e:
-            self.api_clients_info[api_client_dict['id']][
-                'request_durations'][datetime.now()] = time.time() - start
-            self.api_clients_info[api_client_dict['id']]['request_interval'] =\
-                api_client_dict['request_interval']
-            self.api_clients_queue.put(api_client_dict)
-            logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                         extra={'MESSAGE_ID': 'put_client'})
+            self._request_done(api_client_dict, start)
+            self._put_api_client(api_client_dict)
             log_value = queue_resource_item['rev'] if self.config['historical'] else queue_resource_item['dateModified']
             logger.error(
                 'Error while getting resource item {} {}-{} from public '
@@ -262,143 +354,117 @@ class ResourceItemWorker(Greenlet):
                     log_value, e.message),
                 extra={'MESSAGE_ID': 'exceptions'})
 
-            self.add_to_retry_queue({
-                'id': queue_resource_item['id'],
-                retry_key: queue_resource_item[retry_key]
-            })
+            self.add_to_retry_queue(
+                QueueItem.for_retry(queue_resource_item))
             return None
 
-    def _add_to_bulk(self, resource_item, resource_item_doc=None):
+    def _delta_encode(self, resource_item):
+        """Return patch against previous revision or None for snapshot"""
+        rev = int(resource_item['rev'])
+        interval = self.config['historical_snapshot_interval']
+        self.revisions_cache.put(resource_item['id'], rev, resource_item)
+        if is_snapshot_rev(rev, interval):
+            return None
+        previous = self.revisions_cache.get(resource_item['id'], rev - 1)
+        if previous is None:
+            try:
+                previous = rebuild_revision(self.db, resource_item['id'],
+                                            rev - 1, interval)
+            except Exception as e:
+                logger.error('Error while rebuilding {} {}-{}: {}'.format(
+                    self.config['resource'][:-1], resource_item['id'],
+                    rev - 1, repr(e)), extra={'MESSAGE_ID': 'exceptions'})
+        if previous is None:
+            # Previous revision isn't fetched yet, store this one full
+            self.events.debug('historical_snapshot', 'Store full {} {}-{}',
+                              self.config['resource'][:-1],
+                              resource_item['id'], rev)
+            return None
+        return make_delta(previous, resource_item)
+
+    def _request_resource_item(self, client, queue_resource_item):
+        """GET document, conditional when its validator is known
+
+        On 304 answer document isn't received again: replica that isn't
+        actual yet is reported by stub with dateModified of known body, None
+        is returned when that body is already saved.
+        """
+        item_id = queue_resource_item['id']
+        path = '{}/{}'.format(client.prefix_path, item_id)
+        headers = {}
+        if (self.validators is not None and
+                queue_resource_item['dateModified'] is not None):
+            headers = self.validators.headers(item_id)
+        response = client.request('GET', path, headers=headers)
+        if response.status_code == 304:
+            date_modified = self.validators.date_modified(item_id)
+            if (date_modified is not None and
+                    date_modified < queue_resource_item['dateModified']):
+                return {'id': item_id, 'dateModified': date_modified}
+            local_date_modified = self.index.date_modified(item_id)
+            if (date_modified is not None and
+                    local_date_modified is not None and
+                    local_date_modified >= date_modified):
+                return None
+            # Known body wasn't saved, receive it again
+            if self.rate_limiter is not None:
+                self.rate_limiter.acquire()
+            response = client.request('GET', path)
+        if response.status_code != 200:
+            raise InvalidResponse(response)
+        if self.codec is not None:
+            resource_item = self.codec.loads(response.content)
+        else:
+            resource_item = loads(response.content)['data']
+        if self.validators is not None:
+            self.validators.update(item_id, response.headers,
+                                   resource_item['dateModified'])
+        return resource_item
+
+    def _add_to_bulk(self, resource_item, local_rev=None):
         resource_item['doc_type'] = self.config['resource'][:-1].title()
         if self.config['historical']:
+            if self.config['historical_delta']:
+                delta = self._delta_encode(resource_item)
+                if delta is not None:
+                    delta['doc_type'] = resource_item['doc_type'] + 'Delta'
+                    resource_item = delta
             resource_item['_id'] = resource_item['id'] + '-' + resource_item['rev']
         else:
             resource_item['_id'] = resource_item['id']
-        if resource_item_doc:
-            resource_item['_rev'] = resource_item_doc['_rev']
-        bulk_doc = self.bulk.get(resource_item['id'])
-
-        if self.config['historical']:
-            self.bulk[resource_item['id']] = resource_item
-            logger.debug('Put in bulk {} {}-{}'.format(
-                self.config['resource'][:-1], resource_item['id'],
-                resource_item['rev']),
-                extra={'MESSAGE_ID': 'add_to_save_bulk'})
-        else:
-            if bulk_doc and bulk_doc['dateModified'] <\
-                    resource_item['dateModified']:
-                logger.debug(
-                    'Replaced {} in bulk {} previous {}, current {}'.format(
-                        self.config['resource'][:-1], bulk_doc['id'],
-                        bulk_doc['dateModified'], resource_item['dateModified']),
-                    extra={'MESSAGE_ID': 'skipped'})
-                self.bulk[resource_item['id']] = resource_item
-            elif bulk_doc and bulk_doc['dateModified'] >=\
-                    resource_item['dateModified']:
-                logger.debug(
-                    'Ignored duplicate {} {} in bulk: previous {}, current '
-                    '{}'.format(
-                        self.config['resource'][:-1], resource_item['id'],
-                        bulk_doc['dateModified'], resource_item['dateModified']),
-                    extra={'MESSAGE_ID': 'skipped'})
-            if not bulk_doc:
-                self.bulk[resource_item['id']] = resource_item
-                logger.debug('Put in bulk {} {} {}'.format(
-                    self.config['resource'][:-1], resource_item['id'],
-                    resource_item['dateModified']),
-                    extra={'MESSAGE_ID': 'add_to_save_bulk'})
-        return
-
-    def _save_bulk_docs(self):
-        if (len(self.bulk) > self.bulk_save_limit or
-                (datetime.now() - self.start_time).total_seconds() >
-                self.bulk_save_interval or self.exit):
-            try:
-                logger.debug('Try save bulk: {}'.format(len(self.bulk)),
-                             extra={'SAVE_BULK_LEN': len(self.bulk)})
-                start = time.time()
-                res = self.db.update(self.bulk.values())
-                end = time.time() - start
-                logger.debug('Bulk save duration: {} sec.'.format(end),
-                             extra={'SAVE_BULK_DURATION': end})
-                if not self.config['historical']:
-                    for resource_item in self.bulk.values():
-                        ts = (datetime.now(TZ) -
-                              parse_date(resource_item[
-                                  'dateModified'])).total_seconds()
-                        logger.debug('{} {} timeshift is {} sec.'.format(
-                            self.config['resource'][:-1], resource_item['id'], ts),
-                            extra={'DOCUMENT_TIMESHIFT': ts})
-                logger.info('Save bulk {} docs to db.'.format(len(self.bulk)))
-            except Exception as e:
-                logger.error('Error while saving bulk_docs in db: {}'.format(
-                    e.message), extra={'MESSAGE_ID': 'exceptions'})
-                for doc in self.bulk.values():
-                    if self.config['historical']:
-                        self.add_to_retry_queue({
-                            'id': doc['id'],
-                            'rev': doc['rev']
-                        })
-                    else:
-                        self.add_to_retry_queue({
-                            'id': doc['id'],
-                            'dateModified': doc['dateModified']
-                        })
-                self.bulk = {}
-                self.start_time = datetime.now()
-                return
-            self.bulk = {}
-            for success, doc_id, rev_or_exc in res:
-                if success:
-                    if not rev_or_exc.startswith('1-'):
-                        logger.info('Update {} {}'.format(
-                            self.config['resource'][:-1], doc_id),
-                            extra={'MESSAGE_ID': 'update_documents'})
-                    else:
-                        logger.info('Save {} {}'.format(
-                            self.config['resource'][:-1], doc_id),
-                            extra={'MESSAGE_ID': 'save_documents'})
-                    continue
-                elif not self.config['historical']:
-                    if rev_or_exc.message !=\
-                            u'New doc with oldest dateModified.':
-                        self.add_to_retry_queue({'id': doc_id,
-                                                 'dateModified': None})
-                        logger.error(
-                            'Put to retry queue {} {} with reason: '
-                            '{}'.format(self.config['resource'][:-1],
-                                        doc_id, rev_or_exc.message))
-                    else:
-                        logger.debug('Ignored {} {} with reason: {}'.format(
-                            self.config['resource'][:-1], doc_id, rev_or_exc),
-                            extra={'MESSAGE_ID': 'skipped'})
-                        continue
-            self.start_time = datetime.now()
+        if local_rev:
+            resource_item['_rev'] = local_rev
+        self.bulk_writer.add(resource_item)
+        log_value = resource_item['rev'] if self.config['historical'] else resource_item['dateModified']
+        self.events.debug('add_to_save_bulk', 'Put in bulk {} {} {}',
+                          self.config['resource'][:-1], resource_item['id'],
+                          log_value)
 
     def _run(self):
         while not self.exit:
-            # Try get api client from clients queue
-            api_client_dict = self._get_api_client_dict()
-            if api_client_dict is None:
-                logger.debug('API clients queue is empty.')
-                sleep(self.config['worker_sleep'])
-                continue
-            # Try get item from resource items queue
+            # Wait for item before taking client, so idle workers don't hold
+            # API clients busy workers need. Both queues wake up waiting
+            # worker as soon as something is put.
             queue_resource_item = self._get_resource_item_from_queue()
             if queue_resource_item is None:
-                self.api_clients_queue.put(api_client_dict)
-                logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                             extra={'MESSAGE_ID': 'put_client'})
-                logger.debug('Resource items queue is empty.')
-                sleep(self.config['worker_sleep'])
+                self.events.debug(None, 'Resource items queue is empty.')
+                continue
+            if self.tracer is not None:
+                self.tracer.mark(queue_resource_item['id'], 'main_queue')
+            api_client_dict = self._wait_api_client_dict()
+            if api_client_dict is None:
+                # Worker is shut down, item is left to the others
+                self._requeue(queue_resource_item)
                 continue
+            if self.tracer is not None:
+                self.tracer.mark(queue_resource_item['id'], 'api_client')
 
-            resource_item_doc = None
-            # Try get resource item from local storage
+            local_item = None
+            # Try get resource item from local index
             if not self.config['historical']:
                 try:
-                    # Resource object from local db server
-                    resource_item_doc = self.db.get(queue_resource_item['id'])
+                    # (dateModified, _rev) of local document
+                    local_item = self.index.get(queue_resource_item['id'])
                     if queue_resource_item['dateModified'] is None:
                         public_doc = self._get_resource_item_from_public(
                             api_client_dict, queue_resource_item)
@@ -406,48 +472,57 @@ class ResourceItemWorker(Greenlet):
                             queue_resource_item['dateModified'] \
                                 = public_doc['dateModified']
                         else:
+                            self._trace_skipped(queue_resource_item)
                             continue
-                        api_client_dict = self._get_api_client_dict()
+                        api_client_dict = self._wait_api_client_dict()
                         if api_client_dict is None:
-                            self.add_to_retry_queue(queue_resource_item)
+                            self._requeue(queue_resource_item)
                             continue
-                    if (resource_item_doc and
-                            resource_item_doc['dateModified'] >=
+                    if (local_item and local_item[0] is not None and
+                            local_item[0] >=
                             queue_resource_item['dateModified']):
-                        logger.debug('Ignored {} {} QUEUE - {}, EDGE - {}'.format(
-                            self.config['resource'][:-1],
-                            queue_resource_item['id'],
-                            queue_resource_item['dateModified'],
-                            resource_item_doc['dateModified']),
-                            extra={'MESSAGE_ID': 'skiped'})
-                        self.api_clients_queue.put(api_client_dict)
-                        logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                                     extra={'MESSAGE_ID': 'put_client'})
+                        self.events.debug('skiped',
+                                          'Ignored {} {} QUEUE - {}, EDGE - {}',
+                                          self.config['resource'][:-1],
+                                          queue_resource_item['id'],
+                                          queue_resource_item['dateModified'],
+                                          local_item[0])
+                        self.metrics.skip('worker')
+                        self._trace_skipped(queue_resource_item)
+                        self._put_api_client(api_client_dict)
                         continue
                 except Exception as e:
-                    self.api_clients_queue.put(api_client_dict)
-                    logger.debug('PUT API CLIENT: {}'.format(api_client_dict['id']),
-                                 extra={'MESSAGE_ID': 'put_client'})
-                    self.add_to_retry_queue({
-                        'id': queue_resource_item['id'],
-                        'dateModified': queue_resource_item['dateModified']
-                    })
+                    self._put_api_client(api_client_dict)
+                    self.add_to_retry_queue(
+                        QueueItem.for_retry(queue_resource_item))
                     logger.error('Error while getting resource item from couchdb: '
                                  '{}'.format(repr(e)),
                                  extra={'MESSAGE_ID': 'exceptions'})
                     continue
 
-            # Try get resource item from public server
-            resource_item = self._get_resource_item_from_public(
-                api_client_dict, queue_resource_item)
-            if resource_item is None:
-                continue
-
-            # Add docs to bulk
-            self._add_to_bulk(resource_item, resource_item_doc)
+            # Use full document received from feed in bulk ingest mode
+            resource_item = queue_resource_item.get('doc')
+            if resource_item is not None:
+                self._put_api_client(api_client_dict)
+                self.events.debug('received_from_feed',
+                                  'Received from feed {}: {} {}',
+                                  self.config['resource'][:-1],
+                                  resource_item['id'],
+                                  resource_item['dateModified'])
+            else:
+                # Try get resource item from public server
+                resource_item = self._get_resource_item_from_public(
+                    api_client_dict, queue_resource_item)
+                if resource_item is None:
+                    # Items put to retry have finished their traces already
+                    self._trace_skipped(queue_resource_item)
+                    continue
+                if self.tracer is not None:
+                    self.tracer.mark(queue_resource_item['id'], 'upstream')
 
-            # Save/Update docs in db
-            self._save_bulk_docs()
+            # Add docs to bulk, writer saves it to db
+            self._add_to_bulk(resource_item,
+                              local_item[1] if local_item else None)
 
     def shutdown(self):
         self.exit = True
@@ -0,0 +1,253 @@
+# -*- coding: utf-8 -*-
+from gevent import monkey
+monkey.patch_all()
+
+import logging
+import os
+import time
+from couchdb.http import ResourceConflict, ServerError
+from datetime import datetime
+from gevent import Greenlet
+from gevent.event import Event
+from gevent.pool import Pool
+from iso8601 import parse_date
+from pytz import timezone
+from openprocurement.edge.codec import encode_document
+from openprocurement.edge.events import EventLog
+from openprocurement.edge.items import QueueItem
+from openprocurement.edge.metrics import PipelineMetrics
+from openprocurement.edge.retry import retry_delay
+
+logger = logging.getLogger(__name__)
+
+TZ = timezone(os.environ['TZ'] if 'TZ' in os.environ else 'Europe/Kiev')
+
+
+class BulkWriter(Greenlet):
+
+    """Single save stage fed by all workers of resource pipeline
+
+    Documents are JSON encoded once when added, so the size of pending bulk
+    is known and ``_bulk_docs`` body is assembled from ready strings. Bulk
+    is flushed when it reaches ``bulk_save_limit`` documents or
+    ``bulk_save_bytes`` bytes, or when its oldest document waits for
+    ``bulk_save_interval`` seconds. Up to ``bulk_save_concurrency`` bulk
+    requests are in flight, further flushes wait for a free slot, which
+    slows down workers feeding the writer.
+
+    Items of every bulk are recorded in ``journal`` if given, until the
+    bulk request is over.
+    """
+
+    def __init__(self, db=None, config_dict=None, index=None,
+                 retry_scheduler=None, journal=None, metrics=None,
+                 tracer=None, event_sampler=None, unsaved=None):
+        Greenlet.__init__(self)
+        self.exit = False
+        self.db = db
+        self.config = config_dict
+        self.index = index
+        self.retry_scheduler = retry_scheduler
+        self.journal = journal
+        self.metrics = metrics or PipelineMetrics()
+        self.tracer = tracer
+        self.events = EventLog(logger, event_sampler)
+        self.unsaved = unsaved
+        self.bulk_save_limit = self.config['bulk_save_limit']
+        self.bulk_save_bytes = self.config['bulk_save_bytes']
+        self.bulk_save_interval = self.config['bulk_save_interval']
+        self.pool = Pool(self.config['bulk_save_concurrency'])
+        self.bulk = {}
+        self.bulk_bytes = 0
+        self.start_time = None
+        self.wakeup = Event()
+
+    def add(self, resource_item):
+        bulk_doc = self.bulk.get(resource_item['_id'])
+        if bulk_doc is not None:
+            if self.config['historical']:
+                return
+            if bulk_doc[0]['dateModified'] >= resource_item['dateModified']:
+                self.metrics.skip('bulk')
+                self.events.debug(
+                    'skipped',
+                    'Ignored duplicate {} {} in bulk: previous {}, current {}',
+                    self.config['resource'][:-1], resource_item['id'],
+                    bulk_doc[0]['dateModified'], resource_item['dateModified'])
+                return
+            self.events.debug('skipped',
+                              'Replaced {} in bulk {} previous {}, current {}',
+                              self.config['resource'][:-1],
+                              resource_item['id'], bulk_doc[0]['dateModified'],
+                              resource_item['dateModified'])
+            self.bulk_bytes -= len(bulk_doc[1])
+        encoded = encode_document(resource_item)
+        self.bulk[resource_item['_id']] = (resource_item, encoded)
+        self.bulk_bytes += len(encoded)
+        if self.start_time is None:
+            self.start_time = time.time()
+            # Start timer of new bulk
+            self.wakeup.set()
+        if (len(self.bulk) >= self.bulk_save_limit or
+                self.bulk_bytes >= self.bulk_save_bytes):
+            self.flush()
+
+    def flush(self):
+        if not self.bulk:
+            return
+        bulk = self.bulk
+        self.bulk = {}
+        self.bulk_bytes = 0
+        self.start_time = None
+        if self.journal is not None:
+            self.journal.begin(doc for doc, _ in bulk.values())
+        self.pool.spawn(self._save_bulk_docs, bulk)
+
+    def add_to_retry_queue(self, resource_item, reason='default'):
+        timeout = retry_delay(resource_item, self.config, reason)
+        if resource_item['retries_count'] > self.config['retries_count']:
+            self.metrics.dropped.inc()
+            if self.tracer is not None:
+                self.tracer.finish(resource_item['id'], 'dropped')
+            if self.unsaved is not None:
+                self.unsaved.settle(resource_item['id'],
+                                    resource_item['dateModified'])
+            logger.critical(
+                '{} {} reached limit retries count {} and dropped from '
+                'retry_queue.'.format(
+                    self.config['resource'][:-1].title(),
+                    resource_item['id'], self.config['retries_count']),
+                extra={'MESSAGE_ID': 'dropped_documents'})
+        else:
+            self.metrics.retry(reason)
+            if self.tracer is not None:
+                self.tracer.finish(resource_item['id'], 'retried')
+            self.retry_scheduler.schedule(resource_item, timeout)
+            self.events.info('add_to_retry', 'Put {} {} to \'retries_queue\'',
+                             self.config['resource'][:-1], resource_item['id'])
+
+    def _post_bulk_docs(self, bulk):
+        body = '{"docs":[' + ','.join(encoded for _, encoded in
+                                       bulk.values()) + ']}'
+        _, _, data = self.db.resource.post_json(
+            '_bulk_docs', body=body,
+            headers={'Content-Type': 'application/json'})
+        results = []
+        for result in data:
+            if 'error' in result:
+                if result['error'] == 'conflict':
+                    exc_type = ResourceConflict
+                else:
+                    exc_type = ServerError
+                results.append((False, result['id'],
+                                exc_type(result['reason'])))
+            else:
+                results.append((True, result['id'], result['rev']))
+        return results
+
+    def _save_bulk_docs(self, bulk):
+        try:
+            self.events.debug(None, 'Try save bulk: {}', len(bulk),
+                              SAVE_BULK_LEN=len(bulk))
+            self.metrics.bulk_docs_size.observe(len(bulk))
+            if self.tracer is not None:
+                for doc, _ in bulk.values():
+                    self.tracer.mark(doc['id'], 'bulk')
+            start = time.time()
+            res = self._post_bulk_docs(bulk)
+            end = time.time() - start
+            self.metrics.bulk_docs.observe(end)
+            self.events.debug(None, 'Bulk save duration: {} sec.', end,
+                              SAVE_BULK_DURATION=end)
+            # Parsing dateModified of every document is costly, it's done
+            # only for DEBUG
+            if not self.config['historical'] and self.events.enabled():
+                for resource_item, _ in bulk.values():
+                    ts = (datetime.now(TZ) -
+                          parse_date(resource_item[
+                              'dateModified'])).total_seconds()
+                    self.events.debug(None, '{} {} timeshift is {} sec.',
+                                      self.config['resource'][:-1],
+                                      resource_item['id'], ts,
+                                      DOCUMENT_TIMESHIFT=ts)
+            self.events.info(None, 'Save bulk {} docs to db.', len(bulk))
+        except Exception as e:
+            logger.error('Error while saving bulk_docs in db: {}'.format(
+                e.message), extra={'MESSAGE_ID': 'exceptions'})
+            for doc, _ in bulk.values():
+                if self.config['historical']:
+                    self.add_to_retry_queue(QueueItem(doc['id'],
+                                                      rev=doc['rev']))
+                else:
+                    self.add_to_retry_queue(QueueItem(doc['id'],
+                                                      doc['dateModified']))
+            self._journal_done(bulk)
+            return
+        for success, doc_id, rev_or_exc in res:
+            if self.tracer is not None:
+                self.tracer.mark(doc_id, 'bulk_docs')
+            if success:
+                if not self.config['historical']:
+                    self.index.update(doc_id,
+                                      bulk[doc_id][0]['dateModified'],
+                                      rev_or_exc)
+                if not rev_or_exc.startswith('1-'):
+                    self.metrics.updated.inc()
+                    self.events.debug('update_documents', 'Update {} {}',
+                                      self.config['resource'][:-1], doc_id)
+                else:
+                    self.metrics.created.inc()
+                    self.events.debug('save_documents', 'Save {} {}',
+                                      self.config['resource'][:-1], doc_id)
+                if self.tracer is not None:
+                    self.tracer.finish(doc_id, 'saved')
+            elif not self.config['historical']:
+                # Local document differs from indexed one, reload entry
+                try:
+                    self.index.refresh(self.db, doc_id)
+                except Exception as e:
+                    logger.error('Error while refreshing index entry {} '
+                                 '{}: {}'.format(
+                                     self.config['resource'][:-1], doc_id,
+                                     repr(e)),
+                                 extra={'MESSAGE_ID': 'exceptions'})
+                if rev_or_exc.message !=\
+                        u'New doc with oldest dateModified.':
+                    self.add_to_retry_queue(QueueItem(doc_id),
+                                            reason='conflict')
+                    logger.error(
+                        'Put to retry queue {} {} with reason: '
+                        '{}'.format(self.config['resource'][:-1],
+                                    doc_id, rev_or_exc.message))
+                else:
+                    self.metrics.skip('save')
+                    if self.tracer is not None:
+                        self.tracer.finish(doc_id, 'skipped')
+                    self.events.debug('skipped',
+                                      'Ignored {} {} with reason: {}',
+                                      self.config['resource'][:-1], doc_id,
+                                      rev_or_exc)
+        self._journal_done(bulk)
+
+    def _journal_done(self, bulk):
+        # Failed items are in retry scheduler already
+        if self.journal is not None:
+            self.journal.done(doc for doc, _ in bulk.values())
+
+    def _run(self):
+        while not self.exit:
+            self.wakeup.clear()
+            if self.start_time is None:
+                self.wakeup.wait()
+                continue
+            timeout = self.start_time + self.bulk_save_interval - time.time()
+            if timeout > 0:
+                self.wakeup.wait(timeout)
+            else:
+                self.flush()
+        self.flush()
+        self.pool.join()
+
+    def shutdown(self):
+        self.exit = True
+        self.wakeup.set()
@@ -19,7 +19,8 @@ requires = [
     'tzlocal',
     'pyyaml',
     'psutil',
-    'iso8601'
+    'iso8601',
+    'jsonpatch'
 ]
 test_requires = requires + [
     'requests',
@@ -34,7 +35,8 @@ entry_points = {
         'main = openprocurement.edge.main:main'
     ],
     'console_scripts': [
-        'edge_data_bridge = openprocurement.edge.databridge:main'
+        'edge_data_bridge = openprocurement.edge.databridge:main',
+        'edge_data_bridge_benchmark = openprocurement.edge.benchmark:main'
     ]
 }
 